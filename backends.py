@@ -0,0 +1,602 @@
+"""
+AI backends and routing between them.
+
+A backend makes one completion request against one upstream: an
+OpenAI-compatible HTTP endpoint, or the built-in simulated upstream. The
+router spreads requests over the configured backends, preferring healthy
+backends with fewer outstanding requests and lower observed latency. When a
+backend fails, the router fails over to another one within the same attempt.
+Optionally, slow non-streaming requests are hedged to a second backend.
+"""
+import asyncio
+import random
+import time
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+import aiohttp
+from models import CursorMessage, MessageType
+from context_window import CHARS_PER_TOKEN, estimate_tokens
+from hedging import Hedger
+from performance import json_dumps_str, json_loads
+from request_batcher import RequestBatcher, BatchingUnsupportedError
+from resilience import CursorAPIError, parse_retry_after
+from simulation import SimulationProfile, parse_latency
+from logger import get_logger
+from config import settings
+
+logger = get_logger("backends")
+
+ChunkCallback = Callable[[str], Awaitable[None]]
+
+# Responses from the batch endpoint meaning the backend has no batch support
+BATCH_UNSUPPORTED_STATUSES = (404, 405, 501)
+
+# Least latency, in seconds, a failed request counts as when ranking backends
+FAILURE_LATENCY_FLOOR = 1.0
+
+class PoolMetrics:
+    """Connection pool counters collected through aiohttp trace hooks."""
+
+    def __init__(self):
+        self.connections_created = 0
+        self.connections_reused = 0
+        self.queued = 0
+        self.queued_total = 0
+
+    def trace_config(self) -> aiohttp.TraceConfig:
+        """Build a trace config that feeds these counters."""
+        trace = aiohttp.TraceConfig()
+        trace.on_connection_create_end.append(self._on_connection_create)
+        trace.on_connection_reuseconn.append(self._on_connection_reuse)
+        trace.on_connection_queued_start.append(self._on_queued_start)
+        trace.on_connection_queued_end.append(self._on_queued_end)
+        return trace
+
+    async def _on_connection_create(self, session, ctx, params):
+        self.connections_created += 1
+
+    async def _on_connection_reuse(self, session, ctx, params):
+        self.connections_reused += 1
+
+    async def _on_queued_start(self, session, ctx, params):
+        self.queued += 1
+        self.queued_total += 1
+
+    async def _on_queued_end(self, session, ctx, params):
+        self.queued -= 1
+
+class Backend:
+    """An upstream that completes prompts, with the health state the router keeps."""
+
+    def __init__(self, name: str, weight: float = 1.0):
+        self.name = name
+        self.weight = weight
+        # Requests sent and not yet answered
+        self.outstanding = 0
+        # Smoothed latency in seconds, with failures counted as slow requests
+        self.latency: Optional[float] = None
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.ejected_until = 0.0
+
+    @property
+    def is_active(self) -> bool:
+        """Whether the backend is ready to take requests."""
+        return True
+
+    def is_ejected(self, now: float) -> bool:
+        return self.ejected_until > now
+
+    async def initialize(self):
+        """Open connections or other resources."""
+
+    async def close(self):
+        """Release resources."""
+
+    async def complete(self, payload: Dict[str, Any], on_chunk: Optional[ChunkCallback],
+                       stream: bool) -> CursorMessage:
+        """Make a single completion request, raising CursorAPIError on failure."""
+        raise NotImplementedError
+
+    def get_pool_stats(self) -> Optional[Dict[str, Any]]:
+        """Get connection pool utilization, for backends that have a pool."""
+        return None
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get routing statistics for this backend."""
+        return {
+            "name": self.name,
+            "weight": self.weight,
+            "outstanding": self.outstanding,
+            "latency_ms": round(self.latency * 1000, 1) if self.latency is not None else None,
+            "requests": self.requests,
+            "failures": self.failures,
+            "ejected": self.is_ejected(time.monotonic()),
+        }
+
+class HTTPBackend(Backend):
+    """OpenAI-compatible chat completions endpoint."""
+
+    def __init__(self, name: str, url: str, api_key: Optional[str] = None,
+                 model: Optional[str] = None, weight: float = 1.0):
+        super().__init__(name, weight)
+        self.api_url = url.rstrip("/")
+        self.api_key = api_key
+        # Overrides the model named in requests when set
+        self.model = model
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.pool_metrics = PoolMetrics()
+        self.batcher: Optional[RequestBatcher] = None
+        if settings.cursor_batch_enabled:
+            self.batcher = RequestBatcher(
+                self._post_batch,
+                max_batch_size=settings.cursor_batch_max_size,
+                max_wait=settings.cursor_batch_max_wait_ms / 1000
+            )
+
+    @property
+    def is_active(self) -> bool:
+        return self.session is not None and not self.session.closed
+
+    async def initialize(self):
+        """Open the connection pool."""
+        if self.is_active:
+            return
+
+        # Reuse connections across requests and bound how long any stage may hang
+        connector = aiohttp.TCPConnector(
+            limit=settings.cursor_pool_limit,
+            limit_per_host=settings.cursor_pool_limit_per_host,
+            keepalive_timeout=settings.cursor_keepalive_timeout,
+            ttl_dns_cache=settings.cursor_dns_cache_ttl
+        )
+        timeout = aiohttp.ClientTimeout(
+            total=settings.cursor_total_timeout,
+            connect=settings.cursor_connect_timeout,
+            sock_read=settings.cursor_read_timeout
+        )
+        self.session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=timeout,
+            trace_configs=[self.pool_metrics.trace_config()],
+            json_serialize=json_dumps_str,
+            headers={
+                "Authorization": f"Bearer {self.api_key}" if self.api_key else "",
+                "Content-Type": "application/json"
+            }
+        )
+
+    async def close(self):
+        """Close the connection pool."""
+        if self.session:
+            await self.session.close()
+            self.session = None
+
+    async def complete(self, payload: Dict[str, Any], on_chunk: Optional[ChunkCallback],
+                       stream: bool) -> CursorMessage:
+        """Make a single completion request, raising CursorAPIError on failure."""
+        if not self.is_active:
+            await self.initialize()
+
+        payload = dict(payload, stream=stream)
+        if self.model:
+            payload["model"] = self.model
+
+        # Non-streaming requests can share a round trip with others
+        if self.batcher and self.batcher.supported and not stream:
+            try:
+                data = await self.batcher.submit(payload)
+            except BatchingUnsupportedError:
+                pass
+            else:
+                cursor_msg = self._parse_completion(data)
+                if on_chunk and cursor_msg.content:
+                    await on_chunk(cursor_msg.content)
+                return cursor_msg
+
+        try:
+            async with self.session.post(
+                f"{self.api_url}/v1/chat/completions",
+                json=payload
+            ) as response:
+                if response.status == 200:
+                    if stream and response.content_type == "text/event-stream":
+                        return await self._read_stream(response, on_chunk)
+
+                    cursor_msg = self._parse_completion(await response.json(loads=json_loads))
+                    if on_chunk and cursor_msg.content:
+                        await on_chunk(cursor_msg.content)
+                    return cursor_msg
+
+                error_text = await response.text()
+                logger.error("Cursor API error {} from {}: {}", response.status, self.name, error_text)
+                raise CursorAPIError(
+                    f"Cursor API error: {response.status}",
+                    status=response.status,
+                    retry_after=parse_retry_after(response.headers.get("Retry-After"))
+                )
+
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise CursorAPIError(f"Cursor API request failed: {str(e) or type(e).__name__}") from e
+
+    async def _post_batch(self, payloads: List[Dict[str, Any]]) -> List[Any]:
+        """Send several completion requests in one round trip.
+
+        Returns a completion body or a CursorAPIError per request, in order.
+        """
+        if not self.is_active:
+            await self.initialize()
+
+        try:
+            async with self.session.post(
+                f"{self.api_url}/v1/chat/completions/batch",
+                json={"requests": payloads}
+            ) as response:
+                if response.status in BATCH_UNSUPPORTED_STATUSES:
+                    raise BatchingUnsupportedError(f"batch endpoint returned {response.status}")
+                if response.status != 200:
+                    error_text = await response.text()
+                    logger.error("Cursor API batch error {} from {}: {}", response.status, self.name, error_text)
+                    raise CursorAPIError(
+                        f"Cursor API error: {response.status}",
+                        status=response.status,
+                        retry_after=parse_retry_after(response.headers.get("Retry-After"))
+                    )
+                data = await response.json(loads=json_loads)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise CursorAPIError(f"Cursor API request failed: {str(e) or type(e).__name__}") from e
+
+        results: List[Any] = []
+        for item in data.get("responses", []):
+            error = item.get("error")
+            if error:
+                results.append(CursorAPIError(
+                    f"Cursor API error: {error.get('message', 'batched request failed')}",
+                    status=error.get("status")
+                ))
+            else:
+                results.append(item)
+        if len(results) != len(payloads):
+            raise CursorAPIError(f"Cursor API batch returned {len(results)} responses for {len(payloads)} requests")
+        return results
+
+    def _parse_completion(self, data: Dict[str, Any]) -> CursorMessage:
+        """Create a Cursor message from a completion response body."""
+        return CursorMessage(
+            message_id=data.get("id", f"cursor_{asyncio.get_event_loop().time()}"),
+            content=data.get("choices", [{}])[0].get("message", {}).get("content", ""),
+            message_type=MessageType.TEXT,
+            timestamp=data.get("created", asyncio.get_event_loop().time()),
+            metadata={
+                "conversation_id": data.get("conversation_id"),
+                "model": data.get("model"),
+                "usage": data.get("usage"),
+                "backend": self.name
+            }
+        )
+
+    async def _read_stream(self, response: aiohttp.ClientResponse, on_chunk: ChunkCallback) -> CursorMessage:
+        """Consume a server-sent event stream of completion chunks."""
+        parts: List[str] = []
+        data: Dict[str, Any] = {}
+
+        async for raw_line in response.content:
+            line = raw_line.strip()
+            if not line.startswith(b"data:"):
+                continue
+            event = line[5:].strip()
+            if event == b"[DONE]":
+                break
+
+            chunk = json_loads(event)
+            # Keep the latest envelope fields; usage usually arrives last
+            for key in ("id", "created", "model", "conversation_id", "usage"):
+                if chunk.get(key) is not None:
+                    data[key] = chunk[key]
+
+            choices = chunk.get("choices") or [{}]
+            delta = choices[0].get("delta", {}).get("content")
+            if delta:
+                parts.append(delta)
+                await on_chunk(delta)
+
+        data["choices"] = [{"message": {"content": "".join(parts)}}]
+        return self._parse_completion(data)
+
+    def get_pool_stats(self) -> Dict[str, Any]:
+        """Get connection pool utilization."""
+        limit = settings.cursor_pool_limit
+        return {
+            "limit": limit,
+            "limit_per_host": settings.cursor_pool_limit_per_host,
+            "in_flight": self.outstanding,
+            "utilization": round(self.outstanding / limit, 3) if limit else None,
+            "queued": self.pool_metrics.queued,
+            "queued_total": self.pool_metrics.queued_total,
+            "connections_created": self.pool_metrics.connections_created,
+            "connections_reused": self.pool_metrics.connections_reused,
+        }
+
+    def get_stats(self) -> Dict[str, Any]:
+        stats = super().get_stats()
+        stats["batching"] = self.batcher.get_stats() if self.batcher else None
+        return stats
+
+class MockBackend(Backend):
+    """Simulated upstream for running without API access.
+
+    Latency, generation speed, injected failures and upstream queuing follow
+    a simulation profile, so slowdowns can be reproduced offline.
+    """
+
+    def __init__(self, name: str = "mock", weight: float = 1.0, profile: Optional[str] = None, **overrides):
+        super().__init__(name, weight)
+        self.profile_name = profile or settings.cursor_mock_profile
+        self.profile = SimulationProfile.named(self.profile_name, **overrides)
+        self._first_token_delay = parse_latency(self.profile.latency)
+        self._slots = asyncio.Semaphore(self.profile.max_concurrency) if self.profile.max_concurrency else None
+        self.queued = 0
+        self.injected = {"error": 0, "rate_limit": 0, "timeout": 0}
+
+    async def complete(self, payload: Dict[str, Any], on_chunk: Optional[ChunkCallback],
+                       stream: bool) -> CursorMessage:
+        """Mock a single completion request."""
+        profile = self.profile
+        message = payload["message"]
+
+        # Draw the outcome up front; rate limits are answered before any queuing
+        roll = random.random()
+        if roll < profile.rate_limit_rate:
+            self.injected["rate_limit"] += 1
+            raise CursorAPIError("Cursor API error: 429", status=429, retry_after=profile.retry_after)
+        roll -= profile.rate_limit_rate
+
+        if self._slots:
+            self.queued += 1
+            try:
+                await self._slots.acquire()
+            finally:
+                self.queued -= 1
+        try:
+            if roll < profile.timeout_rate:
+                self.injected["timeout"] += 1
+                await asyncio.sleep(profile.timeout_after)
+                raise CursorAPIError("Cursor API request failed: TimeoutError")
+            roll -= profile.timeout_rate
+
+            await asyncio.sleep(max(0.0, self._first_token_delay()))
+            if roll < profile.error_rate:
+                self.injected["error"] += 1
+                raise CursorAPIError(f"Cursor API error: {profile.error_status}", status=profile.error_status)
+
+            mock_response = f"I received your message: '{message}'. This is a mock response from Cursor AI. In a real implementation, this would be processed by the actual Cursor API."
+            await self._generate(mock_response, on_chunk if stream else None)
+            if on_chunk and not stream:
+                await on_chunk(mock_response)
+        finally:
+            if self._slots:
+                self._slots.release()
+
+        logger.info("Mock response generated for: {}...", message[:50])
+        return CursorMessage(
+            message_id=f"mock_{int(time.time())}",
+            content=mock_response,
+            message_type=MessageType.TEXT,
+            timestamp=datetime.now(),
+            metadata={
+                "conversation_id": payload.get("conversation_id") or f"mock_conv_{int(time.time())}",
+                "model": "mock-cursor-ai",
+                "usage": {"prompt_tokens": estimate_tokens(message), "completion_tokens": estimate_tokens(mock_response)},
+                "backend": self.name
+            }
+        )
+
+    async def _generate(self, text: str, on_chunk: Optional[ChunkCallback]):
+        """Take as long as generating the text at the profile's token rate, streaming it if asked."""
+        token_rate = self.profile.token_rate
+        if not on_chunk:
+            if token_rate:
+                await asyncio.sleep(estimate_tokens(text) / token_rate)
+            return
+
+        size = max(1, self.profile.chunk_tokens) * CHARS_PER_TOKEN
+        for start in range(0, len(text), size):
+            chunk = text[start:start + size]
+            if token_rate:
+                await asyncio.sleep(estimate_tokens(chunk) / token_rate)
+            await on_chunk(chunk)
+
+    def get_stats(self) -> Dict[str, Any]:
+        stats = super().get_stats()
+        stats["simulation"] = {
+            "profile": self.profile_name,
+            "queued": self.queued,
+            "injected": dict(self.injected),
+        }
+        return stats
+
+class BackendRouter:
+    """Chooses a backend per request and fails over between them.
+
+    Strategies:
+    - weighted: random choice in proportion to weight
+    - least_outstanding: fewest in-flight requests relative to weight
+    - latency: lowest expected wait, i.e. smoothed latency times queue depth,
+      relative to weight; a small share of traffic explores the others so a
+      recovered backend is noticed
+
+    Backends failing eject_after times in a row are skipped for eject_seconds
+    unless no other backend is left. With a hedger, non-streaming requests
+    that run long are duplicated to another backend where there is one.
+    """
+
+    STRATEGIES = ("weighted", "least_outstanding", "latency")
+
+    def __init__(self, backends: List[Backend], strategy: str = "latency", eject_after: int = 3,
+                 eject_seconds: float = 30.0, latency_alpha: float = 0.2, explore_ratio: float = 0.05,
+                 hedger: Optional[Hedger] = None):
+        if not backends:
+            raise ValueError("At least one backend is required")
+        if strategy not in self.STRATEGIES:
+            raise ValueError(f"Unknown routing strategy: {strategy}")
+        self.backends = backends
+        self.strategy = strategy
+        self.eject_after = eject_after
+        self.eject_seconds = eject_seconds
+        self.latency_alpha = latency_alpha
+        self.explore_ratio = explore_ratio
+        self.hedger = hedger
+        self.failovers = 0
+
+    @property
+    def outstanding(self) -> int:
+        return sum(backend.outstanding for backend in self.backends)
+
+    async def initialize(self):
+        await asyncio.gather(*(backend.initialize() for backend in self.backends))
+
+    async def close(self):
+        await asyncio.gather(*(backend.close() for backend in self.backends))
+
+    def choose(self, exclude: Optional[List[Backend]] = None) -> Optional[Backend]:
+        """Pick a backend for the next request, or None if all are excluded."""
+        exclude = exclude or []
+        remaining = [b for b in self.backends if b not in exclude]
+        if not remaining:
+            return None
+        now = time.monotonic()
+        candidates = [b for b in remaining if not b.is_ejected(now)] or remaining
+        if len(candidates) == 1:
+            return candidates[0]
+
+        if self.strategy == "weighted" or (self.strategy == "latency" and random.random() < self.explore_ratio):
+            return random.choices(candidates, weights=[b.weight for b in candidates])[0]
+        if self.strategy == "least_outstanding":
+            return min(candidates, key=lambda b: b.outstanding / b.weight)
+
+        # Backends without a latency sample yet are tried first
+        return min(candidates, key=lambda b: ((b.outstanding + 1) * (b.latency or 0.0)) / b.weight)
+
+    async def send(self, payload: Dict[str, Any], on_chunk: Optional[ChunkCallback] = None,
+                   stream: bool = False) -> CursorMessage:
+        """Complete a request, failing over to other backends on retryable errors.
+
+        No failover happens once output has reached on_chunk. Streaming
+        requests are never hedged, since output can't be taken back; other
+        requests pass the winner's reply to on_chunk once the hedge settles.
+        """
+        if self.hedger is None or stream:
+            return await self._send(payload, on_chunk, stream, [])
+
+        # The hedge avoids the backends the original has used, if it can
+        used: List[Backend] = []
+        cursor_msg = await self.hedger.run(lambda hedged: self._send(payload, None, False, used))
+        if on_chunk and cursor_msg.content:
+            await on_chunk(cursor_msg.content)
+        return cursor_msg
+
+    async def _send(self, payload: Dict[str, Any], on_chunk: Optional[ChunkCallback], stream: bool,
+                    used: List[Backend]) -> CursorMessage:
+        tried: List[Backend] = []
+        streamed = False
+
+        async def forward_chunk(chunk: str):
+            nonlocal streamed
+            streamed = True
+            await on_chunk(chunk)
+
+        while True:
+            backend = self.choose(exclude=tried + used) or self.choose(exclude=tried)
+            tried.append(backend)
+            used.append(backend)
+            backend.outstanding += 1
+            backend.requests += 1
+            started = time.monotonic()
+            try:
+                cursor_msg = await backend.complete(payload, forward_chunk if on_chunk else None, stream)
+            except CursorAPIError as e:
+                if e.retryable:
+                    self._record_failure(backend, time.monotonic() - started)
+                if not e.retryable or streamed or self.choose(exclude=tried) is None:
+                    raise
+                self.failovers += 1
+                logger.warning("Backend {} failed, failing over: {}", backend.name, e)
+                continue
+            except asyncio.CancelledError:
+                # A request that lost to its hedge was at least this slow
+                self._record_latency(backend, time.monotonic() - started)
+                raise
+            finally:
+                backend.outstanding -= 1
+            self._record_success(backend, time.monotonic() - started)
+            return cursor_msg
+
+    def _record_success(self, backend: Backend, elapsed: float):
+        backend.consecutive_failures = 0
+        self._record_latency(backend, elapsed)
+
+    def _record_latency(self, backend: Backend, elapsed: float):
+        if backend.latency is None:
+            backend.latency = elapsed
+        else:
+            backend.latency += self.latency_alpha * (elapsed - backend.latency)
+
+    def _record_failure(self, backend: Backend, elapsed: float):
+        # A backend that fails fast must not look like the fastest one
+        others = [b.latency for b in self.backends if b is not backend and b.latency is not None]
+        self._record_latency(backend, max(elapsed, 2 * max(others, default=0.0), FAILURE_LATENCY_FLOOR))
+        backend.failures += 1
+        backend.consecutive_failures += 1
+        if backend.consecutive_failures >= self.eject_after:
+            backend.ejected_until = time.monotonic() + self.eject_seconds
+            logger.warning("Backend {} ejected for {:.0f}s after {} failures",
+                           backend.name, self.eject_seconds, backend.consecutive_failures)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get routing statistics."""
+        return {
+            "strategy": self.strategy,
+            "failovers": self.failovers,
+            "hedging": self.hedger.get_stats() if self.hedger else None,
+            "backends": [backend.get_stats() for backend in self.backends],
+        }
+
+BACKEND_TYPES = {
+    "openai": HTTPBackend,
+    "mock": MockBackend,
+}
+
+def create_backends() -> List[Backend]:
+    """Create the backends configured in settings.
+
+    CURSOR_BACKENDS lists backends explicitly; otherwise the Cursor API is used
+    when an API key is set, and the mock backend when it isn't.
+    """
+    if settings.cursor_backends:
+        backends = []
+        for index, config in enumerate(settings.cursor_backends):
+            config = dict(config)
+            backend_type = config.pop("type", "openai")
+            if backend_type not in BACKEND_TYPES:
+                raise ValueError(f"Unknown backend type: {backend_type}")
+            config.setdefault("name", f"{backend_type}-{index}")
+            backends.append(BACKEND_TYPES[backend_type](**config))
+        return backends
+    if settings.cursor_api_key:
+        return [HTTPBackend("cursor", settings.cursor_api_url, settings.cursor_api_key)]
+    return [MockBackend()]
+
+def create_router(backends: Optional[List[Backend]] = None) -> BackendRouter:
+    """Create a router over the given or configured backends."""
+    return BackendRouter(
+        backends or create_backends(),
+        strategy=settings.cursor_backend_strategy,
+        eject_after=settings.cursor_backend_eject_after,
+        eject_seconds=settings.cursor_backend_eject_seconds,
+        hedger=Hedger(
+            percentile=settings.cursor_hedge_percentile,
+            budget_ratio=settings.cursor_hedge_budget,
+            min_delay=settings.cursor_hedge_min_delay_ms / 1000
+        ) if settings.cursor_hedge_enabled else None
+    )
@@ -0,0 +1,589 @@
+"""
+Benchmarks for the Telegram-Cursor relay.
+
+The relay suite drives a TelegramCursorRelay with synthetic Telegram
+messages spread over many chats. Replies go to a stub Telegram Bot API
+served in this process, which timestamps them; Cursor requests go to a stub
+completions server in a child process with configurable latency, errors and
+capacity. Results are written as JSON so runs can be compared across
+releases.
+
+The models suite measures the CPU time and memory of building the messages
+handled per update, with validation and with model_construct, and the cost
+of encoding them for the message log. The codec suite times the json module
+against orjson on the payloads the relay encodes and parses.
+
+Usage:
+    python benchmark.py --messages 5000 --chats 500 --latency lognormal:0.2,0.5 --output results.json
+    python benchmark.py --baseline results.json --tolerance 0.1
+    python benchmark.py --performance-profile --baseline results.json
+    python benchmark.py --suite models --iterations 20000
+    python benchmark.py --suite codec
+"""
+import argparse
+import asyncio
+import gc
+import json
+import math
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import defaultdict, deque
+from datetime import datetime, timezone
+from typing import Any, Callable, Deque, Dict, List, Optional
+from aiohttp import web
+from simulation import parse_latency
+
+STUB_TOKEN = "123456:benchmark"
+
+def percentile(ordered: List[float], fraction: float) -> Optional[float]:
+    """Nearest-rank percentile of an ascending list."""
+    if not ordered:
+        return None
+    index = max(0, math.ceil(fraction * len(ordered)) - 1)
+    return ordered[index]
+
+def summarize_ms(samples: List[float]) -> Dict[str, Optional[float]]:
+    """Summarize durations in seconds as milliseconds."""
+    ordered = sorted(samples)
+
+    def ms(value: Optional[float]) -> Optional[float]:
+        return round(value * 1000, 2) if value is not None else None
+
+    return {
+        "mean": ms(sum(ordered) / len(ordered)) if ordered else None,
+        "p50": ms(percentile(ordered, 0.50)),
+        "p95": ms(percentile(ordered, 0.95)),
+        "p99": ms(percentile(ordered, 0.99)),
+        "max": ms(ordered[-1] if ordered else None),
+    }
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+class CursorStub:
+    """OpenAI-compatible completions endpoint with simulated upstream behaviour."""
+
+    def __init__(self, latency: str, error_rate: float = 0.0, error_status: int = 503,
+                 max_concurrency: int = 0, max_rps: float = 0.0, stream_chunks: int = 4,
+                 reply_chars: int = 200):
+        self.latency = parse_latency(latency)
+        self.error_rate = error_rate
+        self.error_status = error_status
+        # Requests beyond this many at once wait for a slot
+        self.slots = asyncio.Semaphore(max_concurrency) if max_concurrency else None
+        # Requests beyond this rate are rejected with 429
+        self.max_rps = max_rps
+        self.stream_chunks = stream_chunks
+        self.reply_chars = reply_chars
+        self._window_start = time.monotonic()
+        self._window_count = 0
+        self.stats = {"requests": 0, "completed": 0, "errors_injected": 0, "rate_limited": 0, "peak_concurrency": 0}
+        self._active = 0
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self.complete)
+        app.router.add_get("/stats", self.get_stats)
+        return app
+
+    def _over_rate(self) -> bool:
+        now = time.monotonic()
+        if now - self._window_start >= 1.0:
+            self._window_start = now
+            self._window_count = 0
+        self._window_count += 1
+        return self._window_count > self.max_rps
+
+    async def complete(self, request: web.Request) -> web.StreamResponse:
+        self.stats["requests"] += 1
+        payload = await request.json()
+        if self.max_rps and self._over_rate():
+            self.stats["rate_limited"] += 1
+            return web.json_response({"error": "rate limited"}, status=429, headers={"Retry-After": "1"})
+
+        if self.slots:
+            await self.slots.acquire()
+        self._active += 1
+        self.stats["peak_concurrency"] = max(self.stats["peak_concurrency"], self._active)
+        try:
+            delay = max(0.0, self.latency())
+            if random.random() < self.error_rate:
+                await asyncio.sleep(delay)
+                self.stats["errors_injected"] += 1
+                return web.json_response({"error": "injected failure"}, status=self.error_status)
+
+            content = f"Echo: {payload.get('message', '')} ".ljust(self.reply_chars, ".")
+            body = {
+                "id": f"stub-{self.stats['requests']}",
+                "created": int(time.time()),
+                "model": "stub",
+                "usage": {"prompt_tokens": len(payload.get("message", "")) // 4, "completion_tokens": len(content) // 4},
+            }
+            if payload.get("stream"):
+                return await self._stream(request, body, content, delay)
+
+            await asyncio.sleep(delay)
+            self.stats["completed"] += 1
+            return web.json_response(dict(body, choices=[{"message": {"content": content}}]))
+        finally:
+            self._active -= 1
+            if self.slots:
+                self.slots.release()
+
+    async def _stream(self, request: web.Request, body: Dict[str, Any], content: str,
+                      delay: float) -> web.StreamResponse:
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        size = math.ceil(len(content) / self.stream_chunks)
+        for start in range(0, len(content), size):
+            await asyncio.sleep(delay / self.stream_chunks)
+            chunk = dict(body, choices=[{"delta": {"content": content[start:start + size]}}])
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+        await response.write(b"data: [DONE]\n\n")
+        self.stats["completed"] += 1
+        return response
+
+    async def get_stats(self, request: web.Request) -> web.Response:
+        return web.json_response(self.stats)
+
+def run_cursor_stub(port: int, options: Dict[str, Any], ready):
+    """Serve the Cursor stub until the parent terminates this process."""
+    async def serve():
+        runner = web.AppRunner(CursorStub(**options).app(), access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", port, backlog=1024).start()
+        ready.set()
+        await asyncio.Event().wait()
+
+    asyncio.run(serve())
+
+class TelegramStub:
+    """Minimal Bot API that records when each reply arrives.
+
+    A chat's messages are processed in order, so each reply to a chat
+    completes the oldest message still waiting for one.
+    """
+
+    def __init__(self):
+        self.waiting: Dict[int, Deque[float]] = defaultdict(deque)
+        self.latencies: List[float] = []
+        self.error_replies = 0
+        self.edits = 0
+        self._message_ids = 0
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post(f"/bot{STUB_TOKEN}/{{method}}", self.handle)
+        return app
+
+    def expect_reply(self, chat_id: int):
+        self.waiting[chat_id].append(time.monotonic())
+
+    @property
+    def replies(self) -> int:
+        return len(self.latencies)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = dict(await request.post()) if request.content_type != "application/json" else await request.json()
+        if method == "getMe":
+            result: Any = {"id": 1, "is_bot": True, "first_name": "Benchmark", "username": "benchmark_bot"}
+        elif method in ("sendMessage", "editMessageText"):
+            chat_id = int(params["chat_id"])
+            text = params.get("text", "")
+            if method == "sendMessage":
+                self._message_ids += 1
+                message_id = self._message_ids
+                pending = self.waiting.get(chat_id)
+                if pending:
+                    self.latencies.append(time.monotonic() - pending.popleft())
+                    if text.startswith("❌"):
+                        self.error_replies += 1
+            else:
+                message_id = int(params["message_id"])
+                self.edits += 1
+            result = {"message_id": message_id, "date": int(time.time()), "chat": {"id": chat_id, "type": "private"}, "text": text}
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+async def sample_loop_lag(samples: List[float], stop: asyncio.Event, interval: float = 0.05):
+    """Record how late the event loop wakes up from short sleeps."""
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        samples.append(max(0.0, loop.time() - expected))
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def configure(args: argparse.Namespace, data_dir: str, telegram_port: int, cursor_port: int):
+    """Point the relay at the stubs and keep its files out of the working tree."""
+    from config import settings
+
+    settings.telegram_bot_token = STUB_TOKEN
+    settings.telegram_api_url = f"http://127.0.0.1:{telegram_port}"
+    # Webhook mode, so the bot doesn't poll; the stub accepts the registration
+    settings.telegram_mode = "webhook"
+    settings.telegram_webhook_url = "http://127.0.0.1"
+    settings.telegram_webhook_secret = "benchmark"
+    if args.telegram_rate:
+        settings.telegram_global_rate = args.telegram_rate
+    else:
+        settings.telegram_global_rate = settings.telegram_chat_rate = 1e9
+    settings.cursor_backends = [{"name": "stub", "url": f"http://127.0.0.1:{cursor_port}", "api_key": "benchmark"}]
+    settings.cursor_streaming = args.streaming
+    settings.storage_path = os.path.join(data_dir, "relay.db")
+    settings.relay_log_path = os.path.join(data_dir, "relay-messages.log")
+    settings.tracing_exporter = "none"
+    if args.workers:
+        settings.relay_worker_count = args.workers
+
+async def run_benchmark(args: argparse.Namespace) -> Dict[str, Any]:
+    telegram_port, cursor_port = free_port(), free_port()
+    context = multiprocessing.get_context("spawn")
+    ready = context.Event()
+    stub_options = {
+        "latency": args.latency,
+        "error_rate": args.error_rate,
+        "error_status": args.error_status,
+        "max_concurrency": args.upstream_concurrency,
+        "max_rps": args.upstream_rps,
+    }
+    cursor_stub = context.Process(target=run_cursor_stub, args=(cursor_port, stub_options, ready), daemon=True)
+    cursor_stub.start()
+
+    telegram_stub = TelegramStub()
+    runner = web.AppRunner(telegram_stub.app(), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", telegram_port, backlog=1024).start()
+
+    data_dir = tempfile.mkdtemp(prefix="relay-benchmark-")
+    configure(args, data_dir, telegram_port, cursor_port)
+    from models import TelegramMessage, MessageType
+    from relay import TelegramCursorRelay
+    import aiohttp
+
+    relay = None
+    try:
+        if not await asyncio.get_running_loop().run_in_executor(None, ready.wait, 30):
+            raise RuntimeError("Cursor stub did not start")
+
+        relay = TelegramCursorRelay()
+        await relay.initialize()
+        await relay.start()
+
+        lag_samples: List[float] = []
+        stop_sampling = asyncio.Event()
+        sampler = asyncio.create_task(sample_loop_lag(lag_samples, stop_sampling))
+
+        async def deliver(index: int):
+            chat_id = 1000 + index % args.chats
+            telegram_stub.expect_reply(chat_id)
+            await relay._handle_telegram_message(TelegramMessage(
+                message_id=index,
+                chat_id=chat_id,
+                user_id=chat_id,
+                username=f"user{chat_id}",
+                text=f"Benchmark message {index}: " + "x" * args.message_chars,
+                message_type=MessageType.TEXT,
+                timestamp=datetime.now()
+            ))
+
+        started = time.monotonic()
+        deliveries = []
+        for index in range(args.messages):
+            if args.sequential:
+                # One update at a time, as polling and shard workers hand them over
+                await deliver(index)
+                continue
+            deliveries.append(asyncio.create_task(deliver(index)))
+            if args.rate:
+                # Open-loop arrivals at the offered rate
+                delay = started + (index + 1) / args.rate - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            elif index % 100 == 99:
+                await asyncio.sleep(0)
+        await asyncio.gather(*deliveries)
+        ingested = time.monotonic()
+
+        deadline = ingested + args.timeout
+        while telegram_stub.replies < args.messages and time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+        finished = time.monotonic()
+
+        stop_sampling.set()
+        await sampler
+
+        async with aiohttp.ClientSession() as session:
+            async with session.get(f"http://127.0.0.1:{cursor_port}/stats") as response:
+                upstream = await response.json()
+        relay_status = await relay.get_status()
+    finally:
+        if relay:
+            await relay.stop()
+        await runner.cleanup()
+        cursor_stub.terminate()
+        cursor_stub.join()
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+    duration = finished - started
+    replies = telegram_stub.replies
+    return {
+        "messages": args.messages,
+        "replies": replies,
+        "error_replies": telegram_stub.error_replies,
+        "timed_out": args.messages - replies,
+        "duration_seconds": round(duration, 3),
+        "ingest_seconds": round(ingested - started, 3),
+        "ingest_per_second": round(args.messages / (ingested - started), 2) if ingested > started else None,
+        "throughput_per_second": round(replies / duration, 2) if duration else None,
+        "latency_ms": summarize_ms(telegram_stub.latencies),
+        "event_loop_lag_ms": summarize_ms(lag_samples),
+        # ru_maxrss is in kilobytes on Linux and bytes on macOS
+        "peak_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024),
+        "upstream": upstream,
+        "telegram_edits": telegram_stub.edits,
+        "cursor_backends": relay_status["cursor_backends"],
+        "performance": relay_status["performance"],
+    }
+
+def build_messages(iterations: int, construct: bool) -> List[Any]:
+    """Build the Telegram, relay and Cursor messages of that many updates."""
+    from models import TelegramMessage, RelayMessage, CursorMessage, MessageType, MessageDirection
+
+    def make(cls, **fields):
+        return cls.model_construct(**fields) if construct else cls(**fields)
+
+    messages = []
+    for index in range(iterations):
+        now = datetime.now()
+        telegram_msg = make(TelegramMessage, message_id=index, chat_id=1000 + index % 500, user_id=index,
+                            username="user", text="Benchmark message", message_type=MessageType.TEXT, timestamp=now)
+        relay_msg = make(RelayMessage, id=f"relay-{index}", telegram_message=telegram_msg,
+                         direction=MessageDirection.TELEGRAM_TO_CURSOR, status="pending", created_at=now)
+        relay_msg.cursor_message = make(CursorMessage, message_id=f"cursor-{index}", content="Benchmark reply",
+                                        message_type=MessageType.TEXT, timestamp=now,
+                                        metadata={"model": "stub", "backend": "stub"})
+        messages.append(relay_msg)
+    return messages
+
+def measure_construction(iterations: int, construct: bool) -> Dict[str, float]:
+    """CPU time, and retained and peak traced memory, per update."""
+    build_messages(min(iterations, 1000), construct)  # warm up
+    gc.collect()
+    started = time.process_time_ns()
+    build_messages(iterations, construct)
+    cpu_ns = time.process_time_ns() - started
+
+    gc.collect()
+    tracemalloc.start()
+    try:
+        baseline = tracemalloc.get_traced_memory()[0]
+        messages = build_messages(iterations, construct)
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del messages
+    return {
+        "ns_per_message": round(cpu_ns / iterations),
+        "retained_bytes_per_message": round((current - baseline) / iterations),
+        "peak_bytes_per_message": round((peak - baseline) / iterations),
+    }
+
+def measure_serialization(messages: List[Any], encode: Callable[[Any], bytes]) -> Dict[str, float]:
+    """CPU time and output size per message of a message log encoding."""
+    gc.collect()
+    started = time.process_time_ns()
+    size = sum(len(encode(relay_msg)) for relay_msg in messages)
+    return {
+        "ns_per_message": round((time.process_time_ns() - started) / len(messages)),
+        "bytes_per_message": round(size / len(messages)),
+    }
+
+def run_model_benchmark(args: argparse.Namespace) -> Dict[str, Any]:
+    validated = measure_construction(args.iterations, construct=False)
+    constructed = measure_construction(args.iterations, construct=True)
+    messages = build_messages(args.iterations, construct=False)
+    return {
+        "iterations": args.iterations,
+        "construction": {"validated": validated, "model_construct": constructed},
+        "serialization": {
+            "model_dump_json_dumps": measure_serialization(
+                messages, lambda m: json.dumps({"message": m.model_dump(mode="json")}, separators=(",", ":")).encode()),
+            "model_dump_json": measure_serialization(
+                messages, lambda m: b'{"message":' + m.model_dump_json().encode() + b"}"),
+        },
+    }
+
+def sample_payloads() -> Dict[str, Any]:
+    """Representative JSON documents: a request with history, a completion and a status report."""
+    history = [{"role": "user" if turn % 2 else "assistant", "content": f"Turn {turn}: " + "lorem ipsum " * 20}
+               for turn in range(20)]
+    return {
+        "request": {
+            "message": "Explain this stack trace " + "x" * 200,
+            "conversation_id": "telegram_chat_1000_1700000000",
+            "context": {"user_id": 1000, "username": "user", "message_type": "text"},
+            "model": "cursor-ai",
+            "stream": False,
+            "history": history,
+        },
+        "completion": {
+            "id": "chatcmpl-1", "created": 1700000000, "model": "stub",
+            "choices": [{"message": {"role": "assistant", "content": "Reply " * 200}}],
+            "usage": {"prompt_tokens": 900, "completion_tokens": 300},
+        },
+        "status": {
+            "backends": [{"name": f"backend-{i}", "outstanding": i, "latency_ms": 120.5 + i, "requests": 1000 * i,
+                          "failures": i, "ejected": False} for i in range(4)],
+            "dispatcher": {"queued": 12, "busy_workers": 8, "workers": 8, "processed": 123456},
+        },
+    }
+
+def time_per_call(func: Callable[[], Any], iterations: int) -> int:
+    """CPU nanoseconds per call."""
+    func()
+    started = time.process_time_ns()
+    for _ in range(iterations):
+        func()
+    return round((time.process_time_ns() - started) / iterations)
+
+def run_codec_benchmark(args: argparse.Namespace) -> Dict[str, Any]:
+    try:
+        import orjson
+    except ImportError:
+        orjson = None
+
+    iterations = max(1, args.iterations // 4)
+    results: Dict[str, Any] = {"iterations": iterations, "orjson_available": orjson is not None}
+    for name, document in sample_payloads().items():
+        encoded = json.dumps(document, separators=(",", ":")).encode()
+        codecs = {"json": {
+            "dumps_ns": time_per_call(lambda: json.dumps(document, separators=(",", ":")).encode(), iterations),
+            "loads_ns": time_per_call(lambda: json.loads(encoded), iterations),
+        }}
+        if orjson:
+            codecs["orjson"] = {
+                "dumps_ns": time_per_call(lambda: orjson.dumps(document), iterations),
+                "loads_ns": time_per_call(lambda: orjson.loads(encoded), iterations),
+            }
+        codecs["bytes"] = len(encoded)
+        results[name] = codecs
+    return results
+
+# Result fields checked against a baseline, and whether higher is better
+REGRESSION_CHECKS = [
+    (("throughput_per_second",), True),
+    (("latency_ms", "p50"), False),
+    (("latency_ms", "p95"), False),
+    (("latency_ms", "p99"), False),
+    (("event_loop_lag_ms", "p99"), False),
+    (("peak_rss_bytes",), False),
+    (("construction", "validated", "ns_per_message"), False),
+    (("construction", "validated", "retained_bytes_per_message"), False),
+    (("serialization", "model_dump_json", "ns_per_message"), False),
+]
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> List[str]:
+    """List metrics that are worse than the baseline by more than the tolerance."""
+    regressions = []
+    for path, higher_is_better in REGRESSION_CHECKS:
+        current, previous = results["results"], baseline["results"]
+        for key in path:
+            current, previous = (current or {}).get(key), (previous or {}).get(key)
+        if not current or not previous:
+            continue
+        change = (current - previous) / previous
+        if (-change if higher_is_better else change) > tolerance:
+            regressions.append(f"{'.'.join(path)}: {previous} -> {current} ({change:+.1%})")
+    return regressions
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Load test the relay against local stubs, or time model construction")
+    parser.add_argument("--suite", choices=("relay", "models", "codec"), default="relay", help="what to benchmark")
+    parser.add_argument("--iterations", type=int, default=20000, help="updates built by the models suite")
+    parser.add_argument("--performance-profile", action="store_true", help="run the relay with orjson and uvloop, where installed")
+    parser.add_argument("--messages", type=int, default=2000, help="synthetic messages to send")
+    parser.add_argument("--chats", type=int, default=200, help="distinct chats the messages are spread over")
+    parser.add_argument("--rate", type=float, default=0.0, help="offered messages per second; 0 sends as fast as ingest allows")
+    parser.add_argument("--sequential", action="store_true",
+                        help="ingest one update at a time, as polling and shard workers do, instead of concurrently")
+    parser.add_argument("--message-chars", type=int, default=100, help="padding added to each message")
+    parser.add_argument("--workers", type=int, default=0, help="relay workers; 0 keeps RELAY_WORKER_COUNT")
+    parser.add_argument("--streaming", action="store_true", help="stream replies; latency is then to the first visible reply")
+    parser.add_argument("--telegram-rate", type=float, default=0.0,
+                        help="global Telegram send rate; 0 disables send pacing so the relay is measured")
+    parser.add_argument("--latency", default="lognormal:0.1,0.5",
+                        help="upstream latency, e.g. constant:S, lognormal:MEDIAN,SIGMA or histogram:@FILE (see simulation.parse_latency)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of upstream requests that fail")
+    parser.add_argument("--error-status", type=int, default=503, help="status of injected upstream failures")
+    parser.add_argument("--upstream-concurrency", type=int, default=0, help="requests the upstream serves at once; 0 is unlimited")
+    parser.add_argument("--upstream-rps", type=float, default=0.0, help="upstream requests per second before 429s; 0 is unlimited")
+    parser.add_argument("--timeout", type=float, default=120.0, help="seconds to wait for replies after ingest")
+    parser.add_argument("--log-level", default="CRITICAL", help="relay log level during the run; logs share stdout with the results")
+    parser.add_argument("--output", help="write results JSON here instead of stdout")
+    parser.add_argument("--baseline", help="results JSON of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed relative regression against the baseline")
+    return parser.parse_args(argv)
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    # Must be set before the relay modules configure logging on import
+    os.environ["LOG_LEVEL"] = args.log_level
+    if args.performance_profile:
+        os.environ["PERFORMANCE_PROFILE"] = "true"
+    random.seed(0)
+
+    if args.suite == "models":
+        suite_results = run_model_benchmark(args)
+    elif args.suite == "codec":
+        suite_results = run_codec_benchmark(args)
+    else:
+        from performance import install_event_loop
+        install_event_loop()
+        suite_results = asyncio.run(run_benchmark(args))
+    results = {
+        "benchmark": args.suite,
+        "schema_version": 1,
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "git_revision": git_revision(),
+        "python": platform.python_version(),
+        "config": vars(args),
+        "results": suite_results,
+    }
+    output = json.dumps(results, indent=2, default=str)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,173 @@
+"""
+Adaptive concurrency limit for upstream calls.
+
+The limit on outstanding requests is discovered from observed latency rather
+than configured. With the gradient algorithm, the limit follows the ratio of
+no-load latency (the lowest seen lately) to recent latency: while requests
+are about as fast as that it grows, and once they start queuing upstream it
+shrinks. With AIMD it grows by about one per limit's worth of successes and
+is cut by a fixed ratio on overload errors or slow responses. Callers beyond
+the limit wait in a short bounded queue; past that they are shed at once, so
+an upstream slowdown can't turn into an unbounded pile of waiting coroutines.
+"""
+import asyncio
+import math
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Deque, Dict, Optional
+from resilience import CursorAPIError
+from logger import get_logger
+
+logger = get_logger("concurrency_limit")
+
+class ConcurrencyLimitError(Exception):
+    """Raised when a call is shed because the upstream is at its concurrency limit."""
+
+class AdaptiveLimiter:
+    """Bounds outstanding calls by a limit adjusted from their latency."""
+
+    ALGORITHMS = ("gradient", "aimd")
+
+    def __init__(self, algorithm: str = "gradient", initial_limit: int = 20, min_limit: int = 2,
+                 max_limit: int = 200, max_queue: int = 100, queue_timeout: float = 2.0,
+                 backoff_ratio: float = 0.9, slow_threshold: float = 30.0, smoothing: float = 0.2,
+                 rtt_tolerance: float = 2.0):
+        if algorithm not in self.ALGORITHMS:
+            raise ValueError(f"Unknown concurrency limit algorithm: {algorithm}")
+        self.algorithm = algorithm
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        # AIMD: factor applied on overload, and latency counted as overload
+        self.backoff_ratio = backoff_ratio
+        self.slow_threshold = slow_threshold
+        # Gradient: how far each sample moves the limit toward its new estimate, and how
+        # much slower than no-load latency counts as normal, since reply lengths vary
+        self.smoothing = smoothing
+        self.rtt_tolerance = rtt_tolerance
+        self.in_flight = 0
+        self._waiters: Deque[asyncio.Future] = deque()
+        # Gradient: smoothed recent latency, and the no-load latency it is compared with
+        self._short_rtt: Optional[float] = None
+        self._base_rtt: Optional[float] = None
+        self.shed = 0
+        self.queued_total = 0
+        self.overloads = 0
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncIterator[None]:
+        """Hold a slot for one call, feeding its latency and outcome back into the limit."""
+        await self.acquire()
+        started = time.monotonic()
+        try:
+            yield
+        except CursorAPIError as e:
+            # Rate limits, server errors and timeouts mean the upstream is overloaded
+            self.release(time.monotonic() - started, overloaded=e.retryable)
+            raise
+        except BaseException:
+            self.release()
+            raise
+        else:
+            self.release(time.monotonic() - started)
+
+    async def acquire(self):
+        """Take a slot, waiting in the queue if needed; raise ConcurrencyLimitError if shed."""
+        if self.in_flight < int(self.limit) and not self._waiters:
+            self.in_flight += 1
+            return
+        if len(self._waiters) >= self.max_queue:
+            self._shed("queue is full")
+
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append(future)
+        self.queued_total += 1
+        try:
+            await asyncio.wait_for(future, self.queue_timeout)
+        except asyncio.TimeoutError:
+            self._shed(f"no slot within {self.queue_timeout:.1f}s")
+        except asyncio.CancelledError:
+            # A slot may have been handed over just as the wait was cancelled
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+        finally:
+            if future in self._waiters:
+                self._waiters.remove(future)
+
+    def _shed(self, reason: str):
+        self.shed += 1
+        raise ConcurrencyLimitError(f"Cursor API concurrency limit of {int(self.limit)} reached: {reason}")
+
+    def release(self, rtt: Optional[float] = None, overloaded: bool = False):
+        """Free a slot; rtt is the call's latency when it produced a usable sample."""
+        in_flight = self.in_flight
+        self.in_flight -= 1
+        if overloaded:
+            self.overloads += 1
+            self._decrease()
+        elif rtt is not None:
+            if self.algorithm == "gradient":
+                self._update_gradient(rtt, in_flight)
+            elif rtt > self.slow_threshold:
+                self.overloads += 1
+                self._decrease()
+            elif in_flight * 2 >= self.limit:
+                # Only grow while the limit is actually being used
+                self._set_limit(self.limit + 1 / self.limit)
+        self._wake()
+
+    def _decrease(self):
+        self._set_limit(self.limit * self.backoff_ratio)
+
+    def _update_gradient(self, rtt: float, in_flight: int):
+        if self._short_rtt is None:
+            self._short_rtt = self._base_rtt = rtt
+            return
+        self._short_rtt += 0.1 * (rtt - self._short_rtt)
+        if rtt < self._base_rtt:
+            self._base_rtt = rtt
+        else:
+            # Drift up slowly so a lasting change in the upstream's speed is accepted
+            self._base_rtt += 0.001 * (rtt - self._base_rtt)
+        if in_flight * 2 < self.limit:
+            return
+
+        gradient = max(0.5, min(1.0, self.rtt_tolerance * self._base_rtt / self._short_rtt))
+        # The square root term lets the limit probe upward while latency holds
+        estimate = self.limit * gradient + math.sqrt(self.limit)
+        self._set_limit(self.limit * (1 - self.smoothing) + estimate * self.smoothing)
+
+    def _set_limit(self, limit: float):
+        previous = int(self.limit)
+        self.limit = max(float(self.min_limit), min(float(self.max_limit), limit))
+        if int(self.limit) != previous:
+            logger.debug("Cursor API concurrency limit {} -> {}", previous, int(self.limit))
+
+    def _wake(self):
+        """Hand free slots to queued callers, oldest first."""
+        while self._waiters and self.in_flight < int(self.limit):
+            future = self._waiters.popleft()
+            if not future.done():
+                self.in_flight += 1
+                future.set_result(None)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get limiter statistics."""
+        return {
+            "algorithm": self.algorithm,
+            "limit": int(self.limit),
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "queued_total": self.queued_total,
+            "shed": self.shed,
+            "overloads": self.overloads,
+            "latency_ms": round(self._short_rtt * 1000, 1) if self._short_rtt is not None else None,
+        }
@@ -2,7 +2,7 @@
 Configuration management for the Telegram-Cursor API relay.
 """
 import os
-from typing import Optional
+from typing import Any, Dict, List, Optional
 from pydantic_settings import BaseSettings
 from pydantic import Field
 from dotenv import load_dotenv
@@ -17,10 +17,71 @@ class Settings(BaseSettings):
     telegram_bot_token: str = Field("", env="TELEGRAM_BOT_TOKEN")
     telegram_api_id: Optional[str] = Field(None, env="TELEGRAM_API_ID")
     telegram_api_hash: Optional[str] = Field(None, env="TELEGRAM_API_HASH")
+    telegram_api_url: str = Field("https://api.telegram.org", env="TELEGRAM_API_URL")
+    
+    telegram_mode: str = Field("polling", env="TELEGRAM_MODE")  # polling, webhook
+    telegram_webhook_url: Optional[str] = Field(None, env="TELEGRAM_WEBHOOK_URL")
+    telegram_webhook_path: str = Field("/telegram/webhook", env="TELEGRAM_WEBHOOK_PATH")
+    telegram_webhook_secret: Optional[str] = Field(None, env="TELEGRAM_WEBHOOK_SECRET")
+    telegram_webhook_max_connections: int = Field(40, env="TELEGRAM_WEBHOOK_MAX_CONNECTIONS")
+    telegram_edit_interval: float = Field(1.0, env="TELEGRAM_EDIT_INTERVAL")
+    telegram_global_rate: float = Field(30.0, env="TELEGRAM_GLOBAL_RATE")
+    telegram_chat_rate: float = Field(1.0, env="TELEGRAM_CHAT_RATE")
+    telegram_group_rate_per_minute: float = Field(20.0, env="TELEGRAM_GROUP_RATE_PER_MINUTE")
+    telegram_max_send_retries: int = Field(3, env="TELEGRAM_MAX_SEND_RETRIES")
+    
+    # orjson for JSON and uvloop for the event loop, where installed
+    performance_profile: bool = Field(False, env="PERFORMANCE_PROFILE")
     
     # Cursor API Configuration
     cursor_api_url: str = Field("https://api.cursor.sh", env="CURSOR_API_URL")
     cursor_api_key: Optional[str] = Field(None, env="CURSOR_API_KEY")
+    cursor_pool_limit: int = Field(100, env="CURSOR_POOL_LIMIT")
+    cursor_pool_limit_per_host: int = Field(50, env="CURSOR_POOL_LIMIT_PER_HOST")
+    cursor_keepalive_timeout: float = Field(30.0, env="CURSOR_KEEPALIVE_TIMEOUT")
+    cursor_dns_cache_ttl: int = Field(300, env="CURSOR_DNS_CACHE_TTL")
+    cursor_connect_timeout: float = Field(5.0, env="CURSOR_CONNECT_TIMEOUT")
+    cursor_read_timeout: float = Field(60.0, env="CURSOR_READ_TIMEOUT")
+    cursor_total_timeout: float = Field(120.0, env="CURSOR_TOTAL_TIMEOUT")
+    cursor_max_attempts: int = Field(3, env="CURSOR_MAX_ATTEMPTS")
+    cursor_retry_base_delay: float = Field(0.5, env="CURSOR_RETRY_BASE_DELAY")
+    cursor_retry_max_delay: float = Field(10.0, env="CURSOR_RETRY_MAX_DELAY")
+    cursor_retry_budget_ratio: float = Field(0.2, env="CURSOR_RETRY_BUDGET_RATIO")
+    cursor_breaker_threshold: int = Field(5, env="CURSOR_BREAKER_THRESHOLD")
+    cursor_breaker_reset_timeout: float = Field(30.0, env="CURSOR_BREAKER_RESET_TIMEOUT")
+    cursor_streaming: bool = Field(False, env="CURSOR_STREAMING")
+    cursor_cache_enabled: bool = Field(False, env="CURSOR_CACHE_ENABLED")
+    cursor_cache_ttl: float = Field(3600.0, env="CURSOR_CACHE_TTL")
+    cursor_cache_max_entries: int = Field(10000, env="CURSOR_CACHE_MAX_ENTRIES")
+    cursor_cache_max_bytes: int = Field(20 * 1024 * 1024, env="CURSOR_CACHE_MAX_BYTES")
+    cursor_cache_bypass_chats: List[int] = Field([], env="CURSOR_CACHE_BYPASS_CHATS")
+    cursor_coalesce_requests: bool = Field(False, env="CURSOR_COALESCE_REQUESTS")
+    cursor_backends: List[Dict[str, Any]] = Field([], env="CURSOR_BACKENDS")
+    cursor_backend_strategy: str = Field("latency", env="CURSOR_BACKEND_STRATEGY")  # weighted, least_outstanding, latency
+    cursor_backend_eject_after: int = Field(3, env="CURSOR_BACKEND_EJECT_AFTER")
+    cursor_backend_eject_seconds: float = Field(30.0, env="CURSOR_BACKEND_EJECT_SECONDS")
+    cursor_limit_algorithm: str = Field("none", env="CURSOR_LIMIT_ALGORITHM")  # none, gradient, aimd
+    cursor_limit_initial: int = Field(20, env="CURSOR_LIMIT_INITIAL")
+    cursor_limit_min: int = Field(2, env="CURSOR_LIMIT_MIN")
+    cursor_limit_max: int = Field(200, env="CURSOR_LIMIT_MAX")
+    cursor_limit_queue_size: int = Field(100, env="CURSOR_LIMIT_QUEUE_SIZE")
+    cursor_limit_queue_timeout: float = Field(2.0, env="CURSOR_LIMIT_QUEUE_TIMEOUT")
+    cursor_limit_slow_threshold: float = Field(10.0, env="CURSOR_LIMIT_SLOW_THRESHOLD")
+    cursor_hedge_enabled: bool = Field(False, env="CURSOR_HEDGE_ENABLED")
+    cursor_hedge_percentile: float = Field(0.95, env="CURSOR_HEDGE_PERCENTILE")
+    cursor_hedge_budget: float = Field(0.05, env="CURSOR_HEDGE_BUDGET")
+    cursor_hedge_min_delay_ms: float = Field(50.0, env="CURSOR_HEDGE_MIN_DELAY_MS")
+    cursor_mock_profile: str = Field("default", env="CURSOR_MOCK_PROFILE")  # default, instant, production, degraded
+    cursor_batch_enabled: bool = Field(False, env="CURSOR_BATCH_ENABLED")
+    cursor_batch_max_size: int = Field(16, env="CURSOR_BATCH_MAX_SIZE")
+    cursor_batch_max_wait_ms: float = Field(10.0, env="CURSOR_BATCH_MAX_WAIT_MS")
+    cursor_history_max_messages: int = Field(50, env="CURSOR_HISTORY_MAX_MESSAGES")
+    cursor_history_max_bytes: int = Field(50 * 1024 * 1024, env="CURSOR_HISTORY_MAX_BYTES")
+    cursor_history_ttl: float = Field(24 * 3600, env="CURSOR_HISTORY_TTL")
+    # Send prior turns with each request, trimmed to a token budget
+    cursor_context_enabled: bool = Field(False, env="CURSOR_CONTEXT_ENABLED")
+    cursor_context_max_tokens: int = Field(2000, env="CURSOR_CONTEXT_MAX_TOKENS")
+    cursor_context_summary_tokens: int = Field(200, env="CURSOR_CONTEXT_SUMMARY_TOKENS")
     
     # MCP Configuration
     mcp_server_url: str = Field("http://localhost:8000", env="MCP_SERVER_URL")
@@ -29,8 +90,41 @@ class Settings(BaseSettings):
     # Application Configuration
     debug: bool = Field(False, env="DEBUG")
     log_level: str = Field("INFO", env="LOG_LEVEL")
+    log_async: bool = Field(True, env="LOG_ASYNC")
+    log_format: str = Field("text", env="LOG_FORMAT")  # text, json
+    log_module_levels: Dict[str, str] = Field({}, env="LOG_MODULE_LEVELS")
+    log_file_path: str = Field("logs/relay.log", env="LOG_FILE_PATH")
+    log_error_path: str = Field("logs/errors.log", env="LOG_ERROR_PATH")
     port: int = Field(8000, env="PORT")
     
+    # Storage Configuration
+    storage_backend: str = Field("sqlite", env="STORAGE_BACKEND")  # sqlite, none
+    storage_path: str = Field("data/relay.db", env="STORAGE_PATH")
+    storage_flush_interval: float = Field(0.5, env="STORAGE_FLUSH_INTERVAL")
+    storage_batch_size: int = Field(500, env="STORAGE_BATCH_SIZE")
+    
+    # Dispatch Configuration
+    relay_worker_count: int = Field(8, env="RELAY_WORKER_COUNT")
+    relay_queue_size: int = Field(1000, env="RELAY_QUEUE_SIZE")
+    relay_retained_messages: int = Field(1000, env="RELAY_RETAINED_MESSAGES")
+    relay_retained_bytes: int = Field(5 * 1024 * 1024, env="RELAY_RETAINED_BYTES")
+    relay_log_enabled: bool = Field(True, env="RELAY_LOG_ENABLED")
+    relay_log_path: str = Field("data/relay-messages.log", env="RELAY_LOG_PATH")
+    relay_log_commit_interval: float = Field(0.01, env="RELAY_LOG_COMMIT_INTERVAL")
+    relay_log_compact_after: int = Field(10000, env="RELAY_LOG_COMPACT_AFTER")
+    
+    # Sharding Configuration (0 runs a single in-process relay; webhook mode only)
+    relay_shards: int = Field(0, env="RELAY_SHARDS")
+    relay_shard_socket_dir: str = Field("data/shards", env="RELAY_SHARD_SOCKET_DIR")
+    relay_shard_max_pending: int = Field(10000, env="RELAY_SHARD_MAX_PENDING")
+    
+    # Tracing Configuration
+    tracing_sample_rate: float = Field(0.01, env="TRACING_SAMPLE_RATE")
+    tracing_exporter: str = Field("jsonl", env="TRACING_EXPORTER")  # jsonl, otlp, none
+    tracing_jsonl_path: str = Field("logs/traces.jsonl", env="TRACING_JSONL_PATH")
+    tracing_otlp_endpoint: str = Field("http://localhost:4318/v1/traces", env="TRACING_OTLP_ENDPOINT")
+    tracing_flush_interval: float = Field(5.0, env="TRACING_FLUSH_INTERVAL")
+    
     class Config:
         env_file = ".env"
         case_sensitive = False
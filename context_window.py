@@ -0,0 +1,99 @@
+"""
+Token-budgeted assembly of conversation history for Cursor requests.
+
+Prior turns are added newest first until the budget is spent; older turns
+are dropped, optionally leaving a short extractive summary of what was
+dropped. Tokens are estimated from character counts, which is close enough
+for budgeting and costs nothing on the hot path.
+"""
+from typing import Any, Dict, List, Sequence
+from models import CursorMessage
+
+# Average characters per token for English text and code
+CHARS_PER_TOKEN = 4
+# Per-turn cost of role markers and separators
+TURN_OVERHEAD_TOKENS = 4
+# Longest excerpt of a single dropped turn kept in the summary
+SUMMARY_EXCERPT_CHARS = 160
+
+def estimate_tokens(text: str) -> int:
+    """Approximate the number of tokens in a text."""
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+def turn_role(message: CursorMessage) -> str:
+    """Role of a stored turn; Cursor responses carry no role marker."""
+    return (message.metadata or {}).get("role", "assistant")
+
+class ContextWindow:
+    """Builds the history sent with a request under a token budget."""
+
+    def __init__(self, max_tokens: int = 2000, summary_tokens: int = 200):
+        self.max_tokens = max_tokens
+        self.summary_tokens = summary_tokens
+        self.requests = 0
+        self.turns_included = 0
+        self.turns_dropped = 0
+        self.summaries = 0
+
+    def build(self, history: Sequence[CursorMessage], message: str) -> List[Dict[str, str]]:
+        """Select prior turns, oldest first, that fit alongside the new message."""
+        self.requests += 1
+        budget = self.max_tokens - estimate_tokens(message) - TURN_OVERHEAD_TOKENS
+        kept = self._fit(history, budget)
+        if len(kept) < len(history) and self.summary_tokens > 0:
+            # Make room for the summary, then summarize whatever no longer fits
+            kept = self._fit(history, budget - self.summary_tokens)
+
+        dropped = history[:len(history) - len(kept)]
+        turns = [{"role": turn_role(turn), "content": turn.content} for turn in kept]
+        if dropped and self.summary_tokens > 0:
+            summary = self._summarize(dropped)
+            if summary:
+                turns.insert(0, {"role": "system", "content": summary})
+                self.summaries += 1
+
+        self.turns_included += len(kept)
+        self.turns_dropped += len(dropped)
+        return turns
+
+    @staticmethod
+    def _fit(history: Sequence[CursorMessage], budget: int) -> List[CursorMessage]:
+        """Take the longest run of most recent turns within the budget."""
+        used = 0
+        start = len(history)
+        for index in range(len(history) - 1, -1, -1):
+            cost = estimate_tokens(history[index].content) + TURN_OVERHEAD_TOKENS
+            if used + cost > budget:
+                break
+            used += cost
+            start = index
+        return list(history[start:])
+
+    def _summarize(self, dropped: Sequence[CursorMessage]) -> str:
+        """Excerpt the first line of dropped turns, most recent first, within the summary budget."""
+        header = "Summary of earlier turns:"
+        budget = self.summary_tokens - estimate_tokens(header)
+        lines: List[str] = []
+        for turn in reversed(dropped):
+            first_line = turn.content.strip().split("\n", 1)[0]
+            if len(first_line) > SUMMARY_EXCERPT_CHARS:
+                first_line = first_line[:SUMMARY_EXCERPT_CHARS] + "..."
+            line = f"- {turn_role(turn)}: {first_line}"
+            cost = estimate_tokens(line) + 1
+            if cost > budget:
+                break
+            budget -= cost
+            lines.append(line)
+        if not lines:
+            return ""
+        return "\n".join([header] + lines[::-1])
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get context assembly statistics."""
+        return {
+            "max_tokens": self.max_tokens,
+            "requests": self.requests,
+            "turns_included": self.turns_included,
+            "turns_dropped": self.turns_dropped,
+            "summaries": self.summaries,
+        }
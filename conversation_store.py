@@ -0,0 +1,136 @@
+"""
+Bounded conversation history store for the Cursor client.
+
+Histories are capped per conversation, evicted least-recently-used once the
+total approximate size exceeds a byte budget, and expired after sitting idle
+for longer than a TTL.
+"""
+import time
+from collections import OrderedDict, deque
+from typing import Any, Deque, Dict, List, Optional
+from models import CursorMessage
+
+# Rough per-message cost of the pydantic object itself, excluding content
+MESSAGE_OVERHEAD_BYTES = 512
+
+class _Conversation:
+    """History and bookkeeping for a single conversation."""
+
+    __slots__ = ("messages", "size", "last_access")
+
+    def __init__(self, max_messages: Optional[int]):
+        self.messages: Deque[CursorMessage] = deque(maxlen=max_messages)
+        self.size = 0
+        self.last_access = 0.0
+
+class ConversationStore:
+    """LRU/TTL-bounded mapping of conversation id to message history."""
+
+    def __init__(self, max_messages_per_conversation: int = 50,
+                 max_total_bytes: int = 50 * 1024 * 1024,
+                 idle_ttl: Optional[float] = 24 * 3600):
+        self.max_messages_per_conversation = max_messages_per_conversation
+        self.max_total_bytes = max_total_bytes
+        self.idle_ttl = idle_ttl
+        self._conversations: "OrderedDict[str, _Conversation]" = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self) -> int:
+        return len(self._conversations)
+
+    def __contains__(self, conversation_id: str) -> bool:
+        conversation = self._conversations.get(conversation_id)
+        if conversation is None:
+            return False
+        return not self.idle_ttl or conversation.last_access > time.monotonic() - self.idle_ttl
+
+    @staticmethod
+    def _message_size(message: CursorMessage) -> int:
+        return MESSAGE_OVERHEAD_BYTES + len(message.content)
+
+    def append(self, conversation_id: str, message: CursorMessage):
+        """Add a message to a conversation's history."""
+        now = time.monotonic()
+        self._expire(now)
+
+        conversation = self._conversations.get(conversation_id)
+        if conversation is None:
+            conversation = _Conversation(self.max_messages_per_conversation)
+            self._conversations[conversation_id] = conversation
+        else:
+            self._conversations.move_to_end(conversation_id)
+
+        # Account for the message the bounded deque is about to drop
+        messages = conversation.messages
+        if messages.maxlen is not None and len(messages) == messages.maxlen:
+            dropped = self._message_size(messages[0])
+            conversation.size -= dropped
+            self.total_bytes -= dropped
+
+        size = self._message_size(message)
+        messages.append(message)
+        conversation.size += size
+        conversation.last_access = now
+        self.total_bytes += size
+
+        self._evict(keep=conversation_id)
+
+    def get(self, conversation_id: str) -> List[CursorMessage]:
+        """Get a conversation's history, oldest first."""
+        now = time.monotonic()
+        self._expire(now)
+
+        conversation = self._conversations.get(conversation_id)
+        if conversation is None:
+            self.misses += 1
+            return []
+
+        self.hits += 1
+        conversation.last_access = now
+        self._conversations.move_to_end(conversation_id)
+        return list(conversation.messages)
+
+    def clear(self, conversation_id: str) -> bool:
+        """Remove a conversation; return whether it existed."""
+        conversation = self._conversations.pop(conversation_id, None)
+        if conversation is None:
+            return False
+        self.total_bytes -= conversation.size
+        return True
+
+    def _expire(self, now: float):
+        """Drop conversations idle for longer than the TTL."""
+        if not self.idle_ttl:
+            return
+        cutoff = now - self.idle_ttl
+        # Entries are kept in access order, so expired ones are at the front
+        while self._conversations:
+            conversation_id, conversation = next(iter(self._conversations.items()))
+            if conversation.last_access > cutoff:
+                break
+            self.clear(conversation_id)
+            self.expirations += 1
+
+    def _evict(self, keep: str):
+        """Evict least recently used conversations until under the byte budget."""
+        while self.total_bytes > self.max_total_bytes and len(self._conversations) > 1:
+            conversation_id = next(iter(self._conversations))
+            if conversation_id == keep:
+                break
+            self.clear(conversation_id)
+            self.evictions += 1
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get store statistics."""
+        return {
+            "conversations": len(self._conversations),
+            "total_bytes": self.total_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
@@ -1,136 +1,249 @@
 """
 Cursor API client for handling AI interactions.
 """
-import asyncio
-import aiohttp
-import json
-from typing import Optional, Dict, Any, List
+from datetime import datetime
+from typing import Optional, Dict, Any, List, Callable, Awaitable
 from models import CursorMessage, MessageType
+from conversation_store import ConversationStore
+from context_window import ContextWindow
+from storage import SessionStorage
+from response_cache import ResponseCache, make_request_key
+from single_flight import SingleFlight
+from concurrency_limit import AdaptiveLimiter
+from backends import Backend, BackendRouter, MockBackend, create_router
+from resilience import RetryPolicy, RetryBudget, CircuitBreaker
 from logger import get_logger
 from config import settings
 
 logger = get_logger("cursor_client")
 
+ChunkCallback = Callable[[str], Awaitable[None]]
+
 class CursorClient:
     """Cursor API client."""
     
-    def __init__(self):
-        self.api_url = settings.cursor_api_url
-        self.api_key = settings.cursor_api_key
-        self.session: Optional[aiohttp.ClientSession] = None
-        self.conversations: Dict[str, List[CursorMessage]] = {}
+    def __init__(self, storage: Optional[SessionStorage] = None, backends: Optional[List[Backend]] = None):
+        self.model = "cursor-ai"
+        # Upstreams to send requests to; configured in settings unless given
+        self.router: BackendRouter = create_router(backends)
+        self.storage = storage or SessionStorage()
+        self.conversations = ConversationStore(
+            max_messages_per_conversation=settings.cursor_history_max_messages,
+            max_total_bytes=settings.cursor_history_max_bytes,
+            idle_ttl=settings.cursor_history_ttl
+        )
+        self.context_window: Optional[ContextWindow] = None
+        if settings.cursor_context_enabled:
+            self.context_window = ContextWindow(
+                max_tokens=settings.cursor_context_max_tokens,
+                summary_tokens=settings.cursor_context_summary_tokens
+            )
+        self.response_cache: Optional[ResponseCache] = None
+        if settings.cursor_cache_enabled:
+            self.response_cache = ResponseCache(
+                ttl=settings.cursor_cache_ttl,
+                max_entries=settings.cursor_cache_max_entries,
+                max_bytes=settings.cursor_cache_max_bytes,
+                bypass_chats=settings.cursor_cache_bypass_chats
+            )
+        self.single_flight: Optional[SingleFlight] = SingleFlight() if settings.cursor_coalesce_requests else None
+        self.limiter: Optional[AdaptiveLimiter] = None
+        if settings.cursor_limit_algorithm != "none":
+            self.limiter = AdaptiveLimiter(
+                algorithm=settings.cursor_limit_algorithm,
+                initial_limit=settings.cursor_limit_initial,
+                min_limit=settings.cursor_limit_min,
+                max_limit=settings.cursor_limit_max,
+                max_queue=settings.cursor_limit_queue_size,
+                queue_timeout=settings.cursor_limit_queue_timeout,
+                slow_threshold=settings.cursor_limit_slow_threshold
+            )
+        self.retry_policy = RetryPolicy(
+            max_attempts=settings.cursor_max_attempts,
+            base_delay=settings.cursor_retry_base_delay,
+            max_delay=settings.cursor_retry_max_delay,
+            budget=RetryBudget(ratio=settings.cursor_retry_budget_ratio),
+            breaker=CircuitBreaker(
+                failure_threshold=settings.cursor_breaker_threshold,
+                reset_timeout=settings.cursor_breaker_reset_timeout
+            )
+        )
+    
+    @property
+    def is_active(self) -> bool:
+        """Whether any backend is ready to take requests."""
+        return any(backend.is_active for backend in self.router.backends)
     
     async def initialize(self):
         """Initialize the Cursor client."""
         try:
-            self.session = aiohttp.ClientSession(
-                headers={
-                    "Authorization": f"Bearer {self.api_key}" if self.api_key else "",
-                    "Content-Type": "application/json"
-                }
-            )
+            await self.router.initialize()
             logger.info("Cursor client initialized successfully")
         except Exception as e:
-            logger.error(f"Failed to initialize Cursor client: {e}")
+            logger.error("Failed to initialize Cursor client: {}", e)
             raise
     
     async def send_message(self, message: str, conversation_id: Optional[str] = None, 
-                          context: Optional[Dict[str, Any]] = None) -> CursorMessage:
-        """Send a message to Cursor API."""
+                          context: Optional[Dict[str, Any]] = None,
+                          on_chunk: Optional[ChunkCallback] = None,
+                          use_cache: bool = True) -> CursorMessage:
+        """Send a message to Cursor API.
+        
+        When on_chunk is given and streaming is enabled, the response is
+        requested as a stream and on_chunk is awaited with each text delta.
+        Retryable failures are retried until output has reached on_chunk.
+        With the response cache enabled, a prompt opening a conversation may be
+        answered with the reply to the same prompt from another chat, and with
+        request coalescing enabled, concurrent identical opening prompts share
+        one upstream call. Prompts in a conversation that already has turns are
+        never shared, and neither applies when use_cache is False.
+        With the context window enabled, prior turns of the conversation are
+        sent along within the token budget.
+        """
+        prior_turns: List[CursorMessage] = []
+        share = use_cache and (self.response_cache is not None or self.single_flight is not None)
+        if conversation_id and (self.context_window or share):
+            prior_turns = await self.get_conversation_history(conversation_id)
+        history = self.context_window.build(prior_turns, message) if self.context_window and prior_turns else None
+        
+        # Only an opening prompt is independent of its conversation and user
+        request_key = make_request_key(message, self.model, context) if share and not prior_turns else None
+        
+        if request_key is not None and self.response_cache:
+            cached = self.response_cache.get(request_key)
+            if cached:
+                cursor_msg = self._rehome(cached, conversation_id, cached=True)
+                if on_chunk:
+                    await on_chunk(cursor_msg.content)
+                if conversation_id:
+                    self._store_exchange(conversation_id, message, cursor_msg)
+                return cursor_msg
+        
         try:
-            if not self.session:
-                await self.initialize()
-            
-            # Prepare the request payload
-            payload = {
-                "message": message,
-                "conversation_id": conversation_id,
-                "context": context or {},
-                "model": "cursor-ai",
-                "stream": False
-            }
-            
-            # Make the API request
-            async with self.session.post(
-                f"{self.api_url}/v1/chat/completions",
-                json=payload
-            ) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    
-                    # Create Cursor message object
-                    cursor_msg = CursorMessage(
-                        message_id=data.get("id", f"cursor_{asyncio.get_event_loop().time()}"),
-                        content=data.get("choices", [{}])[0].get("message", {}).get("content", ""),
-                        message_type=MessageType.TEXT,
-                        timestamp=data.get("created", asyncio.get_event_loop().time()),
-                        metadata={
-                            "conversation_id": data.get("conversation_id"),
-                            "model": data.get("model"),
-                            "usage": data.get("usage")
-                        }
-                    )
-                    
-                    # Store in conversation history
-                    if cursor_msg.metadata.get("conversation_id"):
-                        conv_id = cursor_msg.metadata["conversation_id"]
-                        if conv_id not in self.conversations:
-                            self.conversations[conv_id] = []
-                        self.conversations[conv_id].append(cursor_msg)
-                    
-                    logger.info(f"Message sent to Cursor API: {message[:50]}...")
-                    return cursor_msg
-                    
-                else:
-                    error_text = await response.text()
-                    logger.error(f"Cursor API error {response.status}: {error_text}")
-                    raise Exception(f"Cursor API error: {response.status}")
-                    
+            if request_key is not None and self.single_flight:
+                cursor_msg, shared = await self.single_flight.do(
+                    request_key,
+                    lambda fan_out: self._send_with_retries(message, conversation_id, context, fan_out, history),
+                    on_chunk=on_chunk
+                )
+                if shared:
+                    cursor_msg = self._rehome(cursor_msg, conversation_id, coalesced=True)
+            else:
+                cursor_msg = await self._send_with_retries(message, conversation_id, context, on_chunk, history)
         except Exception as e:
-            logger.error(f"Failed to send message to Cursor API: {e}")
+            logger.error("Failed to send message to Cursor API: {}", e)
             raise
+        
+        if request_key is not None and self.response_cache and not cursor_msg.metadata.get("coalesced"):
+            self.response_cache.put(request_key, cursor_msg)
+        
+        # Store in conversation history
+        if cursor_msg.metadata.get("conversation_id"):
+            self._store_exchange(cursor_msg.metadata["conversation_id"], message, cursor_msg)
+        
+        logger.info("Message sent to Cursor API: {}...", message[:50])
+        return cursor_msg
+    
+    async def _send_with_retries(self, message: str, conversation_id: Optional[str],
+                                 context: Optional[Dict[str, Any]],
+                                 on_chunk: Optional[ChunkCallback],
+                                 history: Optional[List[Dict[str, str]]] = None) -> CursorMessage:
+        """Send through the retry policy, retrying only before output has been streamed."""
+        streamed = False
+        
+        async def forward_chunk(chunk: str):
+            nonlocal streamed
+            streamed = True
+            await on_chunk(chunk)
+        
+        return await self.retry_policy.call(
+            lambda: self._send_once(message, conversation_id, context, forward_chunk if on_chunk else None, history),
+            can_retry=lambda: not streamed
+        )
+    
+    def _rehome(self, cursor_msg: CursorMessage, conversation_id: Optional[str], **flags: bool) -> CursorMessage:
+        """Copy a shared response so it belongs to this request's conversation."""
+        metadata = dict(cursor_msg.metadata or {})
+        metadata["conversation_id"] = conversation_id
+        metadata.update(flags)
+        return cursor_msg.model_copy(update={"metadata": metadata})
+    
+    async def _send_once(self, message: str, conversation_id: Optional[str],
+                         context: Optional[Dict[str, Any]],
+                         on_chunk: Optional[ChunkCallback],
+                         history: Optional[List[Dict[str, str]]] = None) -> CursorMessage:
+        """Make a single completion request through the backend router."""
+        payload = {
+            "message": message,
+            "conversation_id": conversation_id,
+            "context": context or {},
+            "model": self.model
+        }
+        if history:
+            # Prior turns, oldest first, trimmed to the context window
+            payload["history"] = history
+        
+        stream = on_chunk is not None and settings.cursor_streaming
+        if self.limiter:
+            # Sheds with ConcurrencyLimitError, which is not retried
+            async with self.limiter.slot():
+                return await self.router.send(payload, on_chunk, stream)
+        return await self.router.send(payload, on_chunk, stream)
+    
+    def _store_exchange(self, conversation_id: str, message: str, cursor_msg: CursorMessage):
+        """Record a completed request in the conversation history.
+        
+        The user's side is only kept when the context window needs it.
+        """
+        if self.context_window:
+            self._store_message(conversation_id, CursorMessage(
+                message_id=f"user_{cursor_msg.message_id}",
+                content=message,
+                message_type=MessageType.TEXT,
+                timestamp=datetime.now(),
+                metadata={"role": "user", "conversation_id": conversation_id}
+            ))
+        self._store_message(conversation_id, cursor_msg)
+    
+    def _store_message(self, conversation_id: str, cursor_msg: CursorMessage):
+        """Add a message to the in-memory history and persist it."""
+        self.conversations.append(conversation_id, cursor_msg)
+        self.storage.append_message(conversation_id, cursor_msg)
     
     async def get_conversation_history(self, conversation_id: str) -> List[CursorMessage]:
-        """Get conversation history."""
-        return self.conversations.get(conversation_id, [])
+        """Get conversation history, loading it from storage if not in memory."""
+        if conversation_id not in self.conversations:
+            history = await self.storage.load_history(
+                conversation_id, limit=self.conversations.max_messages_per_conversation
+            )
+            for cursor_msg in history:
+                self.conversations.append(conversation_id, cursor_msg)
+        return self.conversations.get(conversation_id)
     
     async def clear_conversation(self, conversation_id: str):
         """Clear conversation history."""
-        if conversation_id in self.conversations:
-            del self.conversations[conversation_id]
-            logger.info(f"Conversation {conversation_id} cleared")
+        self.storage.delete_conversation(conversation_id)
+        if self.conversations.clear(conversation_id):
+            logger.info("Conversation {} cleared", conversation_id)
     
     async def close(self):
-        """Close the client session."""
-        if self.session:
-            await self.session.close()
-            logger.info("Cursor client session closed")
+        """Close backend connections."""
+        await self.router.close()
+        logger.info("Cursor client session closed")
+    
+    def get_pool_stats(self) -> Dict[str, Any]:
+        """Get connection pool utilization per backend."""
+        return {
+            backend.name: backend.get_pool_stats()
+            for backend in self.router.backends
+            if backend.get_pool_stats() is not None
+        }
 
 class MockCursorClient(CursorClient):
-    """Mock Cursor client for testing without API access."""
+    """Mock Cursor client for testing without API access.
     
-    async def send_message(self, message: str, conversation_id: Optional[str] = None, 
-                          context: Optional[Dict[str, Any]] = None) -> CursorMessage:
-        """Mock send message."""
-        import time
-        
-        # Simulate API delay
-        await asyncio.sleep(1)
-        
-        # Generate mock response
-        mock_response = f"I received your message: '{message}'. This is a mock response from Cursor AI. In a real implementation, this would be processed by the actual Cursor API."
-        
-        cursor_msg = CursorMessage(
-            message_id=f"mock_{int(time.time())}",
-            content=mock_response,
-            message_type=MessageType.TEXT,
-            timestamp=time.time(),
-            metadata={
-                "conversation_id": conversation_id or f"mock_conv_{int(time.time())}",
-                "model": "mock-cursor-ai",
-                "usage": {"prompt_tokens": len(message), "completion_tokens": len(mock_response)}
-            }
-        )
-        
-        logger.info(f"Mock response generated for: {message[:50]}...")
-        return cursor_msg
\ No newline at end of file
+    profile names a simulation profile; overrides replace some of its fields.
+    """
+    
+    def __init__(self, storage: Optional[SessionStorage] = None, profile: Optional[str] = None, **overrides):
+        super().__init__(storage=storage, backends=[MockBackend(profile=profile, **overrides)])
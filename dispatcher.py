@@ -0,0 +1,154 @@
+"""
+Bounded dispatch engine for relay messages.
+
+Messages are grouped by a key (the Telegram chat id): messages sharing a key
+are handled strictly in submission order, while different keys are handled
+concurrently by a fixed pool of worker tasks.
+"""
+import asyncio
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Hashable, List, Optional, Tuple
+from logger import get_logger
+from metrics import stage_duration
+
+logger = get_logger("dispatcher")
+
+Handler = Callable[[Any], Awaitable[None]]
+
+class ChatDispatcher:
+    """Worker pool with per-key FIFO ordering and a bounded backlog."""
+
+    def __init__(self, handler: Handler, workers: int = 8, max_queue_size: int = 1000):
+        if workers < 1:
+            raise ValueError("workers must be at least 1")
+        if max_queue_size < 1:
+            raise ValueError("max_queue_size must be at least 1")
+        self.handler = handler
+        self.worker_count = workers
+        self.max_queue_size = max_queue_size
+        # Per key: queued (item, enqueue time) pairs, head is being handled
+        self._chains: Dict[Hashable, Deque[Tuple[Any, float]]] = {}
+        self._ready: Optional[asyncio.Queue] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._idle: Optional[asyncio.Event] = None
+        self._workers: List[asyncio.Task] = []
+        self._outstanding = 0
+        self._busy_workers = 0
+        self.processed = 0
+        self.failed = 0
+
+    @property
+    def is_running(self) -> bool:
+        """Whether the worker pool is running."""
+        return bool(self._workers)
+
+    @property
+    def outstanding(self) -> int:
+        """Number of submitted messages not yet handled."""
+        return self._outstanding
+
+    def start(self):
+        """Start the worker pool."""
+        if self._workers:
+            return
+
+        # Primitives are created here so they bind to the running loop
+        self._ready = asyncio.Queue()
+        self._slots = asyncio.Semaphore(self.max_queue_size)
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._chains.clear()
+        self._outstanding = 0
+
+        self._workers = [
+            asyncio.create_task(self._worker(i), name=f"relay-worker-{i}")
+            for i in range(self.worker_count)
+        ]
+        logger.info("Dispatcher started with {} workers (capacity {})", self.worker_count, self.max_queue_size)
+
+    async def stop(self, drain_timeout: Optional[float] = 10.0):
+        """Stop the worker pool, waiting up to drain_timeout for queued work."""
+        if not self._workers:
+            return
+
+        if drain_timeout and self._outstanding:
+            try:
+                await asyncio.wait_for(self._idle.wait(), timeout=drain_timeout)
+            except asyncio.TimeoutError:
+                logger.warning("Dispatcher stopped with {} messages still queued", self._outstanding)
+
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        logger.info("Dispatcher stopped")
+
+    async def submit(self, key: Hashable, item: Any):
+        """Queue an item, waiting for capacity when the dispatcher is full."""
+        if not self._workers:
+            raise RuntimeError("Dispatcher is not running")
+        await self._slots.acquire()
+        self._enqueue(key, item)
+
+    def _enqueue(self, key: Hashable, item: Any):
+        """Append an item to its chain, scheduling the chain if it is idle."""
+        self._outstanding += 1
+        self._idle.clear()
+
+        entry = (item, time.perf_counter())
+        chain = self._chains.get(key)
+        if chain is not None:
+            # Chain is already waiting or being worked on; keep FIFO order
+            chain.append(entry)
+            return
+
+        self._chains[key] = deque([entry])
+        self._ready.put_nowait(key)
+
+    async def _worker(self, index: int):
+        """Take one chain at a time and drain it in order."""
+        while True:
+            key = await self._ready.get()
+            chain = self._chains[key]
+            self._busy_workers += 1
+            try:
+                while chain:
+                    item, enqueued_at = chain[0]
+                    stage_duration.observe(time.perf_counter() - enqueued_at, stage="queue_wait")
+                    try:
+                        await self.handler(item)
+                        self.processed += 1
+                    except asyncio.CancelledError:
+                        raise
+                    except Exception as e:
+                        self.failed += 1
+                        logger.error("Worker {} failed handling message for {}: {}", index, key, e)
+                    finally:
+                        chain.popleft()
+                        self._complete_one()
+            finally:
+                self._busy_workers -= 1
+                if chain:
+                    # Only reached when cancelled mid-chain during stop()
+                    logger.warning("Dropping {} queued messages for {}", len(chain), key)
+                del self._chains[key]
+
+    def _complete_one(self):
+        """Release capacity for a handled item."""
+        self._outstanding -= 1
+        self._slots.release()
+        if self._outstanding == 0:
+            self._idle.set()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get dispatcher statistics."""
+        return {
+            "workers": len(self._workers),
+            "busy_workers": self._busy_workers,
+            "queued": self._outstanding,
+            "capacity": self.max_queue_size,
+            "active_chats": len(self._chains),
+            "processed": self.processed,
+            "failed": self.failed,
+        }
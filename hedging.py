@@ -0,0 +1,107 @@
+"""
+Hedged requests for cutting tail latency.
+
+If a request hasn't answered within a high percentile of recently observed
+latencies, a second copy is started and whichever succeeds first wins; the
+other is cancelled. Hedges are paid for from a budget that grows by a fixed
+fraction per request, so hedging adds at most that fraction to upstream load.
+"""
+import asyncio
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional, TypeVar
+from logger import get_logger
+
+logger = get_logger("hedging")
+
+T = TypeVar("T")
+
+# Called with False for the original request and True for the hedge
+Attempt = Callable[[bool], Awaitable[T]]
+
+class Hedger:
+    """Starts a backup request once the original is slower than the percentile."""
+
+    def __init__(self, percentile: float = 0.95, budget_ratio: float = 0.05, min_delay: float = 0.05,
+                 window: int = 500, min_samples: int = 20, max_burst: float = 10.0):
+        if not 0 < percentile < 1:
+            raise ValueError("percentile must be between 0 and 1")
+        self.percentile = percentile
+        self.budget_ratio = budget_ratio
+        self.min_delay = min_delay
+        self.min_samples = min_samples
+        self.max_burst = max_burst
+        self._latencies: Deque[float] = deque(maxlen=window)
+        self._tokens = 0.0
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.budget_exhausted = 0
+
+    def threshold(self) -> Optional[float]:
+        """Delay after which a request is hedged, or None until enough latencies are known."""
+        if len(self._latencies) < self.min_samples:
+            return None
+        ordered = sorted(self._latencies)
+        index = min(len(ordered) - 1, int(len(ordered) * self.percentile))
+        return max(self.min_delay, ordered[index])
+
+    async def run(self, attempt: Attempt) -> T:
+        """Run an attempt, hedging it if it's slow and the budget allows."""
+        self.requests += 1
+        self._tokens = min(self.max_burst, self._tokens + self.budget_ratio)
+        delay = self.threshold()
+        if delay is None:
+            return await self._timed(attempt, False)
+
+        primary = asyncio.ensure_future(self._timed(attempt, False))
+        tasks = {primary}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if done:
+                return primary.result()
+            if self._tokens < 1:
+                self.budget_exhausted += 1
+                return await primary
+
+            self._tokens -= 1
+            self.hedges += 1
+            logger.debug("Request slower than {:.3f}s, sending hedge", delay)
+            hedge = asyncio.ensure_future(self._timed(attempt, True))
+            tasks.add(hedge)
+            error: Optional[BaseException] = None
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            self.hedge_wins += 1
+                        return task.result()
+                    # The original's error is the one reported if both fail
+                    if error is None or task is primary:
+                        error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+            # Let the loser unwind so its backend's accounting is settled
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _timed(self, attempt: Attempt, hedged: bool) -> T:
+        started = time.monotonic()
+        result = await attempt(hedged)
+        self._latencies.append(time.monotonic() - started)
+        return result
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get hedging statistics."""
+        threshold = self.threshold()
+        return {
+            "threshold_ms": round(threshold * 1000, 1) if threshold is not None else None,
+            "requests": self.requests,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "budget_exhausted": self.budget_exhausted,
+            "hedge_ratio": round(self.hedges / self.requests, 4) if self.requests else 0.0,
+        }
@@ -1,43 +1,90 @@
 """
 Logging configuration for the Telegram-Cursor API relay.
+
+Sinks are written from a background thread (LOG_ASYNC) so file writes and
+rotation never block the event loop. Use brace-style arguments rather than
+f-strings, e.g. logger.info("Sent to chat {}", chat_id), so messages are only
+formatted when a sink accepts them.
 """
 import sys
+from typing import Dict
 from loguru import logger
 from config import settings
 
+TEXT_FORMAT = "{time:YYYY-MM-DD HH:mm:ss} | {level: <8} | {name}:{function}:{line} - {message}"
+CONSOLE_FORMAT = "<green>{time:YYYY-MM-DD HH:mm:ss}</green> | <level>{level: <8}</level> | <cyan>{name}</cyan>:<cyan>{function}</cyan>:<cyan>{line}</cyan> - <level>{message}</level>"
+
+def build_module_levels(default_level: str, overrides: Dict[str, str]) -> Dict[str, str]:
+    """Build a loguru filter mapping module name to minimum level; "" is the default."""
+    levels = {"": default_level.upper()}
+    levels.update({name: level.upper() for name, level in overrides.items()})
+    return levels
+
+module_levels = build_module_levels(settings.log_level, settings.log_module_levels)
+
+# Sinks must accept the most verbose module level; the filter does the rest
+sink_level = min(module_levels.values(), key=lambda level: logger.level(level).no)
+serialize = settings.log_format.lower() == "json"
+
 # Remove default logger
 logger.remove()
 
 # Add console logger
 logger.add(
     sys.stdout,
-    level=settings.log_level,
-    format="<green>{time:YYYY-MM-DD HH:mm:ss}</green> | <level>{level: <8}</level> | <cyan>{name}</cyan>:<cyan>{function}</cyan>:<cyan>{line}</cyan> - <level>{message}</level>",
-    colorize=True
+    level=sink_level,
+    filter=module_levels,
+    format=TEXT_FORMAT if serialize else CONSOLE_FORMAT,
+    colorize=not serialize,
+    serialize=serialize,
+    enqueue=settings.log_async
 )
 
-# Add file logger
-logger.add(
-    "logs/relay.log",
-    level=settings.log_level,
-    format="{time:YYYY-MM-DD HH:mm:ss} | {level: <8} | {name}:{function}:{line} - {message}",
-    rotation="1 day",
-    retention="30 days",
-    compression="zip"
-)
+# File sink ids, so the files can be moved (e.g. per shard worker)
+_file_sinks = []
 
-# Add error file logger
-logger.add(
-    "logs/errors.log",
-    level="ERROR",
-    format="{time:YYYY-MM-DD HH:mm:ss} | {level: <8} | {name}:{function}:{line} - {message}",
-    rotation="1 day",
-    retention="90 days",
-    compression="zip"
-)
+def configure_file_logs():
+    """(Re)open the file sinks at settings.log_file_path and settings.log_error_path.
+
+    A rotating file must have a single writer, so each process needs its own.
+    """
+    for sink_id in _file_sinks:
+        logger.remove(sink_id)
+    _file_sinks[:] = [
+        logger.add(
+            settings.log_file_path,
+            level=sink_level,
+            filter=module_levels,
+            format=TEXT_FORMAT,
+            serialize=serialize,
+            enqueue=settings.log_async,
+            rotation="1 day",
+            retention="30 days",
+            compression="zip",
+            delay=True
+        ),
+        logger.add(
+            settings.log_error_path,
+            level="ERROR",
+            format=TEXT_FORMAT,
+            serialize=serialize,
+            enqueue=settings.log_async,
+            rotation="1 day",
+            retention="90 days",
+            compression="zip",
+            delay=True
+        ),
+    ]
+
+# Add file loggers
+configure_file_logs()
 
 def get_logger(name: str = None):
     """Get a logger instance."""
     if name:
         return logger.bind(name=name)
-    return logger
\ No newline at end of file
+    return logger
+
+async def flush_logs():
+    """Wait until queued log messages have been written."""
+    await logger.complete()
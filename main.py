@@ -2,18 +2,22 @@
 Main application entry point for the Telegram-Cursor API relay.
 """
 import asyncio
+import hmac
 import signal
 import sys
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, ORJSONResponse, PlainTextResponse
 import uvicorn
 from relay import TelegramCursorRelay
-from logger import get_logger
+from sharding import ShardRouter, ShardUnavailableError
+from metrics import registry
+from performance import fast_json, install_event_loop, json_loads
+from logger import get_logger, flush_logs
 from config import settings
 
 logger = get_logger("main")
 
-# Global relay instance
+# Global relay instance; the front of a sharded deployment when RELAY_SHARDS is set
 relay: TelegramCursorRelay = None
 
 def create_app() -> FastAPI:
@@ -21,7 +25,8 @@ def create_app() -> FastAPI:
     app = FastAPI(
         title="Telegram-Cursor API Relay",
         description="A relay system connecting Telegram bots with Cursor AI API",
-        version="1.0.0"
+        version="1.0.0",
+        default_response_class=ORJSONResponse if fast_json else JSONResponse
     )
     
     @app.get("/")
@@ -43,9 +48,15 @@ def create_app() -> FastAPI:
             status = await relay.get_status()
             return status
         except Exception as e:
-            logger.error(f"Error getting status: {e}")
+            logger.error("Error getting status: {}", e)
             raise HTTPException(status_code=500, detail=str(e))
     
+    @app.get("/metrics", response_class=PlainTextResponse)
+    async def get_metrics():
+        """Prometheus metrics endpoint."""
+        collected = relay.collect_metrics() if relay else []
+        return PlainTextResponse(registry.render(collected), media_type="text/plain; version=0.0.4")
+    
     @app.post("/restart")
     async def restart_relay():
         """Restart the relay system."""
@@ -57,9 +68,31 @@ def create_app() -> FastAPI:
             await relay.start()
             return {"message": "Relay restarted successfully"}
         except Exception as e:
-            logger.error(f"Error restarting relay: {e}")
+            logger.error("Error restarting relay: {}", e)
             raise HTTPException(status_code=500, detail=str(e))
     
+    if settings.telegram_mode.lower() == "webhook":
+        @app.post(settings.telegram_webhook_path)
+        async def telegram_webhook(request: Request):
+            """Receive a Telegram update pushed by the Bot API."""
+            secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "").encode()
+            if not hmac.compare_digest(secret, (settings.telegram_webhook_secret or "").encode()):
+                raise HTTPException(status_code=403, detail="Invalid secret token")
+            
+            if not relay or not relay.is_running:
+                # Telegram retries failed deliveries, so nothing is lost
+                raise HTTPException(status_code=503, detail="Relay not running")
+            
+            try:
+                await relay.handle_webhook_update(json_loads(await request.body()))
+                return {"ok": True}
+            except ShardUnavailableError as e:
+                logger.warning("Rejecting webhook update: {}", e)
+                raise HTTPException(status_code=503, detail="Relay is overloaded")
+            except Exception as e:
+                logger.error("Error handling webhook update: {}", e)
+                raise HTTPException(status_code=500, detail="Failed to process update")
+    
     @app.get("/health")
     async def health_check():
         """Health check endpoint."""
@@ -74,13 +107,13 @@ async def setup_relay():
     try:
         logger.info("Initializing Telegram-Cursor relay...")
         
-        relay = TelegramCursorRelay()
+        relay = ShardRouter() if settings.relay_shards else TelegramCursorRelay()
         await relay.initialize()
         
         logger.info("Relay initialized successfully")
         
     except Exception as e:
-        logger.error(f"Failed to initialize relay: {e}")
+        logger.error("Failed to initialize relay: {}", e)
         sys.exit(1)
 
 async def start_relay():
@@ -92,7 +125,7 @@ async def start_relay():
         logger.info("Relay started successfully")
         
     except Exception as e:
-        logger.error(f"Failed to start relay: {e}")
+        logger.error("Failed to start relay: {}", e)
         sys.exit(1)
 
 async def stop_relay():
@@ -104,11 +137,14 @@ async def stop_relay():
             await relay.stop()
             logger.info("Relay stopped successfully")
         except Exception as e:
-            logger.error(f"Error stopping relay: {e}")
+            logger.error("Error stopping relay: {}", e)
+    
+    # Write out anything still queued for the background log writer
+    await flush_logs()
 
 def signal_handler(signum, frame):
     """Handle shutdown signals."""
-    logger.info(f"Received signal {signum}, shutting down...")
+    logger.info("Received signal {}, shutting down...", signum)
     asyncio.create_task(stop_relay())
     sys.exit(0)
 
@@ -137,13 +173,13 @@ async def main():
         )
         server = uvicorn.Server(config)
         
-        logger.info(f"Starting web server on port {settings.port}")
+        logger.info("Starting web server on port {}", settings.port)
         await server.serve()
         
     except KeyboardInterrupt:
         logger.info("Received keyboard interrupt")
     except Exception as e:
-        logger.error(f"Application error: {e}")
+        logger.error("Application error: {}", e)
     finally:
         await stop_relay()
 
@@ -152,5 +188,6 @@ if __name__ == "__main__":
     import os
     os.makedirs("logs", exist_ok=True)
     
-    # Run the application
+    # Run the application, on uvloop with the performance profile
+    install_event_loop()
     asyncio.run(main())
\ No newline at end of file
@@ -0,0 +1,210 @@
+"""
+Write-ahead log of relay message state transitions.
+
+Every transition (pending, processing, completed, failed, undelivered) is
+appended as a JSON line. Appends are buffered and committed in groups by a
+background task with one write and one fsync per group, so recording a
+transition costs a JSON encode and a list append. A caller waiting for
+durability starts the commit at once rather than after the commit interval;
+records arriving while it is written form the next group. Once the log grows
+past a threshold it is compacted down to the messages that are still
+unfinished. On startup those messages are read back so the relay can
+process them again.
+"""
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+from models import RelayMessage
+from performance import json_dumps, json_loads
+from logger import get_logger
+
+logger = get_logger("message_log")
+
+FINISHED_STATUSES = ("completed", "failed")
+# Recorded with the whole message, so it can be replayed from this state
+REPLAYABLE_STATUSES = ("pending", "undelivered")
+
+class MessageLog:
+    """Append-only, group-committed log of relay message states."""
+
+    def __init__(self, path: str = "data/relay-messages.log", commit_interval: float = 0.01,
+                 compact_after: int = 10000):
+        self.path = path
+        self.commit_interval = commit_interval
+        self.compact_after = compact_after
+        self._file = None
+        # A single thread owns the file, so batches and compactions never interleave
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._writer: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        # Set when a caller is waiting on the buffer, so it is committed without delay
+        self._flush_requested: Optional[asyncio.Event] = None
+        self._buffer: List[bytes] = []
+        # Resolved when the records now in the buffer, or the batch being written, are durable
+        self._next_commit: Optional[asyncio.Future] = None
+        self._committing: Optional[asyncio.Future] = None
+        # Unfinished message id -> its pending record, the state a compaction keeps
+        self._unfinished: Dict[str, bytes] = {}
+        self._records_in_file = 0
+        self.commits = 0
+        self.records_written = 0
+        self.compactions = 0
+
+    async def initialize(self) -> List[RelayMessage]:
+        """Open the log and return the messages that never finished, oldest first.
+
+        Returns an empty list if the log is already open.
+        """
+        if self._file:
+            return []
+
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="message-log")
+        self._unfinished = await self._run(self._read)
+        # Start from a compacted file so the tail of a torn write is discarded
+        await self._run(self._compact, list(self._unfinished.values()))
+        self._wakeup = asyncio.Event()
+        self._flush_requested = asyncio.Event()
+        self._next_commit = asyncio.get_running_loop().create_future()
+        self._writer = asyncio.create_task(self._write_loop())
+
+        recovered = []
+        for line in self._unfinished.values():
+            relay_msg = RelayMessage.model_validate(json_loads(line)["message"])
+            relay_msg.status = "pending"
+            recovered.append(relay_msg)
+        logger.info("Message log opened at {} with {} unfinished messages", self.path, len(recovered))
+        return recovered
+
+    async def close(self):
+        """Commit buffered records and close the log."""
+        if not self._file:
+            return
+
+        self._writer.cancel()
+        await asyncio.gather(self._writer, return_exceptions=True)
+        await self._commit()
+        await self._run(self._file.close)
+        self._file = None
+        self._executor.shutdown(wait=True)
+        self._executor = None
+
+    async def _run(self, func, *args):
+        """Run a blocking file operation on the log thread."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    def record(self, relay_msg: RelayMessage):
+        """Buffer a message's current state for the next group commit."""
+        if relay_msg.status in REPLAYABLE_STATUSES:
+            # Serialized by pydantic-core directly; same record as _encode would produce
+            line = b'{"message":' + relay_msg.model_dump_json().encode() + b"}\n"
+            self._unfinished[relay_msg.id] = line
+        else:
+            line = self._encode({"id": relay_msg.id, "status": relay_msg.status})
+            if relay_msg.status in FINISHED_STATUSES:
+                self._unfinished.pop(relay_msg.id, None)
+        self._buffer.append(line)
+        self._wakeup.set()
+
+    async def wait_durable(self):
+        """Wait until everything recorded so far is on disk."""
+        if self._buffer:
+            self._flush_requested.set()
+            await asyncio.shield(self._next_commit)
+        elif self._committing and not self._committing.done():
+            await asyncio.shield(self._committing)
+
+    @staticmethod
+    def _encode(record: Dict[str, Any]) -> bytes:
+        return json_dumps(record) + b"\n"
+
+    async def _write_loop(self):
+        """Commit buffered records in groups."""
+        while True:
+            await self._wakeup.wait()
+            if not self._flush_requested.is_set():
+                # Let concurrent records join this group, unless someone is waiting for it
+                try:
+                    await asyncio.wait_for(self._flush_requested.wait(), self.commit_interval)
+                except asyncio.TimeoutError:
+                    pass
+            await self._commit()
+
+    async def _commit(self):
+        """Write and fsync the buffer, compacting instead when the log is large."""
+        self._wakeup.clear()
+        self._flush_requested.clear()
+        if not self._buffer:
+            return
+
+        batch, self._buffer = self._buffer, []
+        future, self._next_commit = self._next_commit, asyncio.get_running_loop().create_future()
+        self._committing = future
+        try:
+            # Compacting only pays off when most of the log is finished messages
+            if (self._records_in_file + len(batch) > self.compact_after
+                    and len(self._unfinished) <= self.compact_after // 2):
+                await self._run(self._compact, list(self._unfinished.values()))
+                self.compactions += 1
+            else:
+                await self._run(self._append, batch)
+            self.commits += 1
+            self.records_written += len(batch)
+            future.set_result(None)
+        except Exception as e:
+            logger.error("Failed to commit {} message log records: {}", len(batch), e)
+            future.set_exception(e)
+            # Mark retrieved so callers that didn't wait don't trigger a warning
+            future.exception()
+
+    def _read(self) -> Dict[str, bytes]:
+        """Read the log and return the pending records of unfinished messages."""
+        unfinished: Dict[str, bytes] = {}
+        if not os.path.exists(self.path):
+            return unfinished
+        with open(self.path, "rb") as f:
+            for line in f:
+                try:
+                    record = json_loads(line)
+                except ValueError:
+                    # A torn write from a crash; nothing after it was committed
+                    break
+                if "message" in record:
+                    unfinished[record["message"]["id"]] = line.rstrip(b"\n") + b"\n"
+                elif record["status"] in FINISHED_STATUSES:
+                    unfinished.pop(record["id"], None)
+        return unfinished
+
+    def _append(self, batch: List[bytes]):
+        """Append a batch and make it durable."""
+        self._file.write(b"".join(batch))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._records_in_file += len(batch)
+
+    def _compact(self, records: List[bytes]):
+        """Atomically replace the log with just the given records."""
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        temp_path = self.path + ".compact"
+        with open(temp_path, "wb") as f:
+            f.write(b"".join(records))
+            f.flush()
+            os.fsync(f.fileno())
+        if self._file:
+            self._file.close()
+        os.replace(temp_path, self.path)
+        self._file = open(self.path, "ab")
+        self._records_in_file = len(records)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get log statistics."""
+        return {
+            "unfinished": len(self._unfinished),
+            "buffered": len(self._buffer),
+            "records_in_file": self._records_in_file,
+            "commits": self.commits,
+            "records_written": self.records_written,
+            "compactions": self.compactions,
+        }
@@ -0,0 +1,84 @@
+"""
+Bounded retention of relay messages.
+
+In-flight messages are tracked by id until they finish; finished messages are
+kept in a ring buffer capped by count and by approximate byte size, so memory
+stays flat no matter how long the relay runs.
+"""
+from collections import deque
+from itertools import islice
+from typing import Any, Deque, Dict, List, Optional, Tuple
+from models import RelayMessage
+
+# Rough per-message cost of the pydantic objects themselves, excluding text
+MESSAGE_OVERHEAD_BYTES = 1024
+
+def estimate_message_size(relay_msg: RelayMessage) -> int:
+    """Approximate the memory held by a relay message."""
+    size = MESSAGE_OVERHEAD_BYTES
+    if relay_msg.telegram_message:
+        size += len(relay_msg.telegram_message.text)
+    if relay_msg.cursor_message:
+        size += len(relay_msg.cursor_message.content)
+    if relay_msg.error_message:
+        size += len(relay_msg.error_message)
+    return size
+
+class RelayMessageStore:
+    """In-flight relay messages plus a bounded buffer of finished ones."""
+
+    def __init__(self, max_completed: int = 1000, max_completed_bytes: int = 5 * 1024 * 1024):
+        self.max_completed = max_completed
+        self.max_completed_bytes = max_completed_bytes
+        self.in_flight: Dict[str, RelayMessage] = {}
+        self._completed: Deque[Tuple[RelayMessage, int]] = deque()
+        self._completed_bytes = 0
+        self.evicted = 0
+
+    def add(self, relay_msg: RelayMessage):
+        """Track a newly received message."""
+        self.in_flight[relay_msg.id] = relay_msg
+
+    def finish(self, relay_msg: RelayMessage):
+        """Move a completed or failed message into the retention buffer."""
+        self.in_flight.pop(relay_msg.id, None)
+
+        if self.max_completed <= 0:
+            self.evicted += 1
+            return
+
+        size = estimate_message_size(relay_msg)
+        self._completed.append((relay_msg, size))
+        self._completed_bytes += size
+
+        # Evict oldest until both limits hold; always keep the newest message
+        while len(self._completed) > 1 and (
+            len(self._completed) > self.max_completed
+            or self._completed_bytes > self.max_completed_bytes
+        ):
+            _, evicted_size = self._completed.popleft()
+            self._completed_bytes -= evicted_size
+            self.evicted += 1
+
+    def get(self, message_id: str) -> Optional[RelayMessage]:
+        """Look up a message by id, in-flight first."""
+        relay_msg = self.in_flight.get(message_id)
+        if relay_msg is not None:
+            return relay_msg
+        for retained, _ in reversed(self._completed):
+            if retained.id == message_id:
+                return retained
+        return None
+
+    def recent(self, limit: int = 20) -> List[RelayMessage]:
+        """Get the most recently finished messages, newest first."""
+        return [relay_msg for relay_msg, _ in islice(reversed(self._completed), limit)]
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get retention statistics."""
+        return {
+            "in_flight": len(self.in_flight),
+            "completed_retained": len(self._completed),
+            "completed_retained_bytes": self._completed_bytes,
+            "evicted": self.evicted,
+        }
@@ -1,5 +1,11 @@
 """
 Data models for the Telegram-Cursor API relay.
+
+Models are built with validation everywhere: pydantic-core validates values
+that already have the right types faster than model_construct skips it (see
+`python benchmark.py --suite models`). On the hot path, pass datetimes
+rather than timestamps so nothing needs coercing, and serialize with
+model_dump_json rather than model_dump followed by json.dumps.
 """
 from typing import Optional, Dict, Any, List
 from pydantic import BaseModel, Field
@@ -44,7 +50,7 @@ class RelayMessage(BaseModel):
     telegram_message: Optional[TelegramMessage] = None
     cursor_message: Optional[CursorMessage] = None
     direction: MessageDirection
-    status: str = "pending"  # pending, processing, completed, failed
+    status: str = "pending"  # pending, processing, completed, failed, undelivered
     created_at: datetime
     processed_at: Optional[datetime] = None
     error_message: Optional[str] = None
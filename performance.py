@@ -0,0 +1,73 @@
+"""
+Opt-in performance profile: a fast JSON codec and the uvloop event loop.
+
+With PERFORMANCE_PROFILE enabled, JSON on the hot paths (Cursor API payloads
+and responses, shard frames, message log records and web responses) goes
+through orjson, and the service runs on uvloop. Both are optional extras;
+when one is missing the standard library json module or asyncio event loop
+is used instead.
+"""
+import asyncio
+import json
+from typing import Any, Dict, Union
+from logger import get_logger
+from config import settings
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+logger = get_logger("performance")
+
+# Whether JSON goes through orjson
+fast_json = bool(settings.performance_profile and orjson)
+
+if settings.performance_profile and not orjson:
+    logger.warning("PERFORMANCE_PROFILE is enabled but orjson is not installed; using the json module")
+
+def json_dumps(obj: Any) -> bytes:
+    """Serialize to compact JSON bytes."""
+    if fast_json:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, separators=(",", ":")).encode()
+
+def json_dumps_str(obj: Any) -> str:
+    """Serialize to compact JSON text, e.g. for aiohttp's json_serialize."""
+    return json_dumps(obj).decode()
+
+def json_loads(data: Union[str, bytes]) -> Any:
+    """Parse JSON text or bytes."""
+    if fast_json:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def install_event_loop() -> str:
+    """Make event loops created from now on use uvloop, if the profile asks for it.
+
+    Call before asyncio.run. Returns the name of the loop implementation.
+    """
+    if not settings.performance_profile:
+        return "asyncio"
+    if not uvloop:
+        logger.warning("PERFORMANCE_PROFILE is enabled but uvloop is not installed; using the asyncio event loop")
+        return "asyncio"
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return "uvloop"
+
+def get_profile() -> Dict[str, Any]:
+    """Describe the codec and event loop in use."""
+    try:
+        loop = type(asyncio.get_running_loop()).__module__.split(".")[0]
+    except RuntimeError:
+        loop = None
+    return {
+        "enabled": settings.performance_profile,
+        "json": "orjson" if fast_json else "json",
+        "event_loop": loop,
+    }
@@ -2,27 +2,67 @@
 Main relay logic connecting Telegram and Cursor API.
 """
 import asyncio
+import time
 import uuid
-from typing import Dict, Optional, List
+from typing import Any, Dict, List, Optional
 from datetime import datetime
+from telegram.error import BadRequest
 from models import RelayMessage, MessageDirection, TelegramMessage, CursorMessage, ChatSession
-from telegram_client import TelegramClient
-from cursor_client import CursorClient, MockCursorClient
+from telegram_client import TelegramClient, StreamingReply
+from cursor_client import CursorClient
+from dispatcher import ChatDispatcher
+from message_store import RelayMessageStore
+from message_log import MessageLog
+from storage import create_storage
+from tracing import create_tracer
+from performance import get_profile
+from resilience import CursorAPIError, CircuitOpenError, CircuitBreaker
+from concurrency_limit import ConcurrencyLimitError
+from metrics import MetricFamily, stage_duration, stage_failures, cursor_tokens
 from logger import get_logger
 from config import settings
 
 logger = get_logger("relay")
 
+class ReplyNotSentError(Exception):
+    """Raised when a reply could not be delivered to Telegram and should be sent again later."""
+
 class TelegramCursorRelay:
     """Main relay class connecting Telegram and Cursor API."""
     
-    def __init__(self):
-        self.telegram_client = TelegramClient()
-        self.cursor_client = MockCursorClient() if not settings.cursor_api_key else CursorClient()
-        self.active_sessions: Dict[int, ChatSession] = {}
-        self.message_queue: List[RelayMessage] = []
+    def __init__(self, shard_index: Optional[int] = None):
+        # Set when running as one worker of a sharded deployment
+        self.shard_index = shard_index
+        self.storage = create_storage()
+        self.telegram_client = TelegramClient(storage=self.storage)
+        # Backends (Cursor API, other OpenAI-compatible endpoints or the mock) come from settings
+        self.cursor_client = CursorClient(storage=self.storage)
+        # Sessions are owned by the Telegram client, which loads them from storage
+        self.active_sessions: Dict[int, ChatSession] = self.telegram_client.active_sessions
+        self.messages = RelayMessageStore(
+            max_completed=settings.relay_retained_messages,
+            max_completed_bytes=settings.relay_retained_bytes
+        )
+        self.dispatcher = ChatDispatcher(
+            self._process_message,
+            workers=settings.relay_worker_count,
+            max_queue_size=settings.relay_queue_size
+        )
+        self.message_log = MessageLog(
+            path=settings.relay_log_path,
+            commit_interval=settings.relay_log_commit_interval,
+            compact_after=settings.relay_log_compact_after
+        ) if settings.relay_log_enabled else None
+        # Unfinished messages read back from the log, submitted once workers start
+        self._recovered: List[RelayMessage] = []
+        self.tracer = create_tracer()
         self.is_running = False
         
+    @property
+    def uses_webhook(self) -> bool:
+        """Whether Telegram updates arrive through the web server's webhook route."""
+        return settings.telegram_mode.lower() == "webhook"
+    
     async def initialize(self):
         """Initialize the relay system."""
         try:
@@ -33,14 +73,20 @@ class TelegramCursorRelay:
             # Set up message handler
             self.telegram_client._send_to_relay = self._handle_telegram_message
             
+            # Recover messages that were in flight when the last run ended
+            if self.message_log:
+                self._recovered = await self.message_log.initialize()
+            
             logger.info("Relay system initialized successfully")
             
         except Exception as e:
-            logger.error(f"Failed to initialize relay system: {e}")
+            logger.error("Failed to initialize relay system: {}", e)
             raise
     
     async def _handle_telegram_message(self, telegram_msg: TelegramMessage):
         """Handle incoming Telegram message."""
+        received = time.perf_counter()
+        relay_msg = None
         try:
             # Create relay message
             relay_msg = RelayMessage(
@@ -51,59 +97,147 @@ class TelegramCursorRelay:
                 created_at=datetime.now()
             )
             
-            # Add to queue
-            self.message_queue.append(relay_msg)
+            self.tracer.start_trace(relay_msg.id, chat_id=telegram_msg.chat_id,
+                                    telegram_message_id=telegram_msg.message_id)
+            
+            # Track as in-flight until processed
+            self.messages.add(relay_msg)
+            self._log_transition(relay_msg)
+            
+            # Dispatch to the worker pool; waits here when the queue is full
+            with self.tracer.resume(relay_msg.id), self.tracer.span("dispatch.submit"):
+                await self.dispatcher.submit(telegram_msg.chat_id, relay_msg)
             
-            # Process immediately
-            await self._process_message(relay_msg)
+            # Don't acknowledge the update until the message would survive a crash
+            if self.message_log:
+                await self.message_log.wait_durable()
+            stage_duration.observe(time.perf_counter() - received, stage="ingest")
             
         except Exception as e:
-            logger.error(f"Error handling Telegram message: {e}")
+            stage_failures.inc(stage="ingest")
+            logger.error("Error handling Telegram message: {}", e)
+            if relay_msg:
+                relay_msg.status = "failed"
+                relay_msg.error_message = str(e)
+                self.messages.finish(relay_msg)
+                self._log_transition(relay_msg)
+                self.tracer.finish_trace(relay_msg.id, error=str(e), status=relay_msg.status)
             await self._send_error_response(telegram_msg.chat_id, "Error processing message")
     
+    async def handle_webhook_update(self, data: Dict[str, Any]):
+        """Feed a Telegram webhook update into the normal handler and dispatch path."""
+        await self.telegram_client.process_webhook_update(data)
+    
     async def _process_message(self, relay_msg: RelayMessage):
         """Process a relay message."""
         try:
             relay_msg.status = "processing"
+            self._log_transition(relay_msg)
             
-            if relay_msg.direction == MessageDirection.TELEGRAM_TO_CURSOR:
-                await self._process_telegram_to_cursor(relay_msg)
-            elif relay_msg.direction == MessageDirection.CURSOR_TO_TELEGRAM:
-                await self._process_cursor_to_telegram(relay_msg)
+            with self.tracer.resume(relay_msg.id):
+                if relay_msg.direction == MessageDirection.TELEGRAM_TO_CURSOR:
+                    await self._process_telegram_to_cursor(relay_msg)
+                elif relay_msg.direction == MessageDirection.CURSOR_TO_TELEGRAM:
+                    await self._process_cursor_to_telegram(relay_msg)
             
             relay_msg.status = "completed"
             relay_msg.processed_at = datetime.now()
             
+        except ReplyNotSentError as e:
+            # Stays unfinished in the message log, so the reply is sent again after a restart
+            relay_msg.status = "undelivered"
+            relay_msg.error_message = str(e)
+            logger.error("Reply to relay message {} was not delivered: {}", relay_msg.id, e)
         except Exception as e:
             relay_msg.status = "failed"
             relay_msg.error_message = str(e)
-            logger.error(f"Error processing relay message {relay_msg.id}: {e}")
+            logger.error("Error processing relay message {}: {}", relay_msg.id, e)
+            if relay_msg.telegram_message:
+                await self._send_error_response(relay_msg.telegram_message.chat_id, self._describe_error(e))
+        finally:
+            finished_at = relay_msg.processed_at or datetime.now()
+            stage_duration.observe((finished_at - relay_msg.created_at).total_seconds(), stage="end_to_end")
+            self.messages.finish(relay_msg)
+            self._log_transition(relay_msg)
+            self.tracer.finish_trace(relay_msg.id, error=relay_msg.error_message, status=relay_msg.status)
+    
+    def _log_transition(self, relay_msg: RelayMessage):
+        """Record a message's new status in the write-ahead log."""
+        if self.message_log:
+            self.message_log.record(relay_msg)
+    
+    async def _resubmit_recovered(self):
+        """Queue messages recovered from the write-ahead log for processing."""
+        recovered, self._recovered = self._recovered, []
+        for relay_msg in recovered:
+            self.messages.add(relay_msg)
+            self.tracer.start_trace(relay_msg.id, recovered=True)
+            await self.dispatcher.submit(relay_msg.telegram_message.chat_id, relay_msg)
+        if recovered:
+            logger.info("Resubmitted {} messages recovered from the message log", len(recovered))
     
     async def _process_telegram_to_cursor(self, relay_msg: RelayMessage):
         """Process message from Telegram to Cursor."""
         telegram_msg = relay_msg.telegram_message
+        if relay_msg.cursor_message is not None:
+            # Recovered after its reply failed to send; only the reply is sent again
+            await self._send_cursor_response_to_telegram(telegram_msg.chat_id, relay_msg.cursor_message)
+            return
         
         # Get or create conversation
-        conversation_id = await self._get_conversation_id(telegram_msg.chat_id)
+        with self.tracer.span("get_conversation_id"):
+            conversation_id = await self._get_conversation_id(telegram_msg.chat_id)
+        
+        # Stream partial output into a message that is edited in place
+        reply = self.telegram_client.streaming_reply(telegram_msg.chat_id) if settings.cursor_streaming else None
         
         # Send to Cursor API
-        cursor_response = await self.cursor_client.send_message(
-            message=telegram_msg.text,
-            conversation_id=conversation_id,
-            context={
-                "user_id": telegram_msg.user_id,
-                "username": telegram_msg.username,
-                "message_type": telegram_msg.message_type.value
-            }
-        )
+        started = time.perf_counter()
+        try:
+            with self.tracer.span("cursor.send_message", streaming=reply is not None) as span:
+                cursor_response = await self.cursor_client.send_message(
+                    message=telegram_msg.text,
+                    conversation_id=conversation_id,
+                    context={
+                        "user_id": telegram_msg.user_id,
+                        "username": telegram_msg.username,
+                        "message_type": telegram_msg.message_type.value
+                    },
+                    on_chunk=reply.append if reply else None,
+                    use_cache=self._allows_cache(telegram_msg.chat_id)
+                )
+                metadata = cursor_response.metadata or {}
+                span.set_attribute("cached", bool(metadata.get("cached")))
+                span.set_attribute("coalesced", bool(metadata.get("coalesced")))
+        except Exception:
+            stage_failures.inc(stage="cursor_api")
+            raise
+        finally:
+            stage_duration.observe(time.perf_counter() - started, stage="cursor_api")
+        self._record_usage(cursor_response)
         
         # Store cursor response
         relay_msg.cursor_message = cursor_response
         
         # Send response back to Telegram
-        await self._send_cursor_response_to_telegram(telegram_msg.chat_id, cursor_response)
+        await self._send_cursor_response_to_telegram(telegram_msg.chat_id, cursor_response, reply)
         
-        logger.info(f"Message relayed from Telegram to Cursor: {telegram_msg.text[:50]}...")
+        logger.info("Message relayed from Telegram to Cursor: {}...", telegram_msg.text[:50])
+    
+    def _record_usage(self, cursor_msg: CursorMessage):
+        """Count tokens for responses that actually went upstream."""
+        metadata = cursor_msg.metadata or {}
+        if metadata.get("cached") or metadata.get("coalesced"):
+            return
+        usage = metadata.get("usage") or {}
+        for token_type in ("prompt_tokens", "completion_tokens"):
+            if usage.get(token_type):
+                cursor_tokens.inc(usage[token_type], type=token_type.replace("_tokens", ""))
+    
+    def _allows_cache(self, chat_id: int) -> bool:
+        """Whether this chat may be given a cached or shared response."""
+        cache = self.cursor_client.response_cache
+        return cache.allows_chat(chat_id) if cache else True
     
     async def _process_cursor_to_telegram(self, relay_msg: RelayMessage):
         """Process message from Cursor to Telegram."""
@@ -115,33 +249,51 @@ class TelegramCursorRelay:
     
     async def _get_conversation_id(self, chat_id: int) -> str:
         """Get or create conversation ID for a chat."""
-        if chat_id in self.active_sessions:
-            session = self.active_sessions[chat_id]
-            if session.cursor_conversation_id:
-                return session.cursor_conversation_id
+        with self.tracer.span("session_lookup"):
+            session = await self.telegram_client.get_session(chat_id)
+        if session and session.cursor_conversation_id:
+            return session.cursor_conversation_id
         
         # Create new conversation ID
         conversation_id = f"telegram_chat_{chat_id}_{int(datetime.now().timestamp())}"
         
-        if chat_id in self.active_sessions:
-            self.active_sessions[chat_id].cursor_conversation_id = conversation_id
+        if session:
+            session.cursor_conversation_id = conversation_id
+            self.storage.save_session(session)
         
         return conversation_id
     
-    async def _send_cursor_response_to_telegram(self, chat_id: int, cursor_msg: CursorMessage):
-        """Send Cursor response to Telegram."""
+    async def _send_cursor_response_to_telegram(self, chat_id: int, cursor_msg: CursorMessage,
+                                                reply: Optional[StreamingReply] = None):
+        """Send Cursor response to Telegram.
+        
+        Raises ReplyNotSentError if the reply may go through when sent again.
+        """
+        started = time.perf_counter()
         try:
             # Format the response
-            response_text = self._format_cursor_response(cursor_msg)
+            with self.tracer.span("format_response"):
+                response_text = self._format_cursor_response(cursor_msg)
             
-            # Send to Telegram
-            await self.telegram_client.send_message(chat_id, response_text)
+            # Send to Telegram, finalizing the streamed message if there is one
+            with self.tracer.span("telegram.send_message", streamed=reply is not None):
+                if reply:
+                    await reply.finish(response_text)
+                else:
+                    await self.telegram_client.send_message(chat_id, response_text)
             
-            logger.info(f"Response sent to Telegram chat {chat_id}")
+            stage_duration.observe(time.perf_counter() - started, stage="telegram_send")
+            logger.info("Response sent to Telegram chat {}", chat_id)
             
+        except BadRequest as e:
+            # Telegram refused this reply; sending it again won't help
+            stage_failures.inc(stage="telegram_send")
+            logger.error("Telegram rejected response: {}", e)
+            raise
         except Exception as e:
-            logger.error(f"Failed to send response to Telegram: {e}")
-            await self._send_error_response(chat_id, "Failed to send response")
+            stage_failures.inc(stage="telegram_send")
+            logger.error("Failed to send response to Telegram: {}", e)
+            raise ReplyNotSentError(f"Failed to send response: {e}") from e
     
     def _format_cursor_response(self, cursor_msg: CursorMessage) -> str:
         """Format Cursor response for Telegram."""
@@ -165,6 +317,20 @@ class TelegramCursorRelay:
         
         return content
     
+    def _describe_error(self, error: Exception) -> str:
+        """Turn a processing error into a message for the user."""
+        if isinstance(error, ConcurrencyLimitError):
+            return "Cursor AI is busy right now. Please try again shortly."
+        if isinstance(error, CircuitOpenError):
+            return "Cursor AI is temporarily unavailable. Please try again in a minute."
+        if isinstance(error, CursorAPIError):
+            if error.status == 429:
+                return "Cursor AI is busy right now. Please try again shortly."
+            if error.retryable:
+                return "Cursor AI did not respond. Please try again."
+            return "Cursor AI could not process this message."
+        return "Error processing message"
+    
     async def _send_error_response(self, chat_id: int, error_message: str):
         """Send error response to Telegram."""
         try:
@@ -173,7 +339,7 @@ class TelegramCursorRelay:
                 f"❌ {error_message}"
             )
         except Exception as e:
-            logger.error(f"Failed to send error response: {e}")
+            logger.error("Failed to send error response: {}", e)
     
     async def start(self):
         """Start the relay system."""
@@ -181,13 +347,26 @@ class TelegramCursorRelay:
             self.is_running = True
             logger.info("Starting Telegram-Cursor relay...")
             
-            # Start Telegram bot polling
-            await self.telegram_client.start_polling()
+            # Open storage and start message workers before updates can arrive
+            await self.storage.initialize()
+            if self.message_log:
+                self._recovered += await self.message_log.initialize()
+            self.tracer.start()
+            # Recovered messages may only need their reply sent
+            await self.telegram_client.prepare()
+            self.dispatcher.start()
+            await self._resubmit_recovered()
+            
+            # Start receiving Telegram updates
+            if self.uses_webhook:
+                await self.telegram_client.start_webhook(register=self.shard_index is None)
+            else:
+                await self.telegram_client.start_polling()
             
             logger.info("Relay system started successfully")
             
         except Exception as e:
-            logger.error(f"Failed to start relay system: {e}")
+            logger.error("Failed to start relay system: {}", e)
             raise
     
     async def stop(self):
@@ -196,8 +375,22 @@ class TelegramCursorRelay:
             self.is_running = False
             logger.info("Stopping Telegram-Cursor relay...")
             
-            # Stop Telegram bot
-            await self.telegram_client.stop_polling()
+            # Stop taking in updates; the webhook route refuses them once is_running is False
+            await self.telegram_client.stop_updates()
+            
+            # Let queued messages finish and send their replies, then stop workers
+            await self.dispatcher.stop()
+            
+            # The bot is only shut down once nothing is left to send
+            await self.telegram_client.shutdown()
+            
+            # Flush pending session and history writes
+            await self.storage.close()
+            if self.message_log:
+                await self.message_log.close()
+            
+            # Export remaining trace spans
+            await self.tracer.stop()
             
             # Close Cursor client
             await self.cursor_client.close()
@@ -205,14 +398,85 @@ class TelegramCursorRelay:
             logger.info("Relay system stopped")
             
         except Exception as e:
-            logger.error(f"Error stopping relay system: {e}")
+            logger.error("Error stopping relay system: {}", e)
     
     async def get_status(self) -> Dict[str, any]:
         """Get relay system status."""
         return {
             "is_running": self.is_running,
+            "shard": self.shard_index,
             "active_sessions": len(self.active_sessions),
-            "message_queue_size": len(self.message_queue),
+            "messages": self.messages.get_stats(),
+            "conversations": self.cursor_client.conversations.get_stats(),
+            "storage": self.storage.get_stats(),
+            "message_log": self.message_log.get_stats() if self.message_log else None,
+            "cursor_pool": self.cursor_client.get_pool_stats(),
+            "cursor_resilience": self.cursor_client.retry_policy.get_stats(),
+            "telegram_sends": self.telegram_client.scheduler.get_stats(),
+            "context_window": self.cursor_client.context_window.get_stats() if self.cursor_client.context_window else None,
+            "response_cache": self.cursor_client.response_cache.get_stats() if self.cursor_client.response_cache else None,
+            "cursor_backends": self.cursor_client.router.get_stats(),
+            "coalescing": self.cursor_client.single_flight.get_stats() if self.cursor_client.single_flight else None,
+            "cursor_concurrency": self.cursor_client.limiter.get_stats() if self.cursor_client.limiter else None,
+            "dispatcher": self.dispatcher.get_stats(),
+            "tracing": self.tracer.get_stats(),
+            "performance": get_profile(),
             "telegram_bot_status": "active" if self.telegram_client.application else "inactive",
-            "cursor_client_status": "active" if self.cursor_client.session else "inactive"
-        }
\ No newline at end of file
+            "cursor_client_status": "active" if self.cursor_client.is_active else "inactive"
+        }
+    
+    def collect_metrics(self) -> List[MetricFamily]:
+        """Collect gauges and counters kept by relay components, for /metrics."""
+        dispatcher = self.dispatcher.get_stats()
+        resilience = self.cursor_client.retry_policy.get_stats()
+        sends = self.telegram_client.scheduler.get_stats()
+        families: List[MetricFamily] = [
+            ("relay_dispatcher_queued", "gauge", "Messages queued or being processed", [({}, dispatcher["queued"])]),
+            ("relay_dispatcher_busy_workers", "gauge", "Workers currently handling a chat", [({}, dispatcher["busy_workers"])]),
+            ("relay_messages_in_flight", "gauge", "Relay messages not yet finished", [({}, self.messages.get_stats()["in_flight"])]),
+            ("cursor_requests_in_flight", "gauge", "Outstanding Cursor API requests", [({}, self.cursor_client.router.outstanding)]),
+            ("cursor_retries_total", "counter", "Cursor API calls retried", [({}, resilience["retries"])]),
+            ("cursor_circuit_open", "gauge", "Whether the Cursor API circuit breaker is open",
+             [({}, 1 if resilience["circuit_state"] == CircuitBreaker.OPEN else 0)]),
+            ("cursor_circuit_rejections_total", "counter", "Calls rejected by the open circuit", [({}, resilience["circuit_rejected"])]),
+            ("telegram_send_queue_depth", "gauge", "Outbound Telegram sends waiting for rate limits", [({}, sends["queued"])]),
+            ("telegram_retry_after_total", "counter", "Telegram flood-control responses", [({}, sends["retry_after_events"])]),
+        ]
+        
+        router = self.cursor_client.router
+        families.extend([
+            ("cursor_backend_outstanding", "gauge", "Outstanding requests per backend",
+             [({"backend": b.name}, b.outstanding) for b in router.backends]),
+            ("cursor_backend_latency_seconds", "gauge", "Smoothed latency of successful requests per backend",
+             [({"backend": b.name}, b.latency) for b in router.backends if b.latency is not None]),
+            ("cursor_backend_failures_total", "counter", "Retryable failures per backend",
+             [({"backend": b.name}, b.failures) for b in router.backends]),
+            ("cursor_backend_failovers_total", "counter", "Requests moved to another backend after a failure",
+             [({}, router.failovers)]),
+        ])
+        limiter = self.cursor_client.limiter
+        if limiter:
+            families.extend([
+                ("cursor_concurrency_limit", "gauge", "Adaptive limit on outstanding Cursor API requests", [({}, int(limiter.limit))]),
+                ("cursor_concurrency_queued", "gauge", "Requests waiting for a slot under the limit", [({}, limiter.queued)]),
+                ("cursor_requests_shed_total", "counter", "Requests answered busy because the limit was reached", [({}, limiter.shed)]),
+            ])
+        if router.hedger:
+            families.append((
+                "cursor_hedged_requests_total", "counter", "Slow requests duplicated to another backend, and hedges that won",
+                [({"result": "sent"}, router.hedger.hedges), ({"result": "won"}, router.hedger.hedge_wins)]
+            ))
+        
+        cache = self.cursor_client.response_cache
+        if cache:
+            stats = cache.get_stats()
+            families.append((
+                "cursor_cache_events_total", "counter", "Response cache hits, misses and evictions",
+                [({"event": event}, stats[key]) for event, key in (("hit", "hits"), ("miss", "misses"), ("eviction", "evictions"))]
+            ))
+        if self.cursor_client.single_flight:
+            families.append((
+                "cursor_coalesced_requests_total", "counter", "Requests served by another identical in-flight request",
+                [({}, self.cursor_client.single_flight.followers)]
+            ))
+        return families
\ No newline at end of file
@@ -0,0 +1,93 @@
+"""
+Micro-batching of requests to a batch-capable backend.
+
+Requests submitted within a short window are collected and sent as one batch;
+each caller receives its own result. If the backend turns out not to accept
+batches, the batcher switches itself off and callers fall back to sending
+single requests.
+"""
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+from logger import get_logger
+
+logger = get_logger("request_batcher")
+
+# Sends a batch; returns one result or exception per item, in order
+BatchSender = Callable[[List[Any]], Awaitable[List[Any]]]
+
+class BatchingUnsupportedError(Exception):
+    """Raised when the backend does not accept batched requests."""
+
+class RequestBatcher:
+    """Collects requests for up to max_wait seconds or max_batch_size items."""
+
+    def __init__(self, send_batch: BatchSender, max_batch_size: int = 16, max_wait: float = 0.01):
+        if max_batch_size < 1:
+            raise ValueError("max_batch_size must be at least 1")
+        self.send_batch = send_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.supported = True
+        self._pending: List[Tuple[Any, asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._sending: Set[asyncio.Task] = set()
+        self.batches = 0
+        self.batched_requests = 0
+
+    async def submit(self, item: Any) -> Any:
+        """Add an item to the current batch and wait for its result."""
+        if not self.supported:
+            raise BatchingUnsupportedError("Batching is disabled for this backend")
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((item, future))
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait, self._flush)
+        return await future
+
+    def _flush(self):
+        """Send everything collected so far as one batch."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, []
+        task = asyncio.get_running_loop().create_task(self._send(batch))
+        self._sending.add(task)
+        task.add_done_callback(self._sending.discard)
+
+    async def _send(self, batch: List[Tuple[Any, asyncio.Future]]):
+        """Send a batch and hand each result to its caller."""
+        self.batches += 1
+        self.batched_requests += len(batch)
+        try:
+            results = await self.send_batch([item for item, _ in batch])
+        except BatchingUnsupportedError as e:
+            if self.supported:
+                self.supported = False
+                logger.warning("Backend does not support batching, sending single requests: {}", e)
+            results = [e] * len(batch)
+        except Exception as e:
+            results = [e] * len(batch)
+
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get batching statistics."""
+        return {
+            "supported": self.supported,
+            "batches": self.batches,
+            "batched_requests": self.batched_requests,
+            "avg_batch_size": round(self.batched_requests / self.batches, 2) if self.batches else 0.0,
+            "waiting": len(self._pending),
+        }
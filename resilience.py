@@ -0,0 +1,184 @@
+"""
+Retry, backoff and circuit breaking for upstream API calls.
+"""
+import asyncio
+import random
+import time
+from email.utils import parsedate_to_datetime
+from typing import Any, Awaitable, Callable, Dict, Optional, TypeVar
+from logger import get_logger
+
+logger = get_logger("resilience")
+
+T = TypeVar("T")
+
+class CursorAPIError(Exception):
+    """Error returned by, or while reaching, the Cursor API."""
+
+    def __init__(self, message: str, status: Optional[int] = None, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+    @property
+    def retryable(self) -> bool:
+        """Rate limits, server errors and transport failures are worth retrying."""
+        return self.status is None or self.status == 429 or self.status >= 500
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an upstream that is known to be failing."""
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Parse a Retry-After header given as seconds or an HTTP date."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+class RetryBudget:
+    """Caps retries to a fraction of recent request volume.
+
+    Every request deposits `ratio` tokens and every retry withdraws one, so
+    during an outage retries add at most `ratio` extra load instead of
+    multiplying it. `min_tokens` keeps a few retries available at low traffic.
+    """
+
+    def __init__(self, ratio: float = 0.2, min_tokens: float = 10.0, max_tokens: float = 100.0):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = min_tokens
+        self.exhausted = 0
+
+    def record_request(self):
+        self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def try_spend(self) -> bool:
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        self.exhausted += 1
+        return False
+
+class CircuitBreaker:
+    """Opens after consecutive failures and probes again after a cool-down."""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.rejected = 0
+        self._probe_in_flight = False
+
+    def before_call(self):
+        """Raise CircuitOpenError if the call should not go upstream."""
+        if self.state == self.OPEN:
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                self.rejected += 1
+                raise CircuitOpenError("Cursor API circuit is open")
+            self.state = self.HALF_OPEN
+
+        if self.state == self.HALF_OPEN:
+            # Let exactly one probe through; everyone else fails fast
+            if self._probe_in_flight:
+                self.rejected += 1
+                raise CircuitOpenError("Cursor API circuit is half-open")
+            self._probe_in_flight = True
+
+    def release_probe(self):
+        """Free the half-open probe slot without recording an outcome."""
+        self._probe_in_flight = False
+
+    def record_success(self):
+        self.consecutive_failures = 0
+        self._probe_in_flight = False
+        if self.state != self.CLOSED:
+            logger.info("Cursor API circuit closed")
+        self.state = self.CLOSED
+
+    def record_failure(self):
+        self.consecutive_failures += 1
+        self._probe_in_flight = False
+        if self.state == self.HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                logger.warning("Cursor API circuit opened after {} failures", self.consecutive_failures)
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+class RetryPolicy:
+    """Exponential backoff with full jitter, a retry budget and a circuit breaker."""
+
+    def __init__(self, max_attempts: int = 3, base_delay: float = 0.5, max_delay: float = 10.0,
+                 budget: Optional[RetryBudget] = None, breaker: Optional[CircuitBreaker] = None):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget = budget or RetryBudget()
+        self.breaker = breaker or CircuitBreaker()
+        self.retries = 0
+
+    def backoff(self, attempt: int, error: CursorAPIError) -> float:
+        """Delay before the given retry attempt (1-based)."""
+        if error.retry_after is not None:
+            return error.retry_after
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+    async def call(self, func: Callable[[], Awaitable[T]],
+                   can_retry: Callable[[], bool] = lambda: True) -> T:
+        """Run func, retrying retryable CursorAPIErrors.
+
+        A Retry-After longer than max_delay is honoured by not retrying at all,
+        since retrying any earlier would only be refused again.
+        can_retry is checked before each retry so callers can stop retrying once
+        a retry would no longer be safe (e.g. after partial streamed output).
+        """
+        self.budget.record_request()
+        attempt = 0
+        while True:
+            attempt += 1
+            self.breaker.before_call()
+            try:
+                result = await func()
+            except CursorAPIError as e:
+                # Client errors mean the upstream is healthy; don't trip the breaker
+                if e.retryable:
+                    self.breaker.record_failure()
+                else:
+                    self.breaker.record_success()
+                if (not e.retryable or attempt >= self.max_attempts or not can_retry()
+                        or (e.retry_after is not None and e.retry_after > self.max_delay)
+                        or self.breaker.state == CircuitBreaker.OPEN or not self.budget.try_spend()):
+                    raise
+                delay = self.backoff(attempt, e)
+                self.retries += 1
+                logger.warning("Retrying Cursor API call in {:.2f}s (attempt {}): {}", delay, attempt + 1, e)
+                await asyncio.sleep(delay)
+            except BaseException:
+                # Not an upstream verdict (cancellation, local bug)
+                self.breaker.release_probe()
+                raise
+            else:
+                self.breaker.record_success()
+                return result
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get retry and breaker statistics."""
+        return {
+            "circuit_state": self.breaker.state,
+            "consecutive_failures": self.breaker.consecutive_failures,
+            "circuit_rejected": self.breaker.rejected,
+            "retries": self.retries,
+            "retry_budget_tokens": round(self.budget.tokens, 2),
+            "retry_budget_exhausted": self.budget.exhausted,
+        }
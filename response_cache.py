@@ -0,0 +1,108 @@
+"""
+Exact-match cache of Cursor responses for repeated prompts.
+
+Prompts are normalized (case, surrounding and repeated whitespace) and keyed
+together with the model and the parts of the context that change the answer.
+Only prompts that open a conversation are cached: once a conversation has
+turns, the same words can mean something else ("continue", "what did I just
+ask?"). Opening prompts don't depend on the chat or user, so their replies
+are shared across chats.
+Entries expire after a TTL and are evicted least-recently-used once the entry
+or byte limits are exceeded.
+"""
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Iterable, Optional, Set, Tuple
+from models import CursorMessage
+
+# Rough per-entry cost of the key, the pydantic object and bookkeeping
+ENTRY_OVERHEAD_BYTES = 768
+
+# Context fields that can change the answer; user identity deliberately isn't one
+KEY_CONTEXT_FIELDS = ("message_type",)
+
+def normalize_prompt(text: str) -> str:
+    """Normalize a prompt so trivially different spellings share a key."""
+    return " ".join(text.split()).casefold()
+
+def make_request_key(message: str, model: str, context: Optional[Dict[str, Any]]) -> Hashable:
+    """Build the key under which requests count as identical."""
+    context = context or {}
+    return (model, normalize_prompt(message)) + tuple(context.get(field) for field in KEY_CONTEXT_FIELDS)
+
+class ResponseCache:
+    """TTL and size-bounded LRU cache of Cursor responses."""
+
+    def __init__(self, ttl: float = 3600.0, max_entries: int = 10000,
+                 max_bytes: int = 20 * 1024 * 1024, bypass_chats: Iterable[int] = ()):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.bypass_chats: Set[int] = set(bypass_chats)
+        self._entries: "OrderedDict[Hashable, Tuple[CursorMessage, float, int]]" = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bypassed = 0
+
+    def allows_chat(self, chat_id: int) -> bool:
+        """Whether responses for this chat may be served from the cache."""
+        if chat_id in self.bypass_chats:
+            self.bypassed += 1
+            return False
+        return True
+
+    def get(self, key: Hashable) -> Optional[CursorMessage]:
+        """Get a fresh cached response, or None."""
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        cursor_msg, expires_at, _ = entry
+        if expires_at <= time.monotonic():
+            self._remove(key)
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return cursor_msg
+
+    def put(self, key: Hashable, cursor_msg: CursorMessage):
+        """Cache a response."""
+        if not cursor_msg.content:
+            return
+        if key in self._entries:
+            self._remove(key)
+
+        size = ENTRY_OVERHEAD_BYTES + len(cursor_msg.content) + len(key[1])
+        self._entries[key] = (cursor_msg, time.monotonic() + self.ttl, size)
+        self.total_bytes += size
+
+        while self._entries and (len(self._entries) > self.max_entries or self.total_bytes > self.max_bytes):
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _remove(self, key: Hashable):
+        _, _, size = self._entries.pop(key)
+        self.total_bytes -= size
+
+    def clear(self):
+        """Drop all cached responses."""
+        self._entries.clear()
+        self.total_bytes = 0
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get cache statistics."""
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "total_bytes": self.total_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "bypassed": self.bypassed,
+        }
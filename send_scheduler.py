@@ -0,0 +1,157 @@
+"""
+Outbound pacing for Telegram Bot API calls.
+
+Telegram allows roughly 30 messages per second overall, one per second in a
+private chat and 20 per minute in a group. Sends are delayed to fit those
+limits instead of being rejected with flood-control errors.
+"""
+import asyncio
+import time
+from datetime import timedelta
+from typing import Any, Awaitable, Callable, Dict, TypeVar
+from telegram.error import RetryAfter
+from logger import get_logger
+
+logger = get_logger("send_scheduler")
+
+T = TypeVar("T")
+
+class TokenBucket:
+    """Token bucket that hands out reservations instead of polling."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def available(self) -> bool:
+        """Whether a token could be taken without waiting."""
+        self._refill(time.monotonic())
+        return self.tokens >= 1
+
+    def reserve(self) -> float:
+        """Take a token, returning how long to wait before using it.
+
+        Tokens may go negative; each caller waits for its own slot, so waiters
+        are served in reservation order.
+        """
+        self._refill(time.monotonic())
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def penalize(self, seconds: float):
+        """Block the bucket for the given time, e.g. after a RetryAfter."""
+        self._refill(time.monotonic())
+        self.tokens = min(self.tokens, 0.0) - seconds * self.rate
+
+class _ChatState:
+    """Pacing state for a single chat."""
+
+    __slots__ = ("bucket", "lock", "waiting", "last_used")
+
+    def __init__(self, bucket: TokenBucket):
+        self.bucket = bucket
+        self.lock = asyncio.Lock()
+        self.waiting = 0
+        self.last_used = time.monotonic()
+
+def retry_after_seconds(error: RetryAfter) -> float:
+    """Read RetryAfter's delay, which is an int or a timedelta depending on version."""
+    value = error.retry_after
+    if isinstance(value, timedelta):
+        return value.total_seconds()
+    return float(value)
+
+class SendScheduler:
+    """Paces sends with a global bucket and per-chat buckets, in per-chat order."""
+
+    def __init__(self, global_rate: float = 30.0, chat_rate: float = 1.0,
+                 group_rate_per_minute: float = 20.0, max_retries: int = 3,
+                 idle_chat_ttl: float = 300.0):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate_per_minute / 60.0
+        self.max_retries = max_retries
+        self.idle_chat_ttl = idle_chat_ttl
+        self._chats: Dict[int, _ChatState] = {}
+        self._sweep_at = 1024
+        self.queued = 0
+        self.sent = 0
+        self.retry_after_events = 0
+        self.total_latency = 0.0
+
+    def _chat_state(self, chat_id: int) -> _ChatState:
+        state = self._chats.get(chat_id)
+        if state is None:
+            # Negative ids are groups, supergroups and channels
+            rate = self.group_rate if chat_id < 0 else self.chat_rate
+            state = _ChatState(TokenBucket(rate, 1.0))
+            self._chats[chat_id] = state
+            if len(self._chats) > self._sweep_at:
+                self._sweep()
+        return state
+
+    def _sweep(self):
+        """Forget idle chats so per-chat state does not grow without bound."""
+        cutoff = time.monotonic() - self.idle_chat_ttl
+        for chat_id in [c for c, s in self._chats.items() if not s.waiting and s.last_used < cutoff]:
+            del self._chats[chat_id]
+        self._sweep_at = max(1024, 2 * len(self._chats))
+
+    def can_send_now(self, chat_id: int) -> bool:
+        """Whether a send to this chat would go out without queuing."""
+        state = self._chats.get(chat_id)
+        if state and (state.waiting or not state.bucket.available()):
+            return False
+        return self.global_bucket.available()
+
+    async def run(self, chat_id: int, send: Callable[[], Awaitable[T]]) -> T:
+        """Run a send for a chat once the rate limits allow it."""
+        state = self._chat_state(chat_id)
+        state.waiting += 1
+        self.queued += 1
+        started = time.monotonic()
+        try:
+            # The lock keeps sends to one chat in order, even across retries
+            async with state.lock:
+                attempt = 0
+                while True:
+                    attempt += 1
+                    await self._wait(state.bucket.reserve())
+                    await self._wait(self.global_bucket.reserve())
+                    try:
+                        result = await send()
+                        self.sent += 1
+                        return result
+                    except RetryAfter as e:
+                        delay = retry_after_seconds(e)
+                        self.retry_after_events += 1
+                        state.bucket.penalize(delay)
+                        if attempt > self.max_retries:
+                            raise
+                        logger.warning("Telegram flood control for chat {}, retrying in {:.0f}s", chat_id, delay)
+        finally:
+            state.waiting -= 1
+            state.last_used = time.monotonic()
+            self.queued -= 1
+            self.total_latency += time.monotonic() - started
+
+    async def _wait(self, delay: float):
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get scheduler statistics."""
+        return {
+            "queued": self.queued,
+            "max_chat_queue": max((s.waiting for s in self._chats.values()), default=0),
+            "tracked_chats": len(self._chats),
+            "sent": self.sent,
+            "retry_after_events": self.retry_after_events,
+            "avg_send_latency": round(self.total_latency / self.sent, 4) if self.sent else 0.0,
+        }
@@ -0,0 +1,365 @@
+"""
+Sharded relay deployment: one front process, N worker processes.
+
+The front process receives Telegram webhook updates and routes each one by
+chat id to a worker process running its own TelegramCursorRelay, so a chat
+always lands on the same worker and keeps its order. Updates travel over a
+Unix socket per worker as newline-delimited JSON frames and stay in the
+front's outbox until the worker acknowledges them; when a worker restarts,
+unacknowledged updates are replayed in order. Delivery is at-least-once.
+
+Run a worker by hand with: python sharding.py <index>
+"""
+import asyncio
+import os
+import signal
+import sys
+from collections import OrderedDict
+from itertools import takewhile
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set
+from relay import TelegramCursorRelay
+from telegram_client import TelegramClient
+from metrics import MetricFamily
+from performance import install_event_loop, json_dumps, json_loads
+from logger import get_logger, flush_logs, configure_file_logs
+from config import settings
+
+logger = get_logger("sharding")
+
+# Largest frame accepted on the IPC sockets; Telegram updates are far smaller
+FRAME_LIMIT = 4 * 1024 * 1024
+RECONNECT_DELAY = 0.2
+RESPAWN_DELAY = 1.0
+
+class ShardUnavailableError(Exception):
+    """Raised when a shard's outbox is full and the update cannot be accepted."""
+
+def shard_for(chat_id: int, shards: int) -> int:
+    """Pick the shard that owns a chat; stable across processes and restarts."""
+    return chat_id % shards
+
+def update_chat_id(data: Dict[str, Any]) -> int:
+    """Find the chat a raw Telegram update belongs to, or 0 if it has none."""
+    for key, value in data.items():
+        if key == "update_id" or not isinstance(value, dict):
+            continue
+        chat = value.get("chat") or (value.get("message") or {}).get("chat")
+        if chat:
+            return chat["id"]
+        sender = value.get("from")
+        if sender:
+            return sender["id"]
+    return 0
+
+def shard_socket_path(index: int) -> str:
+    """Unix socket a shard worker listens on."""
+    return os.path.join(settings.relay_shard_socket_dir, f"shard-{index}.sock")
+
+def shard_file_path(path: str, index: int) -> str:
+    """Per-shard variant of a data file path, e.g. relay.db -> relay-shard0.db."""
+    path = Path(path)
+    return str(path.with_name(f"{path.stem}-shard{index}{path.suffix}"))
+
+def _encode(frame: Dict[str, Any]) -> bytes:
+    return json_dumps(frame) + b"\n"
+
+class ShardLink:
+    """The front's connection to one worker: outbox, delivery and process supervision."""
+
+    def __init__(self, index: int, socket_path: str, max_pending: int = 10000,
+                 command: Optional[List[str]] = None):
+        self.index = index
+        self.socket_path = socket_path
+        self.max_pending = max_pending
+        # Worker process to supervise; None when the worker is managed elsewhere
+        self.command = command
+        self.process: Optional[asyncio.subprocess.Process] = None
+        # Sequence number -> update, in send order, until acknowledged
+        self.pending: "OrderedDict[int, Dict[str, Any]]" = OrderedDict()
+        self._seq = 0
+        self._wakeup = asyncio.Event()
+        self._connected = asyncio.Event()
+        self._tasks: List[asyncio.Task] = []
+        self._stopping = False
+        self.delivered = 0
+        self.replayed = 0
+        self.restarts = 0
+
+    @property
+    def connected(self) -> bool:
+        return self._connected.is_set()
+
+    def submit(self, update: Dict[str, Any]):
+        """Queue an update for delivery to the worker."""
+        if len(self.pending) >= self.max_pending:
+            raise ShardUnavailableError(f"Shard {self.index} has {len(self.pending)} undelivered updates")
+        self._seq += 1
+        self.pending[self._seq] = update
+        self._wakeup.set()
+
+    async def start(self):
+        """Start the worker process (if supervised) and the delivery loop."""
+        self._stopping = False
+        self._tasks = [asyncio.create_task(self._deliver(), name=f"shard-{self.index}-deliver")]
+        if self.command:
+            self._tasks.append(asyncio.create_task(self._supervise(), name=f"shard-{self.index}-supervise"))
+
+    async def stop(self, drain_timeout: float = 10.0):
+        """Wait for the outbox to drain, then stop the worker and delivery loop."""
+        self._stopping = True
+        deadline = asyncio.get_running_loop().time() + drain_timeout
+        while self.pending and self.connected and asyncio.get_running_loop().time() < deadline:
+            await asyncio.sleep(0.05)
+        if self.pending:
+            logger.warning("Shard {} stopped with {} undelivered updates", self.index, len(self.pending))
+
+        await self._terminate()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _terminate(self, timeout: float = 15.0):
+        """Ask the worker to shut down gracefully, killing it if it doesn't."""
+        process = self.process
+        if not process or process.returncode is not None:
+            return
+        process.terminate()
+        try:
+            await asyncio.wait_for(process.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Shard {} worker did not exit, killing it", self.index)
+            process.kill()
+            await process.wait()
+
+    async def _supervise(self):
+        """Keep the worker process running, restarting it when it exits."""
+        while True:
+            self.process = await asyncio.create_subprocess_exec(*self.command, start_new_session=True)
+            logger.info("Shard {} worker started (pid {})", self.index, self.process.pid)
+            returncode = await self.process.wait()
+            if self._stopping:
+                return
+            self.restarts += 1
+            logger.warning("Shard {} worker exited with code {}, restarting", self.index, returncode)
+            await asyncio.sleep(RESPAWN_DELAY)
+
+    async def _deliver(self):
+        """Connect to the worker and stream the outbox, reconnecting as needed."""
+        reconnecting = False
+        while True:
+            try:
+                reader, writer = await asyncio.open_unix_connection(self.socket_path, limit=FRAME_LIMIT)
+            except OSError:
+                await asyncio.sleep(RECONNECT_DELAY)
+                continue
+
+            if reconnecting and self.pending:
+                self.replayed += len(self.pending)
+                logger.info("Shard {} connected, replaying {} updates", self.index, len(self.pending))
+            self._connected.set()
+            try:
+                await self._stream(reader, writer)
+            except (ConnectionError, OSError) as e:
+                logger.warning("Shard {} connection lost: {}", self.index, e)
+            finally:
+                self._connected.clear()
+                writer.close()
+            reconnecting = True
+            await asyncio.sleep(RECONNECT_DELAY)
+
+    async def _stream(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Send every pending update once, in order, until the connection drops."""
+        acks = asyncio.create_task(self._read_acks(reader))
+        last_sent = 0
+        try:
+            while True:
+                self._wakeup.clear()
+                # Unsent updates are always the newest ones, at the tail of the outbox
+                unsent = list(takewhile(lambda seq: seq > last_sent, reversed(self.pending)))
+                for seq in reversed(unsent):
+                    writer.write(_encode({"seq": seq, "update": self.pending[seq]}))
+                    last_sent = seq
+                await writer.drain()
+
+                wakeup = asyncio.create_task(self._wakeup.wait())
+                done, _ = await asyncio.wait({acks, wakeup}, return_when=asyncio.FIRST_COMPLETED)
+                wakeup.cancel()
+                if acks in done:
+                    acks.result()
+                    raise ConnectionError("worker closed the connection")
+        finally:
+            acks.cancel()
+
+    async def _read_acks(self, reader: asyncio.StreamReader):
+        """Drop acknowledged updates from the outbox."""
+        while True:
+            line = await reader.readline()
+            if not line:
+                return
+            if self.pending.pop(json_loads(line)["ack"], None) is not None:
+                self.delivered += 1
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get delivery statistics for this shard."""
+        return {
+            "index": self.index,
+            "pid": self.process.pid if self.process and self.process.returncode is None else None,
+            "connected": self.connected,
+            "pending": len(self.pending),
+            "delivered": self.delivered,
+            "replayed": self.replayed,
+            "restarts": self.restarts,
+        }
+
+class ShardRouter:
+    """Front process of a sharded deployment.
+
+    Exposes the same lifecycle and webhook interface as TelegramCursorRelay so
+    the web server can use either.
+    """
+
+    def __init__(self, shards: Optional[int] = None):
+        shards = shards or settings.relay_shards
+        if shards < 1:
+            raise ValueError("shards must be at least 1")
+        if settings.telegram_mode.lower() != "webhook":
+            raise ValueError("Sharded relay requires TELEGRAM_MODE=webhook")
+        script = os.path.abspath(__file__)
+        self.links = [
+            ShardLink(i, shard_socket_path(i), settings.relay_shard_max_pending,
+                      command=[sys.executable, script, str(i), str(shards)])
+            for i in range(shards)
+        ]
+        # Only used to register the webhook; updates are handled by the workers
+        self.telegram_client = TelegramClient()
+        self.is_running = False
+
+    async def initialize(self):
+        """Initialize the front process."""
+        os.makedirs(settings.relay_shard_socket_dir, exist_ok=True)
+        await self.telegram_client.initialize()
+
+    async def start(self):
+        """Start the workers, then register the webhook."""
+        for link in self.links:
+            await link.start()
+        await self.telegram_client.start_webhook()
+        self.is_running = True
+        logger.info("Sharded relay started with {} workers", len(self.links))
+
+    async def stop(self):
+        """Deliver what is queued, then stop the workers."""
+        self.is_running = False
+        await self.telegram_client.shutdown()
+        await asyncio.gather(*(link.stop() for link in self.links))
+        logger.info("Sharded relay stopped")
+
+    async def handle_webhook_update(self, data: Dict[str, Any]):
+        """Route a webhook update to the worker that owns its chat."""
+        self.links[shard_for(update_chat_id(data), len(self.links))].submit(data)
+
+    async def get_status(self) -> Dict[str, Any]:
+        """Get front process status."""
+        return {
+            "is_running": self.is_running,
+            "shards": [link.get_stats() for link in self.links],
+        }
+
+    def collect_metrics(self) -> List[MetricFamily]:
+        """Collect per-shard delivery metrics, for /metrics."""
+        def per_shard(key: str):
+            return [({"shard": str(link.index)}, link.get_stats()[key]) for link in self.links]
+        return [
+            ("relay_shard_connected", "gauge", "Whether the front is connected to the shard worker", per_shard("connected")),
+            ("relay_shard_pending", "gauge", "Updates not yet acknowledged by the shard worker", per_shard("pending")),
+            ("relay_shard_delivered_total", "counter", "Updates acknowledged by the shard worker", per_shard("delivered")),
+            ("relay_shard_restarts_total", "counter", "Shard worker process restarts", per_shard("restarts")),
+        ]
+
+class ShardWorker:
+    """Worker process of a sharded deployment: a relay fed over a Unix socket."""
+
+    def __init__(self, index: int):
+        self.index = index
+        self.socket_path = shard_socket_path(index)
+        self.relay = TelegramCursorRelay(shard_index=index)
+        self._connections: Set[asyncio.StreamWriter] = set()
+        self._stopping = False
+
+    async def run(self, stop: asyncio.Event):
+        """Serve updates until stop is set, then shut down gracefully."""
+        await self.relay.initialize()
+        await self.relay.start()
+        server = await asyncio.start_unix_server(self._serve, self.socket_path, limit=FRAME_LIMIT)
+        logger.info("Shard {} worker listening on {}", self.index, self.socket_path)
+        try:
+            await stop.wait()
+        finally:
+            # Unacknowledged updates are replayed by the front to the next worker
+            self._stopping = True
+            server.close()
+            for writer in list(self._connections):
+                writer.close()
+            await self.relay.stop()
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Handle frames from the front in order, acknowledging each."""
+        self._connections.add(writer)
+        try:
+            while not self._stopping:
+                line = await reader.readline()
+                if not line:
+                    break
+                frame = json_loads(line)
+                try:
+                    await self.relay.handle_webhook_update(frame["update"])
+                except Exception as e:
+                    # Acknowledge anyway; replaying a bad update would fail again
+                    logger.error("Shard {} failed to handle update: {}", self.index, e)
+                if self._stopping:
+                    break
+                writer.write(_encode({"ack": frame["seq"]}))
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self._connections.discard(writer)
+            writer.close()
+
+async def _watch_parent(stop: asyncio.Event):
+    """Stop when the front process that spawned this worker goes away."""
+    parent = os.getppid()
+    while not stop.is_set():
+        if os.getppid() != parent:
+            logger.warning("Front process exited, stopping shard worker")
+            stop.set()
+        await asyncio.sleep(1.0)
+
+async def run_worker(index: int, shards: int):
+    """Entry point of a shard worker process."""
+    # Each worker keeps its own sessions, message log, traces and log files
+    settings.storage_path = shard_file_path(settings.storage_path, index)
+    settings.tracing_jsonl_path = shard_file_path(settings.tracing_jsonl_path, index)
+    settings.relay_log_path = shard_file_path(settings.relay_log_path, index)
+    settings.log_file_path = shard_file_path(settings.log_file_path, index)
+    settings.log_error_path = shard_file_path(settings.log_error_path, index)
+    configure_file_logs()
+    # The bot's global send limit is shared by all workers; a chat only lives on one
+    settings.telegram_global_rate /= shards
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stop.set)
+    watcher = asyncio.create_task(_watch_parent(stop))
+    try:
+        await ShardWorker(index).run(stop)
+    finally:
+        watcher.cancel()
+        await flush_logs()
+
+if __name__ == "__main__":
+    install_event_loop()
+    asyncio.run(run_worker(int(sys.argv[1]), int(sys.argv[2])))
@@ -0,0 +1,135 @@
+"""
+Simulated upstream behaviour for the mock backend and the benchmark stub.
+
+A profile describes how a Cursor-like upstream behaves: how long until the
+first token, how fast tokens are generated, how often it answers 429, 5xx
+or hangs until the client times out, and how many requests it serves at
+once before queuing the rest. Profiles let production slowdowns be
+reproduced offline when tuning workers, timeouts and retries.
+"""
+import bisect
+import itertools
+import json
+import math
+import random
+from typing import Callable, Dict, List, Tuple
+from pydantic import BaseModel, field_validator
+
+# Latency sampler returning seconds
+LatencySampler = Callable[[], float]
+
+def _histogram_sampler(buckets: List[Tuple[float, float]]) -> LatencySampler:
+    """Sample from bucket (upper bound, count) pairs, uniformly within a bucket."""
+    buckets = sorted(buckets)
+    bounds = [bound for bound, _ in buckets]
+    cumulative = list(itertools.accumulate(count for _, count in buckets))
+    if not cumulative or cumulative[-1] <= 0:
+        raise ValueError("Latency histogram has no samples")
+
+    def sample() -> float:
+        index = bisect.bisect_right(cumulative, random.random() * cumulative[-1])
+        index = min(index, len(bounds) - 1)
+        lower = bounds[index - 1] if index else 0.0
+        return random.uniform(lower, bounds[index])
+
+    return sample
+
+def _load_recorded(path: str) -> LatencySampler:
+    """Sampler for a JSON file of recorded latencies or {upper bound: count} buckets."""
+    with open(path) as f:
+        recorded = json.load(f)
+    if isinstance(recorded, dict):
+        return _histogram_sampler([(float(bound), float(count)) for bound, count in recorded.items()])
+    if not recorded:
+        raise ValueError(f"No recorded latencies in {path}")
+    samples = [float(value) for value in recorded]
+    return lambda: random.choice(samples)
+
+def parse_latency(spec: str) -> LatencySampler:
+    """Parse a latency distribution given in seconds.
+
+    constant:S (or fixed:S), uniform:LOW,HIGH, exponential:MEAN,
+    lognormal:MEDIAN,SIGMA, histogram:BOUND=COUNT,... for recorded buckets,
+    or histogram:@FILE for a JSON file of recorded latencies or buckets.
+    """
+    kind, _, params = spec.partition(":")
+    if kind == "histogram":
+        if params.startswith("@"):
+            return _load_recorded(params[1:])
+        try:
+            buckets = [tuple(float(part) for part in bucket.split("=")) for bucket in params.split(",")]
+        except ValueError:
+            raise ValueError(f"Invalid latency histogram: {spec}") from None
+        if any(len(bucket) != 2 for bucket in buckets):
+            raise ValueError(f"Invalid latency histogram: {spec}")
+        return _histogram_sampler(buckets)
+
+    try:
+        values = [float(value) for value in params.split(",") if value]
+    except ValueError:
+        raise ValueError(f"Invalid latency distribution: {spec}") from None
+    if kind in ("constant", "fixed") and len(values) == 1:
+        return lambda: values[0]
+    if kind == "uniform" and len(values) == 2:
+        return lambda: random.uniform(values[0], values[1])
+    if kind == "exponential" and len(values) == 1:
+        return lambda: random.expovariate(1 / values[0])
+    if kind == "lognormal" and len(values) == 2:
+        return lambda: random.lognormvariate(math.log(values[0]), values[1])
+    raise ValueError(f"Invalid latency distribution: {spec}")
+
+class SimulationProfile(BaseModel):
+    """How a simulated upstream responds."""
+    # Time until the first token
+    latency: str = "constant:1.0"
+    # Tokens generated per second after the first; 0 returns the whole reply at once
+    token_rate: float = 0.0
+    # Tokens per streamed chunk
+    chunk_tokens: int = 8
+    # Fractions of requests answered with a server error, a 429 or no answer at all
+    error_rate: float = 0.0
+    error_status: int = 503
+    rate_limit_rate: float = 0.0
+    retry_after: float = 1.0
+    timeout_rate: float = 0.0
+    # How long a request that gets no answer hangs before the client gives up
+    timeout_after: float = 30.0
+    # Requests served at once; the rest queue as they would upstream. 0 is unlimited
+    max_concurrency: int = 0
+
+    @field_validator("latency")
+    @classmethod
+    def validate_latency(cls, value: str) -> str:
+        parse_latency(value)
+        return value
+
+    @classmethod
+    def named(cls, name: str, **overrides) -> "SimulationProfile":
+        """A built-in profile with some fields overridden."""
+        if name not in PROFILES:
+            raise ValueError(f"Unknown simulation profile: {name}")
+        return cls(**{**PROFILES[name], **overrides})
+
+PROFILES: Dict[str, Dict] = {
+    # The historical mock: a flat one-second answer
+    "default": {},
+    "instant": {"latency": "constant:0"},
+    # Typical healthy upstream: long-tailed time to first token, steady generation
+    "production": {
+        "latency": "lognormal:0.6,0.5",
+        "token_rate": 60.0,
+        "error_rate": 0.002,
+        "rate_limit_rate": 0.005,
+        "max_concurrency": 64,
+    },
+    # Upstream under strain: slower, error-prone, and queuing early
+    "degraded": {
+        "latency": "lognormal:2.5,0.9",
+        "token_rate": 15.0,
+        "error_rate": 0.05,
+        "rate_limit_rate": 0.05,
+        "retry_after": 5.0,
+        "timeout_rate": 0.02,
+        "max_concurrency": 16,
+    },
+}
@@ -0,0 +1,109 @@
+"""
+Coalescing of identical concurrent requests.
+
+While a request for a key is in flight, later callers with the same key wait
+for that request instead of starting their own. Streamed chunks are fanned out
+to every waiter, including ones that join after streaming has started.
+"""
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Tuple, TypeVar
+from logger import get_logger
+
+logger = get_logger("single_flight")
+
+T = TypeVar("T")
+ChunkCallback = Callable[[str], Awaitable[None]]
+
+class _Flight:
+    """A request in progress and everyone waiting on it."""
+
+    __slots__ = ("future", "chunks", "listeners")
+
+    def __init__(self, future: asyncio.Future):
+        self.future = future
+        self.chunks: List[str] = []
+        self.listeners: List[ChunkCallback] = []
+
+class SingleFlight:
+    """Share one call among concurrent callers with the same key."""
+
+    def __init__(self):
+        self._flights: Dict[Hashable, _Flight] = {}
+        self.leaders = 0
+        self.followers = 0
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._flights)
+
+    async def do(self, key: Hashable, func: Callable[[ChunkCallback], Awaitable[T]],
+                 on_chunk: Optional[ChunkCallback] = None) -> Tuple[T, bool]:
+        """Run func once per key; return its result and whether it was shared.
+
+        func receives a chunk callback that forwards to all waiters.
+        """
+        flight = self._flights.get(key)
+        if flight is not None:
+            return await self._follow(flight, on_chunk), True
+
+        flight = _Flight(asyncio.get_running_loop().create_future())
+        self._flights[key] = flight
+        self.leaders += 1
+        if on_chunk:
+            flight.listeners.append(on_chunk)
+
+        async def fan_out(chunk: str):
+            flight.chunks.append(chunk)
+            results = await asyncio.gather(
+                *(listener(chunk) for listener in list(flight.listeners)),
+                return_exceptions=True
+            )
+            for result in results:
+                if isinstance(result, Exception):
+                    logger.warning("Chunk listener failed: {}", result)
+
+        try:
+            result = await func(fan_out)
+        except BaseException as e:
+            # Followers must not see the leader's cancellation as their own
+            error = e if isinstance(e, Exception) else RuntimeError("Shared request was cancelled")
+            flight.future.set_exception(error)
+            # Mark retrieved so an unobserved failure doesn't log a warning
+            flight.future.exception()
+            raise
+        else:
+            flight.future.set_result(result)
+            return result, False
+        finally:
+            del self._flights[key]
+
+    async def _follow(self, flight: _Flight, on_chunk: Optional[ChunkCallback]) -> Any:
+        """Wait on another caller's flight, receiving its chunks."""
+        self.followers += 1
+        listener = None
+        if on_chunk:
+            lock = asyncio.Lock()
+            backlog = "".join(flight.chunks)
+
+            async def listener(chunk: str):
+                async with lock:
+                    await on_chunk(chunk)
+
+            # Registered before any await, so no chunk is missed or reordered
+            flight.listeners.append(listener)
+            if backlog:
+                async with lock:
+                    await on_chunk(backlog)
+        try:
+            return await asyncio.shield(flight.future)
+        finally:
+            if listener is not None and listener in flight.listeners:
+                flight.listeners.remove(listener)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get coalescing statistics."""
+        return {
+            "in_flight": len(self._flights),
+            "leaders": self.leaders,
+            "followers": self.followers,
+        }
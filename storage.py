@@ -0,0 +1,286 @@
+"""
+Persistence for chat sessions and conversation history.
+
+Writes are buffered in memory and committed in batches by a background task,
+so the hot path never waits on disk. Reads happen lazily, per chat or
+conversation, the first time it is accessed after a restart.
+"""
+import asyncio
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+from models import ChatSession, CursorMessage
+from logger import get_logger
+from config import settings
+
+logger = get_logger("storage")
+
+class SessionStorage:
+    """Storage interface; this base implementation persists nothing."""
+
+    async def initialize(self):
+        """Open the backend and start background work."""
+
+    async def close(self):
+        """Flush pending writes and release the backend."""
+
+    async def flush(self):
+        """Commit all pending writes."""
+
+    def save_session(self, session: ChatSession):
+        """Schedule a session upsert."""
+
+    def append_message(self, conversation_id: str, message: CursorMessage):
+        """Schedule a message append to a conversation's history."""
+
+    def delete_conversation(self, conversation_id: str):
+        """Schedule deletion of a conversation's history."""
+
+    async def load_session(self, chat_id: int) -> Optional[ChatSession]:
+        """Load a stored session for a chat."""
+        return None
+
+    async def load_history(self, conversation_id: str, limit: int = 50) -> List[CursorMessage]:
+        """Load the most recent messages of a conversation, oldest first."""
+        return []
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get storage statistics."""
+        return {"backend": "none"}
+
+class SQLiteStorage(SessionStorage):
+    """SQLite backend in WAL mode with batched background writes."""
+
+    def __init__(self, path: str = "data/relay.db", flush_interval: float = 0.5,
+                 max_batch_size: int = 500):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.max_batch_size = max_batch_size
+        self._conn: Optional[sqlite3.Connection] = None
+        # A single thread owns the connection, so no locking is needed
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._writer: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._flush_lock: Optional[asyncio.Lock] = None
+        # Pending writes: sessions are coalesced per chat, history ops keep order
+        self._pending_sessions: Dict[int, ChatSession] = {}
+        self._pending_history: List[Tuple[str, str, Optional[CursorMessage]]] = []
+        self._pending_conversations: Dict[str, int] = {}
+        self.batches_written = 0
+        self.rows_written = 0
+
+    async def initialize(self):
+        """Open the database and start the writer task."""
+        if self._conn:
+            return
+
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite-storage")
+        self._conn = await self._run(self._open)
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._writer = asyncio.create_task(self._write_loop())
+        logger.info("SQLite storage opened at {}", self.path)
+
+    def _open(self) -> sqlite3.Connection:
+        """Open the connection and create the schema."""
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS sessions (
+                chat_id INTEGER PRIMARY KEY,
+                data TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                conversation_id TEXT NOT NULL,
+                data TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_messages_conversation
+                ON messages (conversation_id, id);
+        """)
+        conn.commit()
+        return conn
+
+    async def _run(self, func, *args):
+        """Run a blocking database call on the storage thread."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    async def close(self):
+        """Flush pending writes, stop the writer and close the database."""
+        if not self._conn:
+            return
+
+        self._writer.cancel()
+        await asyncio.gather(self._writer, return_exceptions=True)
+        await self.flush()
+
+        await self._run(self._conn.close)
+        self._executor.shutdown(wait=True)
+        self._conn = None
+        self._executor = None
+        self._writer = None
+        logger.info("SQLite storage closed")
+
+    def _has_pending(self) -> bool:
+        return bool(self._pending_sessions or self._pending_history)
+
+    def _schedule(self):
+        """Wake the writer early once a full batch is waiting."""
+        if self._wakeup and len(self._pending_sessions) + len(self._pending_history) >= self.max_batch_size:
+            self._wakeup.set()
+
+    def save_session(self, session: ChatSession):
+        """Schedule a session upsert; the latest state wins."""
+        self._pending_sessions[session.telegram_chat_id] = session
+        self._schedule()
+
+    def append_message(self, conversation_id: str, message: CursorMessage):
+        """Schedule a message append."""
+        self._pending_history.append(("append", conversation_id, message))
+        self._pending_conversations[conversation_id] = self._pending_conversations.get(conversation_id, 0) + 1
+        self._schedule()
+
+    def delete_conversation(self, conversation_id: str):
+        """Schedule deletion of a conversation's history."""
+        self._pending_history.append(("delete", conversation_id, None))
+        self._pending_conversations[conversation_id] = self._pending_conversations.get(conversation_id, 0) + 1
+        self._schedule()
+
+    async def _write_loop(self):
+        """Periodically commit pending writes."""
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error("Failed to write storage batch: {}", e)
+
+    async def flush(self):
+        """Commit all pending writes in a single transaction.
+
+        If the transaction fails, the writes stay pending for the next flush.
+        """
+        if not self._conn:
+            return
+
+        async with self._flush_lock:
+            if not self._has_pending():
+                return
+
+            sessions, self._pending_sessions = self._pending_sessions, {}
+            history, self._pending_history = self._pending_history, []
+            self._pending_conversations = {}
+
+            # Serialize on the loop so the thread never touches live objects
+            session_rows = [(chat_id, s.model_dump_json()) for chat_id, s in sessions.items()]
+            history_rows = [
+                (op, conversation_id, message.model_dump_json() if message else None)
+                for op, conversation_id, message in history
+            ]
+
+            try:
+                await self._run(self._write_batch, session_rows, history_rows)
+            except Exception:
+                self._requeue(sessions, history)
+                raise
+            self.batches_written += 1
+            self.rows_written += len(session_rows) + len(history_rows)
+
+    def _requeue(self, sessions: Dict[int, ChatSession],
+                 history: List[Tuple[str, str, Optional[CursorMessage]]]):
+        """Put a failed batch back ahead of writes queued since it was taken."""
+        for chat_id, session in sessions.items():
+            # A session saved in the meantime is newer
+            self._pending_sessions.setdefault(chat_id, session)
+        self._pending_history[:0] = history
+        for _, conversation_id, _ in history:
+            self._pending_conversations[conversation_id] = self._pending_conversations.get(conversation_id, 0) + 1
+
+    def _write_batch(self, session_rows: List[Tuple[int, str]],
+                     history_rows: List[Tuple[str, str, Optional[str]]]):
+        """Write one batch on the storage thread."""
+        with self._conn:
+            if session_rows:
+                self._conn.executemany(
+                    "INSERT INTO sessions (chat_id, data) VALUES (?, ?) "
+                    "ON CONFLICT(chat_id) DO UPDATE SET data = excluded.data",
+                    session_rows
+                )
+
+            # Group consecutive appends so ordering against deletes is kept
+            appends: List[Tuple[str, str]] = []
+            for op, conversation_id, data in history_rows:
+                if op == "append":
+                    appends.append((conversation_id, data))
+                    continue
+                if appends:
+                    self._conn.executemany("INSERT INTO messages (conversation_id, data) VALUES (?, ?)", appends)
+                    appends = []
+                self._conn.execute("DELETE FROM messages WHERE conversation_id = ?", (conversation_id,))
+            if appends:
+                self._conn.executemany("INSERT INTO messages (conversation_id, data) VALUES (?, ?)", appends)
+
+    async def load_session(self, chat_id: int) -> Optional[ChatSession]:
+        """Load a session, preferring any unwritten state."""
+        pending = self._pending_sessions.get(chat_id)
+        if pending is not None:
+            return pending
+        if not self._conn:
+            return None
+
+        row = await self._run(self._select_session, chat_id)
+        return ChatSession.model_validate_json(row[0]) if row else None
+
+    def _select_session(self, chat_id: int):
+        return self._conn.execute("SELECT data FROM sessions WHERE chat_id = ?", (chat_id,)).fetchone()
+
+    async def load_history(self, conversation_id: str, limit: int = 50) -> List[CursorMessage]:
+        """Load the most recent messages of a conversation, oldest first."""
+        if not self._conn:
+            return []
+        if conversation_id in self._pending_conversations:
+            await self.flush()
+
+        rows = await self._run(self._select_history, conversation_id, limit)
+        return [CursorMessage.model_validate_json(data) for (data,) in reversed(rows)]
+
+    def _select_history(self, conversation_id: str, limit: int):
+        return self._conn.execute(
+            "SELECT data FROM messages WHERE conversation_id = ? ORDER BY id DESC LIMIT ?",
+            (conversation_id, limit)
+        ).fetchall()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get storage statistics."""
+        return {
+            "backend": "sqlite",
+            "pending_writes": len(self._pending_sessions) + len(self._pending_history),
+            "batches_written": self.batches_written,
+            "rows_written": self.rows_written,
+        }
+
+STORAGE_BACKENDS = {
+    "none": SessionStorage,
+    "sqlite": SQLiteStorage,
+}
+
+def create_storage() -> SessionStorage:
+    """Create the storage backend selected in settings."""
+    backend = settings.storage_backend.lower()
+    if backend not in STORAGE_BACKENDS:
+        raise ValueError(f"Unknown storage backend: {settings.storage_backend}")
+    if backend == "sqlite":
+        return SQLiteStorage(
+            path=settings.storage_path,
+            flush_interval=settings.storage_flush_interval,
+            max_batch_size=settings.storage_batch_size
+        )
+    return STORAGE_BACKENDS[backend]()
@@ -2,28 +2,48 @@
 Telegram client for handling bot interactions.
 """
 import asyncio
+import time
+from datetime import datetime
 from typing import Optional, Dict, Any, List
 from telegram import Update, Bot, Message, Chat, User
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
-from telegram.error import TelegramError
+from telegram.error import TelegramError, BadRequest
 from models import TelegramMessage, MessageType, ChatSession
+from storage import SessionStorage
+from send_scheduler import SendScheduler
 from logger import get_logger
 from config import settings
 
 logger = get_logger("telegram_client")
 
+TELEGRAM_MAX_MESSAGE_LENGTH = 4096
+
 class TelegramClient:
     """Telegram bot client."""
     
-    def __init__(self):
+    def __init__(self, storage: Optional[SessionStorage] = None):
         self.bot_token = settings.telegram_bot_token
         self.application: Optional[Application] = None
+        self.storage = storage or SessionStorage()
+        self.scheduler = SendScheduler(
+            global_rate=settings.telegram_global_rate,
+            chat_rate=settings.telegram_chat_rate,
+            group_rate_per_minute=settings.telegram_group_rate_per_minute,
+            max_retries=settings.telegram_max_send_retries
+        )
         self.active_sessions: Dict[int, ChatSession] = {}
         
     async def initialize(self):
         """Initialize the Telegram bot."""
         try:
-            self.application = Application.builder().token(self.bot_token).build()
+            api_url = settings.telegram_api_url.rstrip("/")
+            self.application = (
+                Application.builder()
+                .token(self.bot_token)
+                .base_url(f"{api_url}/bot")
+                .base_file_url(f"{api_url}/file/bot")
+                .build()
+            )
             
             # Add handlers
             self.application.add_handler(CommandHandler("start", self.start_command))
@@ -34,7 +54,7 @@ class TelegramClient:
             logger.info("Telegram bot initialized successfully")
             
         except Exception as e:
-            logger.error(f"Failed to initialize Telegram bot: {e}")
+            logger.error("Failed to initialize Telegram bot: {}", e)
             raise
     
     async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -58,15 +78,9 @@ Just send me a message and I'll relay it to Cursor AI for processing!
         await update.message.reply_text(welcome_message)
         
         # Create or update session
-        session_id = f"telegram_{chat_id}"
-        session = ChatSession(
-            session_id=session_id,
-            telegram_chat_id=chat_id,
-            is_active=True
-        )
-        self.active_sessions[chat_id] = session
+        self._create_session(chat_id)
         
-        logger.info(f"New session started for user {user.id} in chat {chat_id}")
+        logger.info("New session started for user {} in chat {}", user.id, chat_id)
     
     async def help_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /help command."""
@@ -92,7 +106,7 @@ Just type your message and I'll process it with Cursor AI!
     async def status_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /status command."""
         chat_id = update.effective_chat.id
-        session = self.active_sessions.get(chat_id)
+        session = await self.get_session(chat_id)
         
         if session:
             status_text = f"""
@@ -132,29 +146,47 @@ Just type your message and I'll process it with Cursor AI!
             )
             
             # Update session
-            if chat_id in self.active_sessions:
-                session = self.active_sessions[chat_id]
+            session = await self.get_session(chat_id)
+            if session:
                 session.message_count += 1
                 session.last_activity = telegram_msg.timestamp
+                self.storage.save_session(session)
             else:
                 # Create new session
-                session_id = f"telegram_{chat_id}"
-                session = ChatSession(
-                    session_id=session_id,
-                    telegram_chat_id=chat_id,
-                    is_active=True
-                )
-                self.active_sessions[chat_id] = session
+                session = self._create_session(chat_id)
             
             # Send to relay
             await self._send_to_relay(telegram_msg)
             
-            logger.info(f"Message processed from user {user.id}: {message.text[:50]}...")
+            logger.info("Message processed from user {}: {}...", user.id, message.text[:50])
             
         except Exception as e:
-            logger.error(f"Error handling message: {e}")
+            logger.error("Error handling message: {}", e)
             await update.message.reply_text("❌ Error processing message. Please try again.")
     
+    async def get_session(self, chat_id: int) -> Optional[ChatSession]:
+        """Get the session for a chat, loading it from storage on first access."""
+        session = self.active_sessions.get(chat_id)
+        if session is None:
+            session = await self.storage.load_session(chat_id)
+            if session is not None:
+                self.active_sessions[chat_id] = session
+        return session
+    
+    def _create_session(self, chat_id: int) -> ChatSession:
+        """Create a new session for a chat, replacing any existing one."""
+        now = datetime.now()
+        session = ChatSession(
+            session_id=f"telegram_{chat_id}",
+            telegram_chat_id=chat_id,
+            is_active=True,
+            created_at=now,
+            last_activity=now
+        )
+        self.active_sessions[chat_id] = session
+        self.storage.save_session(session)
+        return session
+    
     def _is_user_allowed(self, user_id: int) -> bool:
         """Check if user is allowed to use the bot."""
         # For now, allow all users. You can implement whitelist/blacklist logic here.
@@ -174,21 +206,54 @@ Just type your message and I'll process it with Cursor AI!
         # This will be implemented in the relay logic
         pass
     
-    async def send_message(self, chat_id: int, text: str, reply_to_message_id: Optional[int] = None):
+    async def send_message(self, chat_id: int, text: str, reply_to_message_id: Optional[int] = None) -> Optional[Message]:
         """Send a message to a Telegram chat."""
         try:
             if self.application:
                 bot = self.application.bot
-                await bot.send_message(
+                sent = await self.scheduler.run(chat_id, lambda: bot.send_message(
                     chat_id=chat_id,
                     text=text,
                     reply_to_message_id=reply_to_message_id
-                )
-                logger.info(f"Message sent to chat {chat_id}")
+                ))
+                logger.info("Message sent to chat {}", chat_id)
+                return sent
         except TelegramError as e:
-            logger.error(f"Failed to send message to chat {chat_id}: {e}")
+            logger.error("Failed to send message to chat {}: {}", chat_id, e)
             raise
     
+    async def edit_message(self, chat_id: int, message_id: int, text: str):
+        """Replace the text of a message previously sent by the bot."""
+        try:
+            if self.application:
+                bot = self.application.bot
+                await self.scheduler.run(chat_id, lambda: bot.edit_message_text(
+                    chat_id=chat_id,
+                    message_id=message_id,
+                    text=text
+                ))
+        except BadRequest as e:
+            # Editing to identical text is harmless
+            if "not modified" not in str(e).lower():
+                logger.error("Failed to edit message {} in chat {}: {}", message_id, chat_id, e)
+                raise
+        except TelegramError as e:
+            logger.error("Failed to edit message {} in chat {}: {}", message_id, chat_id, e)
+            raise
+    
+    def can_send_now(self, chat_id: int) -> bool:
+        """Whether a message to this chat would go out without being delayed."""
+        return self.scheduler.can_send_now(chat_id)
+    
+    def streaming_reply(self, chat_id: int) -> "StreamingReply":
+        """Create a reply that is updated in place as text arrives."""
+        return StreamingReply(self, chat_id, min_edit_interval=settings.telegram_edit_interval)
+    
+    async def prepare(self):
+        """Initialize the bot so replies can be sent before updates are taken in."""
+        if self.application:
+            await self.application.initialize()
+    
     async def start_polling(self):
         """Start the bot polling."""
         if self.application:
@@ -197,10 +262,104 @@ Just type your message and I'll process it with Cursor AI!
             await self.application.updater.start_polling()
             logger.info("Telegram bot started polling")
     
-    async def stop_polling(self):
-        """Stop the bot polling."""
+    async def start_webhook(self, register: bool = True):
+        """Start the bot and, unless register is False, register the webhook with Telegram.
+        
+        Updates are then delivered by the web server through process_webhook_update.
+        Shard workers pass register=False since the front process owns the webhook.
+        """
+        if register and (not settings.telegram_webhook_url or not settings.telegram_webhook_secret):
+            raise ValueError("TELEGRAM_WEBHOOK_URL and TELEGRAM_WEBHOOK_SECRET are required in webhook mode")
+        
         if self.application:
+            await self.application.initialize()
+            await self.application.start()
+            if not register:
+                return
+            
+            webhook_url = settings.telegram_webhook_url.rstrip("/") + settings.telegram_webhook_path
+            await self.application.bot.set_webhook(
+                url=webhook_url,
+                secret_token=settings.telegram_webhook_secret,
+                allowed_updates=Update.ALL_TYPES,
+                max_connections=settings.telegram_webhook_max_connections
+            )
+            logger.info("Telegram webhook registered at {}", webhook_url)
+    
+    async def stop_updates(self):
+        """Stop polling for updates; replies can still be sent until shutdown().
+        
+        In webhook mode updates stop once the web server refuses them.
+        """
+        if self.application and self.application.updater and self.application.updater.running:
             await self.application.updater.stop()
-            await self.application.stop()
+    
+    async def shutdown(self):
+        """Stop the bot; a registered webhook stays so other instances keep receiving updates."""
+        if self.application:
+            await self.stop_updates()
+            if self.application.running:
+                await self.application.stop()
             await self.application.shutdown()
-            logger.info("Telegram bot stopped")
\ No newline at end of file
+            logger.info("Telegram bot stopped")
+    
+    async def process_webhook_update(self, data: Dict[str, Any]):
+        """Run a webhook update through the bot's handlers."""
+        if not self.application or not self.application.running:
+            raise RuntimeError("Telegram bot is not running")
+        update = Update.de_json(data, self.application.bot)
+        await self.application.process_update(update)
+
+class StreamingReply:
+    """A Telegram message that grows as streamed text arrives.
+    
+    The first chunk is sent right away; later chunks are coalesced and applied
+    with at most one edit per min_edit_interval to stay within edit limits.
+    """
+    
+    def __init__(self, client: TelegramClient, chat_id: int, min_edit_interval: float = 1.0,
+                 cursor: str = " ▌"):
+        self.client = client
+        self.chat_id = chat_id
+        self.min_edit_interval = min_edit_interval
+        self.cursor = cursor
+        self.text = ""
+        self.message_id: Optional[int] = None
+        self.edits = 0
+        self._shown = ""
+        self._last_update = 0.0
+    
+    async def append(self, chunk: str):
+        """Add streamed text, updating the message if the throttle allows."""
+        self.text += chunk
+        # Skip rather than queue intermediate edits when the chat is rate limited
+        if (time.monotonic() - self._last_update >= self.min_edit_interval
+                and self.client.can_send_now(self.chat_id)):
+            await self._update(self.text + self.cursor)
+    
+    async def finish(self, final_text: str):
+        """Show the final text, sending it if nothing was shown yet."""
+        await self._update(final_text, final=True)
+    
+    async def _update(self, text: str, final: bool = False):
+        """Send or edit the message with the given text."""
+        if len(text) > TELEGRAM_MAX_MESSAGE_LENGTH:
+            text = text[:TELEGRAM_MAX_MESSAGE_LENGTH - 3] + "..."
+        if text == self._shown or not text.strip():
+            return
+        
+        try:
+            if self.message_id is None:
+                sent = await self.client.send_message(self.chat_id, text)
+                self.message_id = sent.message_id if sent else None
+            else:
+                await self.client.edit_message(self.chat_id, self.message_id, text)
+                self.edits += 1
+            self._shown = text
+        except TelegramError as e:
+            # Intermediate updates are best effort; the final one must land
+            if final:
+                raise
+            logger.warning("Skipped streaming update for chat {}: {}", self.chat_id, e)
+        finally:
+            self._last_update = time.monotonic()
@@ -2,11 +2,40 @@
 Test script for the Telegram-Cursor API relay.
 """
 import asyncio
+import json
+import os
+import sqlite3
 import sys
+import tempfile
+import time
+from contextlib import asynccontextmanager
 from datetime import datetime
 from models import TelegramMessage, MessageType
 from cursor_client import MockCursorClient
-from telegram_client import TelegramClient
+from telegram_client import TelegramClient, StreamingReply
+from dispatcher import ChatDispatcher
+from message_store import RelayMessageStore
+from message_log import MessageLog
+from conversation_store import ConversationStore
+from models import RelayMessage, MessageDirection, CursorMessage, ChatSession
+from storage import SQLiteStorage
+from send_scheduler import SendScheduler
+from response_cache import ResponseCache
+from context_window import ContextWindow, estimate_tokens
+from single_flight import SingleFlight
+from request_batcher import RequestBatcher
+from cursor_client import CursorClient
+from backends import Backend, BackendRouter, HTTPBackend, MockBackend
+from simulation import parse_latency
+from hedging import Hedger
+from concurrency_limit import AdaptiveLimiter, ConcurrencyLimitError
+import benchmark
+import performance
+from aiohttp import web
+from metrics import MetricsRegistry
+from tracing import Tracer, JsonLinesExporter
+from sharding import ShardLink, shard_for, update_chat_id
+from resilience import RetryPolicy, CircuitBreaker, CursorAPIError, CircuitOpenError
 from logger import get_logger
 
 logger = get_logger("test")
@@ -81,6 +110,1167 @@ async def test_relay_message_flow():
     await cursor_client.close()
     print("✅ Relay message flow test passed!\n")
 
+async def test_dispatcher_ordering():
+    """Test per-chat ordering and parallelism in the dispatcher."""
+    print("🧪 Testing Dispatcher Ordering...")
+    
+    handled = {}
+    
+    async def handler(item):
+        chat_id, seq = item
+        # Later messages finish faster, so only the dispatcher keeps them ordered
+        await asyncio.sleep(0.01 * (5 - seq))
+        handled.setdefault(chat_id, []).append(seq)
+    
+    dispatcher = ChatDispatcher(handler, workers=4, max_queue_size=8)
+    dispatcher.start()
+    
+    started = asyncio.get_event_loop().time()
+    for seq in range(5):
+        for chat_id in range(4):
+            await dispatcher.submit(chat_id, (chat_id, seq))
+    await dispatcher.stop()
+    elapsed = asyncio.get_event_loop().time() - started
+    
+    assert all(handled[chat_id] == list(range(5)) for chat_id in range(4)), handled
+    assert elapsed < 0.3, f"Chats were not processed in parallel ({elapsed:.2f}s)"
+    
+    print(f"✅ Messages handled: {dispatcher.processed}")
+    print(f"✅ Elapsed: {elapsed:.2f}s")
+    print("✅ Dispatcher ordering test passed!\n")
+
+async def test_message_retention():
+    """Test bounded retention of finished relay messages."""
+    print("🧪 Testing Message Retention...")
+    
+    store = RelayMessageStore(max_completed=10, max_completed_bytes=1024 * 1024)
+    
+    for i in range(25):
+        relay_msg = RelayMessage(
+            id=f"msg_{i}",
+            direction=MessageDirection.TELEGRAM_TO_CURSOR,
+            created_at=datetime.now()
+        )
+        store.add(relay_msg)
+        if i < 24:
+            relay_msg.status = "completed"
+            store.finish(relay_msg)
+    
+    stats = store.get_stats()
+    assert stats["in_flight"] == 1, stats
+    assert stats["completed_retained"] == 10, stats
+    assert stats["evicted"] == 14, stats
+    assert store.recent(1)[0].id == "msg_23"
+    assert store.get("msg_24") is not None and store.get("msg_0") is None
+    
+    print(f"✅ Stats: {stats}")
+    print("✅ Message retention test passed!\n")
+
+async def test_conversation_store():
+    """Test history caps and LRU eviction in the conversation store."""
+    print("🧪 Testing Conversation Store...")
+    
+    store = ConversationStore(max_messages_per_conversation=3, max_total_bytes=4 * 612, idle_ttl=None)
+    
+    def make_message(i):
+        return CursorMessage(message_id=f"c_{i}", content="x" * 100, timestamp=datetime.now())
+    
+    for i in range(5):
+        store.append("conv_a", make_message(i))
+    assert [m.message_id for m in store.get("conv_a")] == ["c_2", "c_3", "c_4"]
+    
+    # Adding a second conversation pushes the total over budget and evicts conv_a
+    store.append("conv_b", make_message(5))
+    store.append("conv_b", make_message(6))
+    assert "conv_a" not in store and "conv_b" in store
+    assert store.get("conv_a") == []
+    
+    stats = store.get_stats()
+    assert stats["hits"] == 1 and stats["misses"] == 1 and stats["evictions"] == 1, stats
+    assert store.clear("conv_b") and stats["total_bytes"] > store.total_bytes == 0
+    
+    print(f"✅ Stats: {stats}")
+    print("✅ Conversation store test passed!\n")
+
+async def test_sqlite_storage():
+    """Test that sessions and history survive reopening the SQLite store."""
+    print("🧪 Testing SQLite Storage...")
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "relay.db")
+        
+        storage = SQLiteStorage(path=path, flush_interval=60)
+        await storage.initialize()
+        
+        session = ChatSession(
+            session_id="telegram_42",
+            telegram_chat_id=42,
+            created_at=datetime.now(),
+            last_activity=datetime.now()
+        )
+        storage.save_session(session)
+        session.cursor_conversation_id = "conv_42"
+        storage.save_session(session)
+        for i in range(3):
+            storage.append_message("conv_42", CursorMessage(
+                message_id=f"c_{i}", content=f"reply {i}", timestamp=datetime.now()
+            ))
+        
+        # Reads see pending writes before the batch is committed
+        assert (await storage.load_session(42)).cursor_conversation_id == "conv_42"
+        await storage.close()
+        assert storage.batches_written >= 1
+        
+        reopened = SQLiteStorage(path=path)
+        await reopened.initialize()
+        loaded = await reopened.load_session(42)
+        history = await reopened.load_history("conv_42", limit=2)
+        reopened.delete_conversation("conv_42")
+        assert await reopened.load_history("conv_42") == []
+        
+        # A failed write keeps the batch pending instead of dropping it
+        write_batch = reopened._write_batch
+        def busy(*args):
+            raise sqlite3.OperationalError("database is locked")
+        reopened._write_batch = busy
+        reopened.append_message("conv_7", CursorMessage(message_id="c_7", content="kept", timestamp=datetime.now()))
+        try:
+            await reopened.flush()
+            assert False, "Expected OperationalError"
+        except sqlite3.OperationalError:
+            pass
+        assert reopened.get_stats()["pending_writes"] == 1
+        reopened._write_batch = write_batch
+        retried = await reopened.load_history("conv_7")
+        await reopened.close()
+        assert [m.message_id for m in retried] == ["c_7"]
+    
+    assert loaded.cursor_conversation_id == "conv_42"
+    assert [m.message_id for m in history] == ["c_1", "c_2"]
+    
+    print(f"✅ Restored session: {loaded.session_id}")
+    print(f"✅ Restored history: {len(history)} messages")
+    print("✅ SQLite storage test passed!\n")
+
+async def test_streaming_reply():
+    """Test that streamed chunks are coalesced into throttled edits."""
+    print("🧪 Testing Streaming Reply...")
+    
+    class FakeTelegramClient:
+        def __init__(self):
+            self.calls = []
+        
+        async def send_message(self, chat_id, text):
+            self.calls.append(("send", text))
+            return type("Sent", (), {"message_id": 1})()
+        
+        async def edit_message(self, chat_id, message_id, text):
+            self.calls.append(("edit", text))
+        
+        def can_send_now(self, chat_id):
+            return True
+    
+    client = FakeTelegramClient()
+    reply = StreamingReply(client, chat_id=1, min_edit_interval=0.05, cursor="")
+    
+    for i in range(20):
+        await reply.append(f"word{i} ")
+        await asyncio.sleep(0.01)
+    await reply.finish("final answer")
+    
+    assert client.calls[0] == ("send", "word0 ")
+    assert client.calls[-1] == ("edit", "final answer")
+    assert len(client.calls) < 10, f"Chunks were not coalesced: {len(client.calls)} calls"
+    
+    print(f"✅ Telegram calls for 20 chunks: {len(client.calls)}")
+    print("✅ Streaming reply test passed!\n")
+
+async def test_retry_policy():
+    """Test retries, fatal errors and the circuit breaker."""
+    print("🧪 Testing Retry Policy...")
+    
+    policy = RetryPolicy(
+        max_attempts=3, base_delay=0.001,
+        breaker=CircuitBreaker(failure_threshold=3, reset_timeout=60)
+    )
+    attempts = []
+    
+    async def flaky():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise CursorAPIError("unavailable", status=503, retry_after=0)
+        return "ok"
+    
+    assert await policy.call(flaky) == "ok" and len(attempts) == 3
+    
+    async def bad_request():
+        raise CursorAPIError("bad request", status=400)
+    
+    try:
+        await policy.call(bad_request)
+        assert False, "Fatal error was not raised"
+    except CursorAPIError as e:
+        assert e.status == 400 and policy.retries == 2
+    
+    # A Retry-After beyond max_delay isn't cut short; the error is raised instead
+    async def throttled():
+        raise CursorAPIError("slow down", status=429, retry_after=policy.max_delay + 20)
+    
+    try:
+        await policy.call(throttled)
+        assert False, "Throttled call was retried early"
+    except CursorAPIError as e:
+        assert e.status == 429 and policy.retries == 2
+    
+    async def down():
+        raise CursorAPIError("down", status=502)
+    
+    for _ in range(2):
+        try:
+            await policy.call(down)
+        except (CursorAPIError, CircuitOpenError):
+            pass
+    assert policy.breaker.state == CircuitBreaker.OPEN
+    
+    try:
+        await policy.call(flaky)
+        assert False, "Open circuit did not fail fast"
+    except CircuitOpenError:
+        pass
+    
+    print(f"✅ Stats: {policy.get_stats()}")
+    print("✅ Retry policy test passed!\n")
+
+async def test_send_scheduler():
+    """Test per-chat pacing and ordering of outbound sends."""
+    print("🧪 Testing Send Scheduler...")
+    
+    scheduler = SendScheduler(global_rate=1000, chat_rate=20)
+    sent = []
+    
+    async def send(chat_id, seq):
+        sent.append((chat_id, seq, asyncio.get_event_loop().time()))
+    
+    started = asyncio.get_event_loop().time()
+    await asyncio.gather(*[
+        scheduler.run(chat_id, lambda c=chat_id, i=seq: send(c, i))
+        for seq in range(5) for chat_id in (1, 2)
+    ])
+    elapsed = asyncio.get_event_loop().time() - started
+    
+    for chat_id in (1, 2):
+        times = [t for c, _, t in sent if c == chat_id]
+        assert [i for c, i, _ in sent if c == chat_id] == list(range(5))
+        # First send is immediate, the other four wait 1/20s each
+        assert times[-1] - times[0] >= 0.18, times
+    assert elapsed < 0.35, f"Chats were paced serially ({elapsed:.2f}s)"
+    
+    print(f"✅ Stats: {scheduler.get_stats()}")
+    print("✅ Send scheduler test passed!\n")
+
+async def test_response_cache():
+    """Test that opening prompts are shared across chats, and follow-ups are never cached."""
+    print("🧪 Testing Response Cache...")
+    
+    client = MockCursorClient()
+    client.response_cache = ResponseCache(ttl=60, max_entries=10)
+    await client.initialize()
+    
+    first = await client.send_message("What is Python?", conversation_id="conv_1", context={"user_id": 1})
+    started = asyncio.get_event_loop().time()
+    second = await client.send_message("  what is   PYTHON? ", conversation_id="conv_2", context={"user_id": 2})
+    elapsed = asyncio.get_event_loop().time() - started
+    bypassed = await client.send_message("What is Python?", conversation_id="conv_3", use_cache=False)
+    
+    assert second.content == first.content and second.metadata["cached"]
+    assert second.metadata["conversation_id"] == "conv_2"
+    assert not bypassed.metadata.get("cached")
+    assert elapsed < 0.1, f"Cache hit took {elapsed:.3f}s"
+    
+    # Once a conversation has turns, its prompts depend on them and aren't served from the cache
+    await client.send_message("continue", conversation_id="conv_1")
+    follow_up = await client.send_message("continue", conversation_id="conv_1")
+    repeated = await client.send_message("What is Python?", conversation_id="conv_2")
+    await client.close()
+    assert not follow_up.metadata.get("cached") and not repeated.metadata.get("cached")
+    
+    stats = client.response_cache.get_stats()
+    assert stats["hits"] == 1 and stats["misses"] == 1, stats
+    
+    print(f"✅ Stats: {stats}")
+    print("✅ Response cache test passed!\n")
+
+async def test_request_coalescing():
+    """Test that concurrent identical opening prompts from different chats share one upstream call."""
+    print("🧪 Testing Request Coalescing...")
+    
+    client = MockCursorClient()
+    client.single_flight = SingleFlight()
+    await client.initialize()
+    
+    upstream_calls = []
+    send_once = client._send_once
+    
+    async def counting_send_once(*args):
+        upstream_calls.append(args)
+        return await send_once(*args)
+    
+    client._send_once = counting_send_once
+    chunks = {}
+    
+    def collector(i):
+        async def on_chunk(chunk):
+            chunks.setdefault(i, []).append(chunk)
+        return on_chunk
+    
+    started = asyncio.get_event_loop().time()
+    responses = await asyncio.gather(*[
+        client.send_message("Viral question", conversation_id=f"chat_{i}",
+                            context={"user_id": i}, on_chunk=collector(i))
+        for i in range(5)
+    ])
+    elapsed = asyncio.get_event_loop().time() - started
+    
+    assert len(upstream_calls) == 1, f"{len(upstream_calls)} upstream calls"
+    assert [r.metadata["conversation_id"] for r in responses] == [f"chat_{i}" for i in range(5)]
+    assert sum(1 for r in responses if r.metadata.get("coalesced")) == 4
+    assert all("".join(chunks[i]) == responses[0].content for i in range(5))
+    assert elapsed < 1.5, f"Coalesced requests took {elapsed:.2f}s"
+    
+    # Once the chats have turns, the same words depend on them and each chat asks on its own
+    upstream_calls.clear()
+    responses = await asyncio.gather(*[
+        client.send_message("Viral question", conversation_id=f"chat_{i}") for i in range(2)
+    ])
+    await client.close()
+    assert sorted(call[1] for call in upstream_calls) == ["chat_0", "chat_1"], upstream_calls
+    assert all(len(client.conversations.get(f"chat_{i}")) == 2 for i in range(2))
+    assert not any(r.metadata.get("coalesced") for r in responses)
+    
+    print(f"✅ Stats: {client.single_flight.get_stats()}")
+    print("✅ Request coalescing test passed!\n")
+
+async def test_metrics_rendering():
+    """Test histogram and counter exposition."""
+    print("🧪 Testing Metrics Rendering...")
+    
+    registry = MetricsRegistry()
+    latency = registry.histogram("test_latency_seconds", "Test latency", ["stage"], buckets=(0.1, 1.0))
+    failures = registry.counter("test_failures_total", "Test failures", ["stage"])
+    
+    for value in (0.05, 0.5, 5.0):
+        latency.observe(value, stage="cursor_api")
+    failures.inc(stage="cursor_api")
+    
+    text = registry.render([("test_queue_depth", "gauge", "Queue depth", [({}, 3)])])
+    
+    assert 'test_latency_seconds_bucket{stage="cursor_api",le="0.1"} 1' in text
+    assert 'test_latency_seconds_bucket{stage="cursor_api",le="1"} 2' in text
+    assert 'test_latency_seconds_bucket{stage="cursor_api",le="+Inf"} 3' in text
+    assert 'test_latency_seconds_count{stage="cursor_api"} 3' in text
+    assert 'test_failures_total{stage="cursor_api"} 1' in text
+    assert "test_queue_depth 3" in text
+    
+    print(f"✅ Rendered {len(text.splitlines())} lines")
+    print("✅ Metrics rendering test passed!\n")
+
+async def test_tracing_spans():
+    """Test span trees and JSON-lines export for sampled messages."""
+    print("🧪 Testing Tracing Spans...")
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "traces.jsonl")
+        tracer = Tracer(sample_rate=1.0, exporter=JsonLinesExporter(path))
+        message_id = "12345678-1234-5678-1234-567812345678"
+        
+        assert tracer.start_trace(message_id, chat_id=1)
+        with tracer.resume(message_id):
+            with tracer.span("get_conversation_id"):
+                with tracer.span("session_lookup"):
+                    await asyncio.sleep(0)
+            try:
+                with tracer.span("cursor.send_message"):
+                    raise ValueError("upstream failed")
+            except ValueError:
+                pass
+        # Outside resume() nothing is recorded
+        with tracer.span("orphan"):
+            pass
+        tracer.finish_trace(message_id, status="failed")
+        await tracer.stop()
+        
+        with open(path) as f:
+            spans = {span["name"]: span for span in map(json.loads, f)}
+        
+        assert set(spans) == {"relay.message", "get_conversation_id", "session_lookup", "cursor.send_message"}
+        root = spans["relay.message"]
+        assert root["trace_id"] == message_id.replace("-", "") and root["parent_id"] is None
+        assert spans["get_conversation_id"]["parent_id"] == root["span_id"]
+        assert spans["session_lookup"]["parent_id"] == spans["get_conversation_id"]["span_id"]
+        assert spans["cursor.send_message"]["error"] == "upstream failed"
+        assert root["attributes"] == {"chat_id": 1, "status": "failed"}
+    
+    unsampled = Tracer(sample_rate=0.0, exporter=JsonLinesExporter(path))
+    assert not unsampled.start_trace(message_id)
+    with unsampled.resume(message_id), unsampled.span("cursor.send_message") as span:
+        span.set_attribute("cached", True)
+    assert unsampled.get_stats()["buffered_spans"] == 0
+    
+    print(f"✅ Exported spans: {tracer.exported}")
+    print("✅ Tracing spans test passed!\n")
+
+async def test_shard_link_replay():
+    """Test chat routing and in-order replay of unacknowledged updates."""
+    print("🧪 Testing Shard Link Replay...")
+    
+    assert update_chat_id({"update_id": 1, "message": {"chat": {"id": -42}}}) == -42
+    assert update_chat_id({"update_id": 2, "callback_query": {"from": {"id": 7}, "message": {"chat": {"id": 9}}}}) == 9
+    assert shard_for(-42, 4) == shard_for(-42, 4) and 0 <= shard_for(-42, 4) < 4
+    
+    received = []
+    connections = 0
+    
+    async def worker(reader, writer):
+        # First connection dies after handling two updates without acking the second
+        nonlocal connections
+        connections += 1
+        handled = 0
+        while line := await reader.readline():
+            frame = json.loads(line)
+            received.append(frame["update"]["n"])
+            handled += 1
+            if connections == 1 and handled == 2:
+                break
+            writer.write(json.dumps({"ack": frame["seq"]}).encode() + b"\n")
+            await writer.drain()
+        writer.close()
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "shard.sock")
+        server = await asyncio.start_unix_server(worker, path)
+        link = ShardLink(0, path, max_pending=10)
+        for n in range(5):
+            link.submit({"n": n})
+        await link.start()
+        
+        for _ in range(100):
+            if not link.pending and connections == 2:
+                break
+            await asyncio.sleep(0.05)
+        await link.stop()
+        server.close()
+    
+    # Update 1 is seen twice (at-least-once) but every update arrives, in order
+    assert received == [0, 1, 1, 2, 3, 4], received
+    assert link.get_stats()["delivered"] == 5
+    
+    print(f"✅ Frames received: {len(received)}, replayed: {link.replayed}")
+    print("✅ Shard link replay test passed!\n")
+
+async def test_message_log_replay():
+    """Test that unfinished messages survive a restart and the log compacts."""
+    print("🧪 Testing Message Log Replay...")
+    
+    def make_message(n):
+        return RelayMessage(
+            id=f"msg-{n}",
+            telegram_message=TelegramMessage(
+                message_id=n, chat_id=1, user_id=1, text=f"message {n}", timestamp=datetime.now()
+            ),
+            direction=MessageDirection.TELEGRAM_TO_CURSOR,
+            created_at=datetime.now()
+        )
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "messages.log")
+        log = MessageLog(path, commit_interval=0.001, compact_after=20)
+        assert await log.initialize() == []
+        
+        messages = [make_message(n) for n in range(4)]
+        for relay_msg in messages:
+            log.record(relay_msg)
+        messages[1].status = "processing"
+        log.record(messages[1])
+        for relay_msg, status in ((messages[0], "completed"), (messages[2], "failed")):
+            relay_msg.status = status
+            log.record(relay_msg)
+        await log.wait_durable()
+        assert log.get_stats()["buffered"] == 0
+        
+        # Simulate a crash mid-write
+        with open(path, "ab") as f:
+            f.write(b'{"message": {"id": "torn"')
+        await log.close()
+        
+        log = MessageLog(path, commit_interval=0.001, compact_after=20)
+        recovered = await log.initialize()
+        assert [m.id for m in recovered] == ["msg-1", "msg-3"], recovered
+        assert all(m.status == "pending" for m in recovered)
+        assert recovered[0].telegram_message.text == "message 1"
+        
+        for n in range(4, 24):
+            relay_msg = make_message(n)
+            log.record(relay_msg)
+            relay_msg.status = "completed"
+            log.record(relay_msg)
+            await log.wait_durable()
+        stats = log.get_stats()
+        await log.close()
+        
+        assert stats["compactions"] >= 1, stats
+        assert stats["records_in_file"] < 20, stats
+        # A waiting caller doesn't sit out the commit interval
+        log = MessageLog(path, commit_interval=5.0)
+        assert [m.id for m in await log.initialize()] == ["msg-1", "msg-3"]
+        started = time.monotonic()
+        for n in range(24, 27):
+            log.record(make_message(n))
+            await log.wait_durable()
+        waited = time.monotonic() - started
+        assert waited < 1.0 and log.get_stats()["commits"] == 3, (waited, log.get_stats())
+        await log.close()
+    
+    print(f"✅ Commits: {stats['commits']}, compactions: {stats['compactions']}")
+    print("✅ Message log replay test passed!\n")
+
+async def test_context_window():
+    """Test token-budgeted history assembly."""
+    print("🧪 Testing Context Window...")
+    
+    def turn(n, role):
+        return CursorMessage(
+            message_id=f"{role}_{n}",
+            content=f"turn {n} " + "x" * 96,
+            timestamp=datetime.now(),
+            metadata={"role": role} if role == "user" else {}
+        )
+    
+    history = [turn(n, "user" if n % 2 == 0 else "assistant") for n in range(10)]
+    assert estimate_tokens("x" * 100) == 25
+    
+    # Each turn costs 26 + 4 tokens; 4 fit after the new message and summary reserve
+    window = ContextWindow(max_tokens=200, summary_tokens=60)
+    turns = window.build(history, "new question")
+    assert turns[0]["role"] == "system" and turns[0]["content"].startswith("Summary of earlier turns:")
+    assert [t["content"][:6] for t in turns[1:]] == ["turn 6", "turn 7", "turn 8", "turn 9"], turns
+    assert [t["role"] for t in turns[1:]] == ["user", "assistant", "user", "assistant"]
+    # The summary keeps the most recent dropped turns that fit its budget
+    assert "turn 5" in turns[0]["content"] and "turn 0" not in turns[0]["content"]
+    assert estimate_tokens(turns[0]["content"]) <= 60
+    
+    # Without a summary budget the oldest turns are simply dropped
+    window = ContextWindow(max_tokens=200, summary_tokens=0)
+    turns = window.build(history, "new question")
+    assert [t["content"][:6] for t in turns] == ["turn 4", "turn 5", "turn 6", "turn 7", "turn 8", "turn 9"]
+    assert window.get_stats()["turns_dropped"] == 4
+    
+    # The client sends trimmed history and keeps both sides of each exchange
+    sent = []
+    
+    class RecordingClient(MockCursorClient):
+        async def _send_once(self, message, conversation_id, context, on_chunk, history=None):
+            sent.append(history)
+            return CursorMessage(message_id=f"reply_{len(sent)}", content=f"reply to {message}",
+                                 timestamp=datetime.now(), metadata={"conversation_id": conversation_id})
+    
+    client = RecordingClient()
+    client.context_window = ContextWindow(max_tokens=1000, summary_tokens=0)
+    await client.send_message("first", conversation_id="conv")
+    await client.send_message("second", conversation_id="conv")
+    assert sent[0] is None
+    assert sent[1] == [{"role": "user", "content": "first"}, {"role": "assistant", "content": "reply to first"}], sent
+    assert len(client.conversations.get("conv")) == 4
+    
+    print(f"✅ Requests with history: {len([h for h in sent if h])}")
+    print("✅ Context window test passed!\n")
+
+async def test_request_batching():
+    """Test micro-batched Cursor requests and the single-request fallback."""
+    print("🧪 Testing Request Batching...")
+    
+    batch_sizes = []
+    single_requests = 0
+    batch_supported = True
+    
+    async def batch(request):
+        if not batch_supported:
+            return web.Response(status=404)
+        body = await request.json()
+        batch_sizes.append(len(body["requests"]))
+        return web.json_response({"responses": [
+            {"error": {"status": 400, "message": "bad"}} if r["message"] == "bad" else
+            {"id": r["message"], "choices": [{"message": {"content": f"re: {r['message']}"}}]}
+            for r in body["requests"]
+        ]})
+    
+    async def single(request):
+        nonlocal single_requests
+        single_requests += 1
+        body = await request.json()
+        return web.json_response({"id": "single", "choices": [{"message": {"content": f"re: {body['message']}"}}]})
+    
+    app = web.Application()
+    app.router.add_post("/v1/chat/completions/batch", batch)
+    app.router.add_post("/v1/chat/completions", single)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    
+    backend = HTTPBackend("test", f"http://127.0.0.1:{port}")
+    backend.batcher = RequestBatcher(backend._post_batch, max_batch_size=4, max_wait=0.05)
+    client = CursorClient(backends=[backend])
+    try:
+        results = await asyncio.gather(
+            *(client.send_message(f"q{n}") for n in range(6)),
+            client.send_message("bad"),
+            return_exceptions=True
+        )
+        assert [r.content for r in results[:6]] == [f"re: q{n}" for n in range(6)], results
+        assert isinstance(results[6], CursorAPIError) and results[6].status == 400
+        assert sorted(batch_sizes) == [3, 4] and single_requests == 0, batch_sizes
+        
+        batch_supported = False
+        results = await asyncio.gather(*(client.send_message(f"q{n}") for n in range(3)))
+        assert [r.content for r in results] == [f"re: q{n}" for n in range(3)]
+        assert single_requests == 3 and not backend.batcher.supported
+    finally:
+        await client.close()
+        await runner.cleanup()
+    
+    print(f"✅ Batches sent: {backend.batcher.batches}, fallback requests: {single_requests}")
+    print("✅ Request batching test passed!\n")
+
+async def test_connection_pool_metrics():
+    """Test that the connection pool counters track created, reused and queued connections."""
+    print("🧪 Testing Connection Pool Metrics...")
+    
+    from config import settings
+    
+    in_progress = 0
+    release = asyncio.Event()
+    release.set()
+    
+    async def complete(request):
+        nonlocal in_progress
+        body = await request.json()
+        in_progress += 1
+        await release.wait()
+        in_progress -= 1
+        return web.json_response({"id": "pooled", "choices": [{"message": {"content": f"re: {body['message']}"}}]})
+    
+    app = web.Application()
+    app.router.add_post("/v1/chat/completions", complete)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    url = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+    
+    saved_limit = settings.cursor_pool_limit
+    routers = []
+    try:
+        # Sequential requests share one kept-alive connection
+        backend = HTTPBackend("pool", url)
+        routers.append(BackendRouter([backend]))
+        await routers[-1].initialize()
+        for n in range(3):
+            await routers[-1].send({"message": f"q{n}"})
+        stats = backend.get_pool_stats()
+        assert stats["connections_created"] == 1 and stats["connections_reused"] == 2, stats
+        assert stats["in_flight"] == 0 and stats["utilization"] == 0.0, stats
+        
+        # Requests beyond the pool limit wait for a connection
+        settings.cursor_pool_limit = 2
+        backend = HTTPBackend("small-pool", url)
+        routers.append(BackendRouter([backend]))
+        await routers[-1].initialize()
+        release.clear()
+        tasks = [asyncio.create_task(routers[-1].send({"message": f"q{n}"})) for n in range(3)]
+        for _ in range(100):
+            if in_progress == 2 and backend.pool_metrics.queued == 1:
+                break
+            await asyncio.sleep(0.01)
+        busy = backend.get_pool_stats()
+        release.set()
+        await asyncio.gather(*tasks)
+        stats = backend.get_pool_stats()
+        assert busy["in_flight"] == 3 and busy["utilization"] == 1.5 and busy["queued"] == 1, busy
+        assert stats["queued"] == 0 and stats["queued_total"] == 1, stats
+        assert stats["connections_created"] == 2 and stats["connections_reused"] == 1, stats
+    finally:
+        settings.cursor_pool_limit = saved_limit
+        for router in routers:
+            await router.close()
+        await runner.cleanup()
+    
+    print(f"✅ Pool under load: {busy}")
+    print("✅ Connection pool metrics test passed!\n")
+
+class FakeBackend(Backend):
+    """Backend answering with its own name after a fixed delay."""
+    
+    def __init__(self, name, delay, fail=False):
+        super().__init__(name)
+        self.delay = delay
+        self.fail = fail
+    
+    async def complete(self, payload, on_chunk, stream):
+        await asyncio.sleep(self.delay)
+        if self.fail:
+            raise CursorAPIError("upstream down", status=503)
+        return CursorMessage(message_id=self.name, content=self.name, timestamp=datetime.now(),
+                             metadata={"backend": self.name})
+
+async def test_backend_routing():
+    """Test failover and latency-aware selection across backends."""
+    print("🧪 Testing Backend Routing...")
+    
+    # A failing backend is failed over within the attempt, then ejected
+    broken, healthy = FakeBackend("broken", 0.0, fail=True), FakeBackend("healthy", 0.0)
+    router = BackendRouter([broken, healthy], strategy="least_outstanding", eject_after=2)
+    for _ in range(4):
+        assert (await router.send({"message": "hi"})).content == "healthy"
+    assert broken.failures == 2 and router.failovers == 2, router.get_stats()
+    assert router.get_stats()["backends"][0]["ejected"]
+    
+    # Once one backend degrades, latency routing shifts traffic to the faster one
+    slow, fast = FakeBackend("slow", 0.05), FakeBackend("fast", 0.001)
+    router = BackendRouter([slow, fast], strategy="latency", explore_ratio=0.0)
+    used = [(await router.send({"message": "hi"})).content for _ in range(10)]
+    assert used[:2] == ["slow", "fast"] and set(used[2:]) == {"fast"}, used
+    
+    # A backend that fails fast doesn't stay the top latency pick between ejections
+    broken, healthy = FakeBackend("broken", 0.0, fail=True), FakeBackend("healthy", 0.001)
+    router = BackendRouter([broken, healthy], strategy="latency", explore_ratio=0.0, eject_seconds=0.0)
+    for _ in range(20):
+        assert (await router.send({"message": "hi"})).content == "healthy"
+    assert router.failovers == 1 and broken.latency > healthy.latency, router.get_stats()
+    
+    # With nowhere left to fail over, the error reaches the retry policy
+    router = BackendRouter([FakeBackend("only", 0.0, fail=True)])
+    try:
+        await router.send({"message": "hi"})
+        assert False, "Expected CursorAPIError"
+    except CursorAPIError:
+        pass
+    
+    print(f"✅ Requests by backend: slow={slow.requests}, fast={fast.requests}")
+    print("✅ Backend routing test passed!\n")
+
+async def test_hedged_requests():
+    """Test that slow requests are hedged to another backend within the budget."""
+    print("🧪 Testing Hedged Requests...")
+    
+    async def prime(hedger):
+        for _ in range(hedger.min_samples):
+            await hedger.run(lambda hedged: asyncio.sleep(0.005))
+    
+    # The original goes to the stuck backend; the hedge avoids it and wins
+    stuck, fast = FakeBackend("stuck", 0.5), FakeBackend("fast", 0.005)
+    hedger = Hedger(budget_ratio=0.5, min_delay=0.02, min_samples=5)
+    router = BackendRouter([stuck, fast], strategy="least_outstanding", hedger=hedger)
+    await prime(hedger)
+    start_time = time.monotonic()
+    result = await router.send({"message": "hi"})
+    elapsed = time.monotonic() - start_time
+    assert result.content == "fast" and elapsed < 0.2, (result.content, elapsed)
+    assert hedger.hedges == 1 and hedger.hedge_wins == 1
+    assert stuck.outstanding == 0 and stuck.latency is not None, "Loser should be cancelled"
+    
+    # Streaming requests are never hedged
+    stuck.latency = None
+    await router.send({"message": "hi"}, stream=True)
+    assert hedger.hedges == 1
+    
+    # Coalesced requests carry a chunk callback, but aren't streamed and are still hedged
+    stuck.latency = None
+    client = CursorClient(backends=[stuck, fast])
+    client.router = router
+    client.single_flight = SingleFlight()
+    replies = []
+    
+    async def on_chunk(chunk):
+        replies.append(chunk)
+    
+    start_time = time.monotonic()
+    responses = await asyncio.gather(*[
+        client.send_message("hi", conversation_id=f"chat_{i}", on_chunk=on_chunk) for i in range(3)
+    ])
+    coalesced_elapsed = time.monotonic() - start_time
+    assert [r.content for r in responses] == ["fast"] * 3 and replies == ["fast"] * 3, replies
+    assert coalesced_elapsed < 0.2 and hedger.hedges == 2, (coalesced_elapsed, hedger.hedges)
+    assert client.single_flight.followers == 2
+    
+    # Without budget the original is awaited
+    hedger = Hedger(budget_ratio=0.0, min_delay=0.02, min_samples=5)
+    router = BackendRouter([FakeBackend("stuck", 0.1), fast], strategy="least_outstanding", hedger=hedger)
+    await prime(hedger)
+    assert (await router.send({"message": "hi"})).content == "stuck"
+    assert hedger.hedges == 0 and hedger.budget_exhausted == 1
+    
+    print(f"✅ Hedge won in {elapsed * 1000:.0f}ms: {router.get_stats()['hedging']}")
+    print("✅ Hedged requests test passed!\n")
+
+async def test_adaptive_concurrency_limit():
+    """Test that the concurrency limit adapts to upstream latency and sheds excess calls."""
+    print("🧪 Testing Adaptive Concurrency Limit...")
+    
+    async def expect_shed(limiter):
+        try:
+            await limiter.acquire()
+            assert False, "Expected ConcurrencyLimitError"
+        except ConcurrencyLimitError:
+            pass
+    
+    # Calls beyond the limit queue, and are shed once the queue is full or the wait times out
+    limiter = AdaptiveLimiter(initial_limit=1, min_limit=1, max_queue=1, queue_timeout=0.05)
+    await limiter.acquire()
+    waiter = asyncio.create_task(limiter.acquire())
+    await asyncio.sleep(0)
+    assert limiter.queued == 1
+    await expect_shed(limiter)
+    limiter.release()
+    await waiter
+    assert limiter.in_flight == 1 and limiter.queued == 0
+    await expect_shed(limiter)
+    assert limiter.shed == 2
+    
+    # AIMD backs off on overload errors and slow responses
+    limiter = AdaptiveLimiter(algorithm="aimd", initial_limit=10, slow_threshold=1.0)
+    for error in (CursorAPIError("busy", status=429), CursorAPIError("bad", status=400)):
+        try:
+            async with limiter.slot():
+                raise error
+        except CursorAPIError:
+            pass
+    assert limiter.limit == 9.0 and limiter.overloads == 1, limiter.get_stats()
+    await limiter.acquire()
+    limiter.release(rtt=2.0)
+    assert abs(limiter.limit - 8.1) < 1e-9 and limiter.overloads == 2
+    
+    # The gradient limit shrinks when the upstream queues and grows while it keeps up
+    async def drive(initial_limit, max_concurrency):
+        backend = MockBackend(profile="instant", latency="constant:0.02", max_concurrency=max_concurrency)
+        limiter = AdaptiveLimiter(initial_limit=initial_limit, max_limit=100, queue_timeout=5.0)
+        
+        async def worker():
+            for _ in range(15):
+                async with limiter.slot():
+                    await backend.complete({"message": "hi"}, None, stream=False)
+        
+        await asyncio.gather(*(worker() for _ in range(40)))
+        return int(limiter.limit)
+    
+    capped, free = await drive(40, 5), await drive(4, 0)
+    assert capped < 25 and free > 40, (capped, free)
+    
+    # A shed call fails fast instead of being retried
+    client = CursorClient(backends=[MockBackend(profile="instant", latency="constant:0.05")])
+    client.limiter = AdaptiveLimiter(initial_limit=1, min_limit=1, max_queue=0)
+    results = await asyncio.gather(client.send_message("one", use_cache=False),
+                                   client.send_message("two", use_cache=False), return_exceptions=True)
+    assert any(isinstance(result, ConcurrencyLimitError) for result in results), results
+    assert client.retry_policy.retries == 0
+    await client.close()
+    
+    print(f"✅ Gradient limit settled at {capped} with a capped upstream and {free} without")
+    print("✅ Adaptive concurrency limit test passed!\n")
+
+async def test_simulation_profiles():
+    """Test latency distributions, injected failures, streaming and queuing of the mock backend."""
+    print("🧪 Testing Simulation Profiles...")
+    
+    assert parse_latency("constant:0.25")() == 0.25
+    assert 0.1 <= parse_latency("uniform:0.1,0.2")() <= 0.2
+    recorded = [parse_latency("histogram:0.1=0,0.5=10,2=0")() for _ in range(50)]
+    assert all(0.1 <= value <= 0.5 for value in recorded), recorded
+    for spec in ("gamma:1", "lognormal:1", "histogram:0.1"):
+        try:
+            parse_latency(spec)
+            assert False, f"Expected ValueError for {spec}"
+        except ValueError:
+            pass
+    
+    # Streaming emits token-rate paced chunks that add up to the reply
+    backend = MockBackend(profile="instant", token_rate=2000, chunk_tokens=4)
+    chunks = []
+    async def collect(chunk):
+        chunks.append(chunk)
+    cursor_msg = await backend.complete({"message": "hello"}, collect, stream=True)
+    assert len(chunks) > 1 and "".join(chunks) == cursor_msg.content
+    
+    # Injected failures surface as the errors the retry policy expects
+    for overrides, status in (({"error_rate": 1.0}, 503), ({"rate_limit_rate": 1.0}, 429),
+                              ({"timeout_rate": 1.0, "timeout_after": 0.01}, None)):
+        backend = MockBackend(profile="instant", **overrides)
+        try:
+            await backend.complete({"message": "hello"}, None, stream=False)
+            assert False, "Expected CursorAPIError"
+        except CursorAPIError as e:
+            assert e.status == status and e.retryable, (overrides, e.status)
+    
+    # Requests beyond the concurrency cap queue
+    backend = MockBackend(profile="instant", latency="constant:0.05", max_concurrency=2)
+    start_time = time.monotonic()
+    tasks = [asyncio.create_task(backend.complete({"message": "hi"}, None, stream=False)) for _ in range(6)]
+    await asyncio.sleep(0.01)
+    queued = backend.queued
+    await asyncio.gather(*tasks)
+    elapsed = time.monotonic() - start_time
+    assert queued == 4 and elapsed >= 0.15, (queued, elapsed)
+    
+    client = MockCursorClient(profile="instant")
+    assert (await client.send_message("Hi")).content
+    await client.close()
+    
+    print(f"✅ 6 requests through 2 slots took {elapsed * 1000:.0f}ms")
+    print("✅ Simulation profiles test passed!\n")
+
+async def test_performance_profile():
+    """Test that the fast JSON codec matches the standard library and falls back cleanly."""
+    print("🧪 Testing Performance Profile...")
+    
+    frame = {"seq": 7, "update": {"message": {"chat": {"id": -100123}, "text": "héllo ✨"}}, "ok": True, "none": None}
+    saved = performance.fast_json
+    try:
+        outputs = []
+        for enabled in (False, True):
+            performance.fast_json = enabled and performance.orjson is not None
+            encoded = performance.json_dumps(frame)
+            assert performance.json_loads(encoded) == frame
+            assert performance.json_loads(encoded.decode()) == frame
+            outputs.append(json.loads(encoded))
+        assert outputs[0] == outputs[1]
+        
+        # Torn message log lines must still be detected as invalid JSON
+        try:
+            performance.json_loads(b'{"id": "abc", "sta')
+            assert False, "Expected ValueError"
+        except ValueError:
+            pass
+    finally:
+        performance.fast_json = saved
+    
+    assert performance.install_event_loop() == "asyncio"
+    profile = performance.get_profile()
+    assert profile["event_loop"] == "asyncio", profile
+    
+    print(f"✅ Profile: {profile}, orjson installed: {performance.orjson is not None}")
+    print("✅ Performance profile test passed!\n")
+
+@asynccontextmanager
+async def stub_relay(**overrides):
+    """Run a relay in webhook mode against the benchmark's stub Bot API, with files in a temp dir."""
+    from relay import TelegramCursorRelay
+    from config import settings
+    
+    telegram_stub = benchmark.TelegramStub()
+    runner = web.AppRunner(telegram_stub.app(), access_log=None)
+    await runner.setup()
+    port = benchmark.free_port()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    
+    overrides = {
+        "telegram_bot_token": benchmark.STUB_TOKEN,
+        "telegram_api_url": f"http://127.0.0.1:{port}",
+        "telegram_mode": "webhook",
+        "telegram_webhook_url": "http://127.0.0.1",
+        "telegram_webhook_secret": "s3cret",
+        "tracing_exporter": "none",
+        "cursor_mock_profile": "instant",
+        **overrides,
+    }
+    saved = {name: getattr(settings, name) for name in list(overrides) + ["storage_path", "relay_log_path"]}
+    relay = None
+    with tempfile.TemporaryDirectory() as tmp:
+        try:
+            for name, value in overrides.items():
+                setattr(settings, name, value)
+            settings.storage_path = os.path.join(tmp, "relay.db")
+            settings.relay_log_path = os.path.join(tmp, "relay-messages.log")
+            
+            relay = TelegramCursorRelay()
+            await relay.initialize()
+            await relay.start()
+            yield relay, telegram_stub
+        finally:
+            if relay and relay.is_running:
+                await relay.stop()
+            for name, value in saved.items():
+                setattr(settings, name, value)
+            await runner.cleanup()
+
+async def test_relay_stop_drains():
+    """Test that stopping the relay still sends the replies of queued messages."""
+    print("🧪 Testing Relay Stop Drains Replies...")
+    
+    async with stub_relay() as (relay, telegram_stub):
+        relay.cursor_client.router.backends = [MockBackend(profile="instant", latency="constant:0.05")]
+        for i in range(3):
+            telegram_stub.expect_reply(5)
+            await relay._handle_telegram_message(TelegramMessage(
+                message_id=i, chat_id=5, user_id=5, text=f"queued {i}",
+                message_type=MessageType.TEXT, timestamp=datetime.now()
+            ))
+        await relay.stop()
+        assert telegram_stub.replies == 3 and not telegram_stub.error_replies, telegram_stub.replies
+        
+        # As on /restart, the relay answers again once started
+        await relay.start()
+        telegram_stub.expect_reply(5)
+        await relay._handle_telegram_message(TelegramMessage(
+            message_id=3, chat_id=5, user_id=5, text="after restart",
+            message_type=MessageType.TEXT, timestamp=datetime.now()
+        ))
+        await relay.stop()
+        assert telegram_stub.replies == 4 and not telegram_stub.error_replies, telegram_stub.replies
+    
+    print(f"✅ Replies delivered across stop and restart: {telegram_stub.replies}")
+    print("✅ Relay stop drains test passed!\n")
+
+async def test_undelivered_reply_replay():
+    """Test that a reply Telegram didn't take keeps the message unfinished until it is resent."""
+    print("🧪 Testing Undelivered Reply Replay...")
+    
+    from telegram.error import NetworkError
+    
+    async with stub_relay() as (relay, telegram_stub):
+        cursor_calls = []
+        send_to_cursor = relay.cursor_client.send_message
+        async def counting_send_message(*args, **kwargs):
+            cursor_calls.append(kwargs.get("message"))
+            return await send_to_cursor(*args, **kwargs)
+        relay.cursor_client.send_message = counting_send_message
+        
+        send_to_telegram = relay.telegram_client.send_message
+        async def telegram_down(*args, **kwargs):
+            raise NetworkError("connection reset")
+        relay.telegram_client.send_message = telegram_down
+        
+        telegram_stub.expect_reply(9)
+        await relay._handle_telegram_message(TelegramMessage(
+            message_id=1, chat_id=9, user_id=9, text="are you there?",
+            message_type=MessageType.TEXT, timestamp=datetime.now()
+        ))
+        await relay.stop()
+        assert telegram_stub.replies == 0
+        assert relay.message_log.get_stats()["unfinished"] == 1, relay.message_log.get_stats()
+        
+        # After a restart only the reply is sent again; Cursor isn't asked twice
+        relay.telegram_client.send_message = send_to_telegram
+        await relay.start()
+        for _ in range(100):
+            if telegram_stub.replies:
+                break
+            await asyncio.sleep(0.02)
+        await relay.stop()
+        assert telegram_stub.replies == 1 and not telegram_stub.error_replies
+        assert cursor_calls == ["are you there?"], cursor_calls
+        assert relay.message_log.get_stats()["unfinished"] == 0
+    
+    print(f"✅ Cursor calls: {len(cursor_calls)}, replies after restart: {telegram_stub.replies}")
+    print("✅ Undelivered reply replay test passed!\n")
+
+async def test_webhook_route():
+    """Test that webhook updates need the secret token and are relayed when it matches."""
+    print("🧪 Testing Webhook Route...")
+    
+    import httpx
+    import main as app_main
+    from config import settings
+    
+    async with stub_relay() as (relay, telegram_stub):
+        try:
+            dispatched = []
+            submit = relay.dispatcher.submit
+            async def recording_submit(chat_id, relay_msg):
+                dispatched.append((chat_id, relay_msg.telegram_message.text))
+                await submit(chat_id, relay_msg)
+            relay.dispatcher.submit = recording_submit
+            app_main.relay = relay
+            
+            update = {"update_id": 1, "message": {
+                "message_id": 5, "date": int(time.time()), "text": "hello over webhook",
+                "chat": {"id": 77, "type": "private"}, "from": {"id": 77, "is_bot": False, "first_name": "Test"},
+            }}
+            telegram_stub.expect_reply(77)
+            transport = httpx.ASGITransport(app=app_main.create_app())
+            async with httpx.AsyncClient(transport=transport, base_url="http://relay") as client:
+                rejected = await client.post(settings.telegram_webhook_path, json=update,
+                                             headers={"X-Telegram-Bot-Api-Secret-Token": "wrong"})
+                assert rejected.status_code == 403 and not dispatched, rejected.status_code
+                
+                accepted = await client.post(settings.telegram_webhook_path, json=update,
+                                             headers={"X-Telegram-Bot-Api-Secret-Token": "s3cret"})
+                assert accepted.status_code == 200 and accepted.json() == {"ok": True}, accepted.text
+            assert dispatched == [(77, "hello over webhook")], dispatched
+            for _ in range(100):
+                if telegram_stub.replies:
+                    break
+                await asyncio.sleep(0.02)
+            assert telegram_stub.replies == 1 and not telegram_stub.error_replies
+        finally:
+            app_main.relay = None
+    
+    print(f"✅ Dispatched: {dispatched}")
+    print("✅ Webhook route test passed!\n")
+
+async def test_log_module_levels():
+    """Test that per-module level overrides filter records and JSON output is structured."""
+    print("🧪 Testing Log Module Levels...")
+    
+    import io
+    import logger as log_config
+    
+    levels = log_config.build_module_levels("warning", {"cursor_client": "debug", "dispatcher": "error"})
+    assert levels == {"": "WARNING", "cursor_client": "DEBUG", "dispatcher": "ERROR"}
+    
+    output = io.StringIO()
+    sink_id = log_config.logger.add(output, level="DEBUG", filter=levels, serialize=True)
+    
+    def emit(module, level, message):
+        # Records are filtered by the module they are logged from
+        get_logger(module).patch(lambda record: record.update(name=module)).log(level, message, module)
+    
+    try:
+        emit("cursor_client", "DEBUG", "kept {}")
+        emit("dispatcher", "WARNING", "dropped {}")
+        emit("dispatcher", "ERROR", "kept {}")
+        emit("relay", "INFO", "dropped {}")
+        emit("relay", "WARNING", "kept {}")
+    finally:
+        log_config.logger.remove(sink_id)
+    
+    records = [json.loads(line)["record"] for line in output.getvalue().splitlines()]
+    kept = [(r["name"], r["level"]["name"], r["message"], r["extra"]["name"]) for r in records]
+    assert kept == [
+        ("cursor_client", "DEBUG", "kept cursor_client", "cursor_client"),
+        ("dispatcher", "ERROR", "kept dispatcher", "dispatcher"),
+        ("relay", "WARNING", "kept relay", "relay"),
+    ], kept
+    
+    print(f"✅ Kept: {[(name, level) for name, level, _, _ in kept]}")
+    print("✅ Log module levels test passed!\n")
+
+async def test_benchmark_helpers():
+    """Test percentiles and baseline comparison of the benchmark."""
+    print("🧪 Testing Benchmark Helpers...")
+    
+    summary = benchmark.summarize_ms([i / 1000 for i in range(1, 101)])
+    assert summary["p50"] == 50 and summary["p99"] == 99 and summary["max"] == 100, summary
+    
+    def results(throughput, p99):
+        return {"results": {"throughput_per_second": throughput, "latency_ms": {"p99": p99}}}
+    
+    assert benchmark.compare(results(100, 200), results(105, 190), 0.1) == []
+    regressions = benchmark.compare(results(80, 300), results(100, 200), 0.1)
+    assert len(regressions) == 2 and regressions[0].startswith("throughput_per_second"), regressions
+    
+    print(f"✅ Detected: {regressions}")
+    print("✅ Benchmark helpers test passed!\n")
+
 async def main():
     """Run all tests."""
     print("🚀 Starting Telegram-Cursor Relay Tests")
@@ -90,6 +1280,32 @@ async def main():
         await test_telegram_message_model()
         await test_cursor_client()
         await test_relay_message_flow()
+        await test_dispatcher_ordering()
+        await test_message_retention()
+        await test_conversation_store()
+        await test_sqlite_storage()
+        await test_streaming_reply()
+        await test_retry_policy()
+        await test_send_scheduler()
+        await test_response_cache()
+        await test_context_window()
+        await test_request_coalescing()
+        await test_request_batching()
+        await test_connection_pool_metrics()
+        await test_backend_routing()
+        await test_hedged_requests()
+        await test_adaptive_concurrency_limit()
+        await test_simulation_profiles()
+        await test_performance_profile()
+        await test_benchmark_helpers()
+        await test_log_module_levels()
+        await test_webhook_route()
+        await test_relay_stop_drains()
+        await test_undelivered_reply_replay()
+        await test_metrics_rendering()
+        await test_tracing_spans()
+        await test_shard_link_replay()
+        await test_message_log_replay()
         
         print("🎉 All tests passed successfully!")
         print("\nThe relay system is ready to use!")
@@ -0,0 +1,264 @@
+"""
+Lightweight, sampled tracing of relay messages.
+
+Each sampled relay message gets a trace whose spans cover the stages it goes
+through. Unsampled messages cost one dictionary lookup per span. Finished
+spans are buffered and exported in the background as JSON lines or to an
+OTLP/HTTP collector.
+"""
+import asyncio
+import json
+import random
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Any, Deque, Dict, Iterator, List, Optional
+import aiohttp
+from logger import get_logger
+from config import settings
+
+logger = get_logger("tracing")
+
+class Span:
+    """A timed operation within a trace."""
+
+    __slots__ = ("trace_id", "span_id", "parent_id", "name", "start_ns", "end_ns", "attributes", "error")
+
+    def __init__(self, trace_id: str, name: str, parent_id: Optional[str] = None,
+                 attributes: Optional[Dict[str, Any]] = None):
+        self.trace_id = trace_id
+        self.span_id = "%016x" % random.getrandbits(64)
+        self.parent_id = parent_id
+        self.name = name
+        self.start_ns = time.time_ns()
+        self.end_ns: Optional[int] = None
+        self.attributes = attributes or {}
+        self.error: Optional[str] = None
+
+    def set_attribute(self, key: str, value: Any):
+        self.attributes[key] = value
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start_ns": self.start_ns,
+            "end_ns": self.end_ns,
+            "duration_ms": round((self.end_ns - self.start_ns) / 1e6, 3) if self.end_ns else None,
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+class _NoopSpan:
+    """Stand-in yielded when the current message is not sampled."""
+
+    __slots__ = ()
+
+    def set_attribute(self, key: str, value: Any):
+        pass
+
+_NOOP_SPAN = _NoopSpan()
+_current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+class JsonLinesExporter:
+    """Append spans to a file, one JSON object per line."""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    async def export(self, spans: List[Dict[str, Any]]):
+        lines = "".join(json.dumps(span, default=str) + "\n" for span in spans)
+        await asyncio.get_running_loop().run_in_executor(None, self._write, lines)
+
+    def _write(self, lines: str):
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(lines)
+
+    async def close(self):
+        pass
+
+class OtlpHttpExporter:
+    """Send spans to an OTLP/HTTP collector using the JSON encoding."""
+
+    def __init__(self, endpoint: str, service_name: str = "telegram-cursor-relay"):
+        self.endpoint = endpoint
+        self.service_name = service_name
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    @staticmethod
+    def _attribute(key: str, value: Any) -> Dict[str, Any]:
+        if isinstance(value, bool):
+            return {"key": key, "value": {"boolValue": value}}
+        if isinstance(value, int):
+            return {"key": key, "value": {"intValue": str(value)}}
+        if isinstance(value, float):
+            return {"key": key, "value": {"doubleValue": value}}
+        return {"key": key, "value": {"stringValue": str(value)}}
+
+    def _to_otlp(self, span: Dict[str, Any]) -> Dict[str, Any]:
+        otlp_span = {
+            "traceId": span["trace_id"],
+            "spanId": span["span_id"],
+            "name": span["name"],
+            "kind": 1,
+            "startTimeUnixNano": str(span["start_ns"]),
+            "endTimeUnixNano": str(span["end_ns"]),
+            "attributes": [self._attribute(k, v) for k, v in span["attributes"].items()],
+            "status": {"code": 2, "message": span["error"]} if span["error"] else {"code": 1},
+        }
+        if span["parent_id"]:
+            otlp_span["parentSpanId"] = span["parent_id"]
+        return otlp_span
+
+    async def export(self, spans: List[Dict[str, Any]]):
+        if not self._session:
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=5))
+        body = {
+            "resourceSpans": [{
+                "resource": {"attributes": [self._attribute("service.name", self.service_name)]},
+                "scopeSpans": [{"scope": {"name": "relay"}, "spans": [self._to_otlp(s) for s in spans]}],
+            }]
+        }
+        async with self._session.post(self.endpoint, json=body) as response:
+            if response.status >= 300:
+                raise RuntimeError(f"OTLP collector returned {response.status}")
+
+    async def close(self):
+        if self._session:
+            await self._session.close()
+            self._session = None
+
+class Tracer:
+    """Samples relay messages and records spans for them."""
+
+    def __init__(self, sample_rate: float = 0.0, exporter=None, flush_interval: float = 5.0,
+                 max_buffer: int = 10000):
+        self.sample_rate = sample_rate
+        self.exporter = exporter
+        self.flush_interval = flush_interval
+        self._roots: Dict[str, Span] = {}
+        self._buffer: Deque[Dict[str, Any]] = deque(maxlen=max_buffer)
+        self._flusher: Optional[asyncio.Task] = None
+        self.sampled = 0
+        self.exported = 0
+        self.export_errors = 0
+
+    def start_trace(self, message_id: str, name: str = "relay.message", **attributes: Any) -> bool:
+        """Start a trace for a message if it is sampled; return whether it was."""
+        if not self.exporter or random.random() >= self.sample_rate:
+            return False
+        # Relay message ids are UUIDs, which map directly onto 128-bit trace ids
+        trace_id = uuid.UUID(message_id).hex
+        self._roots[message_id] = Span(trace_id, name, attributes=attributes)
+        self.sampled += 1
+        return True
+
+    @contextmanager
+    def resume(self, message_id: str) -> Iterator[None]:
+        """Make a message's trace current for the duration of a with-block."""
+        root = self._roots.get(message_id)
+        if root is None:
+            yield
+            return
+        token = _current_span.set(root)
+        try:
+            yield
+        finally:
+            _current_span.reset(token)
+
+    @contextmanager
+    def span(self, name: str, **attributes: Any) -> Iterator[Any]:
+        """Record a child span of the current span, if there is one."""
+        parent = _current_span.get()
+        if parent is None:
+            yield _NOOP_SPAN
+            return
+
+        span = Span(parent.trace_id, name, parent.span_id, attributes)
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.error = str(e) or type(e).__name__
+            raise
+        finally:
+            _current_span.reset(token)
+            span.end_ns = time.time_ns()
+            self._buffer.append(span.to_dict())
+
+    def finish_trace(self, message_id: str, error: Optional[str] = None, **attributes: Any):
+        """End a message's trace and queue it for export."""
+        root = self._roots.pop(message_id, None)
+        if root is None:
+            return
+        root.attributes.update(attributes)
+        root.error = error
+        root.end_ns = time.time_ns()
+        self._buffer.append(root.to_dict())
+
+    def start(self):
+        """Start periodic export."""
+        if self.exporter and not self._flusher:
+            self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        """Stop periodic export and flush what is buffered."""
+        if self._flusher:
+            self._flusher.cancel()
+            await asyncio.gather(self._flusher, return_exceptions=True)
+            self._flusher = None
+        await self.flush()
+        if self.exporter:
+            await self.exporter.close()
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def flush(self):
+        """Export buffered spans."""
+        if not self._buffer or not self.exporter:
+            return
+        batch = list(self._buffer)
+        self._buffer.clear()
+        try:
+            await self.exporter.export(batch)
+            self.exported += len(batch)
+        except Exception as e:
+            self.export_errors += 1
+            logger.warning("Failed to export {} spans: {}", len(batch), e)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get tracing statistics."""
+        return {
+            "sample_rate": self.sample_rate,
+            "sampled": self.sampled,
+            "active_traces": len(self._roots),
+            "buffered_spans": len(self._buffer),
+            "exported_spans": self.exported,
+            "export_errors": self.export_errors,
+        }
+
+def create_tracer() -> Tracer:
+    """Create the tracer configured in settings."""
+    exporter_name = settings.tracing_exporter.lower()
+    if exporter_name == "jsonl":
+        exporter = JsonLinesExporter(settings.tracing_jsonl_path)
+    elif exporter_name == "otlp":
+        exporter = OtlpHttpExporter(settings.tracing_otlp_endpoint)
+    elif exporter_name == "none":
+        exporter = None
+    else:
+        raise ValueError(f"Unknown tracing exporter: {settings.tracing_exporter}")
+    return Tracer(
+        sample_rate=settings.tracing_sample_rate,
+        exporter=exporter,
+        flush_interval=settings.tracing_flush_interval
+    )